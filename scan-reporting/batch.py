@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Processes many patients one after another in a single Python process. Because
+the pipelines are imported once, the libraries they load (numpy, matplotlib,
+nibabel, python-pptx, ...), the report templates and the REDCap connection are
+reused from one patient to the next instead of being loaded again for each one.
+
+The job file has one patient per line: the pipeline (bold or scd) followed by
+the options you would pass to process_bold.py or process_scd.py, e.g.,
+
+    bold -i /path/to/PTSTEN_101_01 -n Doe -s 0 -d 1960.01.01
+    scd -i /path/to/PTSTEN_202_01 -n Roe -s 124 -h 0.3 -p sca -a 0.98 -r 0
+
+Blank lines and lines starting with # are ignored. Options are split like a
+shell would, so paths with spaces can be quoted.
+
+input:
+    -j / --jobs : the job file
+    -k / --keepgoing : carry on with the next patient if one fails. by default the batch
+        stops at the first failure. does not take an argument
+    -q / --unattended : run every patient as if -q / --unattended had been passed. does not take an argument
+    -l / --dryrun : only print the step plan of every patient. does not take an argument
+    -r / --report : write a JSON summary of the batch (status and time of every patient) here
+    -d / --shared : share the batch with other machines through this queue folder on a shared
+        drive. The jobs of -j (if given) are added to the queue, then this machine works through
+        the queue alongside any others started with the same -d until every job is done. A job
+        whose machine stops touching its lease for -e seconds is taken over by another machine.
+        Implies -q and -k. See shared_queue.py
+    -e / --lease : seconds before an untouched lease is taken over. default: 120
+    -w / --workers : run this many patients at the same time, on worker processes that import the
+        pipelines once. Jobs are ordered by their estimated time and memory: report-only jobs first,
+        then the longest first, starting each only if it fits in the memory budget. Implies -q. The
+        output of each patient goes to logs/batch.log in its folder. See scheduler.py
+    -m / --memory : with -w, the memory budget in MB. default: 80% of this machine's memory
+    -p / --preflight : check every job's inputs first (see preflight.py) and don't run the jobs
+        that fail the checks. They count as failed. does not take an argument
+    -g / --help : brings up this helpful information. does not take an argument
+
+The exit status is 1 if any patient failed.
+"""
+
+import os
+import sys
+import getopt
+import shlex
+import time
+import json
+import traceback
+import importlib
+
+PIPELINES = {'bold':'process_bold',
+             'scd':'process_scd'} # pipeline: module
+
+
+def read_jobs(job_file):
+    """
+    Reads a job file
+
+
+    Parameters
+    ----------
+    job_file : str
+        path to the job file. See help_info for the format.
+
+    Returns
+    -------
+    list of (pipeline, argv) tuples.
+
+    """
+
+    jobs = []
+    with open(job_file) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = shlex.split(line)
+            if parts[0] not in PIPELINES:
+                raise ValueError(f'Line {i+1} of {job_file}: the pipeline must be one of {list(PIPELINES)}, not {parts[0]}')
+            jobs.append((parts[0], parts[1:]))
+    return jobs
+
+
+def release_figures():
+    # pyplot keeps every open figure alive, so a long batch would keep the figures of every patient
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+
+def run_job(pipeline, argv, unattended=False, dry_run=False):
+    """
+    Processes one patient in this process
+
+
+    Parameters
+    ----------
+    pipeline : str
+        'bold' or 'scd'.
+    argv : list of str
+        the options of process_bold.py or process_scd.py.
+    unattended, dry_run : bool, optional
+        force -q / -l on. The default is False.
+
+    Returns
+    -------
+    the run (BoldRun or ScdRun).
+
+    """
+
+    module = importlib.import_module(PIPELINES[pipeline])
+    run = module.parse_args(argv)
+    if unattended:
+        run.unattended = True
+    if dry_run:
+        run.dry_run = True
+    try:
+        return module.process(run)
+    finally:
+        release_figures()
+
+
+def run_batch(jobs, keep_going=False, unattended=False, dry_run=False):
+    """
+    Processes a list of patients one after another
+
+
+    Parameters
+    ----------
+    jobs : list of (pipeline, argv) tuples
+        see read_jobs().
+    keep_going : bool, optional
+        carry on after a patient fails. The default is False.
+    unattended, dry_run : bool, optional
+        see run_job(). The default is False.
+
+    Returns
+    -------
+    dict summarizing the batch.
+
+    """
+
+    results = []
+    start = time.perf_counter()
+    for n, (pipeline, argv) in enumerate(jobs):
+        label = ' '.join(argv[argv.index('-i')+1:argv.index('-i')+2]) if '-i' in argv else f'job {n+1}'
+        print(f'\n##### [{n+1}/{len(jobs)}] {pipeline}: {label}\n')
+        job_start = time.perf_counter()
+        try:
+            run_job(pipeline, argv, unattended, dry_run)
+            status, error = 'ok', None
+        except (Exception, SystemExit) as e: # e.g., -g in a job, or a sys.exit in parse_args
+            traceback.print_exc()
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+        elapsed = time.perf_counter() - job_start
+        results.append({'pipeline':pipeline, 'patient':os.path.basename(os.path.normpath(label)), 'status':status,
+                        'error':error, 'seconds':round(elapsed, 2)})
+        if status != 'ok' and not keep_going:
+            print(f'\n{label} failed. Stopping the batch (use -k / --keepgoing to carry on)')
+            break
+
+    wall = time.perf_counter() - start
+    n_ok = sum([r['status'] == 'ok' for r in results])
+    summary = {'jobs':len(jobs), 'processed':len(results), 'succeeded':n_ok,
+               'wall_seconds':round(wall, 2), 'results':results}
+
+    print('\nBatch summary:')
+    for r in results:
+        print(f"\t{r['patient']} ({r['pipeline']}): {r['status']} in {r['seconds']} s" + (f" - {r['error']}" if r['error'] else ''))
+    print(f'{n_ok} of {len(jobs)} patients processed in {round(wall, 1)} s')
+    return summary
+
+
+def preflight_jobs(jobs, unattended=False):
+    """
+    Checks the inputs of jobs (see preflight.py)
+
+
+    Returns
+    -------
+    tuple of (the jobs that passed, results for the jobs that failed as in run_batch()).
+
+    """
+
+    import preflight
+
+    report = preflight.check_jobs(jobs, unattended)
+    preflight.print_report(report)
+    passed = [job for job, r in zip(jobs, report['jobs']) if r['ok']]
+    rejected = [{'pipeline':r['pipeline'], 'patient':r['patient'], 'status':'rejected',
+                 'error':'; '.join([e['message'] for e in r['errors']]), 'seconds':0}
+                for r in report['jobs'] if not r['ok']]
+    return passed, rejected
+
+
+def run_shared(queue_folder, jobs=None, lease=120, dry_run=False):
+    """
+    Works through a queue shared with other machines. See shared_queue.py
+
+
+    Parameters
+    ----------
+    queue_folder : str
+        the queue folder on the shared drive.
+    jobs : list of (pipeline, argv) tuples, optional
+        jobs to add to the queue first. The default is None.
+    lease : float, optional
+        seconds before an untouched lease is taken over. The default is 120.
+    dry_run : bool, optional
+        see run_job(). The default is False.
+
+    Returns
+    -------
+    dict summarizing the queue.
+
+    """
+
+    import shared_queue
+
+    queue = shared_queue.SharedQueue(queue_folder, lease=lease)
+    if jobs:
+        queue.publish(jobs)
+
+    def run(pipeline, argv):
+        label = ' '.join(argv[argv.index('-i')+1:argv.index('-i')+2]) if '-i' in argv else pipeline
+        print(f'\n##### {pipeline}: {label}\n')
+        job_start = time.perf_counter()
+        try:
+            run_job(pipeline, argv, unattended=True, dry_run=dry_run)
+            status, error = 'ok', None
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+        return {'pipeline':pipeline, 'patient':os.path.basename(os.path.normpath(label)), 'status':status,
+                'error':error, 'seconds':round(time.perf_counter() - job_start, 2)}
+
+    start = time.perf_counter()
+    ran = shared_queue.work(queue, run)
+    wall = time.perf_counter() - start
+
+    results = [r for r in queue.results().values() if r]
+    n_ok = sum([r['status'] == 'ok' for r in results])
+    summary = {'jobs':len(results), 'processed':len(results), 'succeeded':n_ok, 'ran_here':len(ran),
+               'wall_seconds':round(wall, 2), 'results':results}
+
+    print('\nQueue summary:')
+    for r in results:
+        print(f"\t{r['patient']} ({r['pipeline']}): {r['status']} in {r['seconds']} s on {r['node']}" + (f" - {r['error']}" if r['error'] else ''))
+    print(f'{n_ok} of {len(results)} patients processed, {len(ran)} on this machine in {round(wall, 1)} s')
+    return summary
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "j:kqlr:d:e:w:m:pg", ['jobs=', 'keepgoing', 'unattended', 'dryrun', 'report=', 'shared=', 'lease=',
+                                                           'workers=', 'memory=', 'preflight', 'help'])
+
+    job_file = None
+    keep_going = False
+    unattended = False
+    dry_run = False
+    report = None
+    shared = None
+    lease = 120
+    workers = None
+    memory_mb = None
+    preflight = False
+
+    for opt, arg in options:
+        if opt in ('-j', '--jobs'):
+            job_file = arg
+        elif opt in ('-k', '--keepgoing'):
+            keep_going = True
+        elif opt in ('-q', '--unattended'):
+            unattended = True
+        elif opt in ('-l', '--dryrun'):
+            dry_run = True
+        elif opt in ('-r', '--report'):
+            report = arg
+        elif opt in ('-d', '--shared'):
+            shared = arg
+        elif opt in ('-e', '--lease'):
+            lease = float(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-m', '--memory'):
+            memory_mb = float(arg)
+        elif opt in ('-p', '--preflight'):
+            preflight = True
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    jobs = read_jobs(job_file) if job_file else None
+    rejected = []
+    if preflight and jobs:
+        jobs, rejected = preflight_jobs(jobs, unattended or shared is not None or workers is not None)
+
+    if shared is not None:
+        summary = run_shared(shared, jobs, lease, dry_run)
+    elif job_file is None:
+        raise ValueError('A job file (-j) is required')
+    elif workers is not None and not dry_run:
+        import scheduler
+        summary = scheduler.run_scheduled(jobs, workers, memory_mb, keep_going)
+    else:
+        summary = run_batch(jobs, keep_going, unattended, dry_run)
+    if rejected:
+        summary['jobs'] += len(rejected)
+        summary['results'] += rejected
+        print(f'{len(rejected)} patients were not run as they failed the preflight checks')
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(summary, f, indent=4)
+    if summary['succeeded'] < summary['jobs']:
+        sys.exit(1)
@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Benchmarks for the scan reporting code. Everything runs on synthetic data
+(and the bundled bin/TEMPLATE_BOLD_PLACEHOLDERS.pptx) written to a temporary
+folder, so no patient data is needed. Volumes are made at MNI 2mm
+(91x109x91), MNI 4mm (45x54x45) and native T1 (256x256x180) sizes.
+
+The benchmarks are
+    nii_reads : reading a slice and a volume from a .nii.gz cold, while
+        building the shadow cache, and from the memory-mapped shadow
+    filter_slices : filter_zeroed_axial_slices
+    nii_image : nii_image (one multislice png)
+    compare_nii_images : compare_nii_images (T1 next to CBF)
+    parse_scd_csv : parse_scd_csv on a synthetic PROCESSINGresults.csv
+    replace_in_ppt : replace_in_ppt on the bundled powerpoint template
+    plot_dot : plotting the 12 metric dots on a template slide
+    pdf : assembling and writing an FPDF report with images and a table
+    import_time : starting a fresh interpreter and importing the light modules,
+        or running the pipelines with --help. Also lists any heavy dependency
+        (pandas, matplotlib, ...) that one of them imports at startup
+
+Results can be saved as a baseline, and later runs compared against it.
+
+input:
+    -b / --bench : the benchmarks to run, separated by commas, or all. default: all
+    -r / --repeats : the number of times each measurement is repeated. The best time is reported. default: 5
+    -s / --save : save the results as a baseline JSON with this name
+    -c / --compare : compare the results to this baseline JSON. Exits with status 1 if anything regressed
+    -t / --threshold : the fractional slowdown that counts as a regression. default: 0.2 (20% slower)
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import getopt
+import time
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+import nii_io
+
+from external import REPO_BIN_FOLDER
+
+PPT_TEMPLATE = os.path.join(REPO_BIN_FOLDER, 'TEMPLATE_BOLD_PLACEHOLDERS.pptx')
+
+VOLUME_SHAPES = {'mni2mm':(91, 109, 91),
+                 'mni4mm':(45, 54, 45),
+                 't1':(256, 256, 180)}
+THRESHOLD = 0.2
+
+
+def best_time(func, repeats=5, setup=None):
+    """
+    Times a function call
+
+
+    Parameters
+    ----------
+    func : callable
+        the function to time. Takes no arguments.
+    repeats : int, optional
+        the number of times to time func. The default is 5.
+    setup : callable, optional
+        a function called before every timed call, but not timed itself.
+
+    Returns
+    -------
+    float of the fastest time in seconds.
+
+    """
+
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def synthetic_nii(out_name, shape, dtype=np.int16, seed=0):
+    """
+    Writes a NiFTI of random data that compresses about as well as a real scan
+    (smooth-ish values inside a "head", zeroes outside)
+
+
+    Parameters
+    ----------
+    out_name : str
+        path of the NiFTI to write (.nii or .nii.gz).
+    shape : tuple of int
+        the image shape. 3D or 4D.
+    dtype : numpy dtype, optional
+        the on-disk dtype. The default is np.int16.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    str of out_name.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape[:3])]
+    radius = sum([((g - n/2) / (n/2))**2 for g, n in zip(grid, shape[:3])])
+    head = radius < 0.8
+
+    data = np.zeros(shape, dtype=dtype)
+    base = (1000 * (1 - radius) * head).astype(dtype)
+    if len(shape) == 3:
+        data[:] = base + (rng.integers(0, 50, shape) * head).astype(dtype)
+    else:
+        for t in range(shape[3]):
+            data[..., t] = base + (rng.integers(0, 50, shape[:3]) * head).astype(dtype)
+
+    nib.save(nib.Nifti1Image(data, np.diag([2, 2, 2, 1])), out_name)
+    return out_name
+
+
+def bench_nii_reads(repeats=5, shape=(91, 109, 91, 60)):
+    """
+    Compares cold, cache-building and memory-mapped reads of a .nii.gz
+
+
+    Parameters
+    ----------
+    repeats : int, optional
+        the number of times each measurement is repeated. The default is 5.
+    shape : tuple of int, optional
+        shape of the synthetic 4D image. The default is a 2mm MNI volume with 60 dynamics.
+
+    Returns
+    -------
+    dict of the best times in seconds, keyed by measurement name.
+
+    """
+
+    with tempfile.TemporaryDirectory() as work:
+        gz = synthetic_nii(os.path.join(work, 'bench.nii.gz'), shape)
+        cache = os.path.join(work, 'cache')
+        mid_z = shape[2] // 2
+        mid_t = shape[3] // 2
+
+        def clear_cache():
+            if os.path.exists(cache):
+                for f in os.listdir(cache):
+                    os.remove(os.path.join(cache, f))
+
+        def cold_slice():
+            np.asarray(nib.load(gz).dataobj[:, :, mid_z, mid_t])
+
+        def cold_volume():
+            np.asarray(nib.load(gz).dataobj[..., mid_t])
+
+        def build_shadow():
+            nii_io.get_shadow(gz, cache_folder=cache)
+
+        def mmap_slice():
+            np.asarray(nib.load(nii_io.get_shadow(gz, cache_folder=cache), mmap=True).dataobj[:, :, mid_z, mid_t])
+
+        def mmap_volume():
+            np.asarray(nib.load(nii_io.get_shadow(gz, cache_folder=cache), mmap=True).dataobj[..., mid_t])
+
+        results = {}
+        results['cold_slice'] = best_time(cold_slice, repeats)
+        results['cold_volume'] = best_time(cold_volume, repeats)
+        results['shadow_build'] = best_time(build_shadow, repeats, setup=clear_cache)
+        build_shadow()
+        results['mmap_slice'] = best_time(mmap_slice, repeats)
+        results['mmap_volume'] = best_time(mmap_volume, repeats)
+
+    return results
+
+
+def synthetic_map(out_name, shape, seed=0, nan_outside=False):
+    """
+    Writes a float32 NiFTI that looks like a parametric map (e.g., CBF): smooth
+    values inside a "head" plus noise, and zeroes or NaNs outside
+
+
+    Parameters
+    ----------
+    out_name : str
+        path of the NiFTI to write.
+    shape : tuple of int
+        the 3D image shape.
+    seed : int, optional
+        random seed. The default is 0.
+    nan_outside : bool, optional
+        if True, voxels outside the head are NaN instead of 0. The default is False.
+
+    Returns
+    -------
+    str of out_name.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    radius = sum([((g - n/2) / (n/2))**2 for g, n in zip(grid, shape)])
+    head = radius < 0.8
+
+    data = (60 * (1 - radius) + rng.normal(0, 5, shape)).astype(np.float32)
+    data[~head] = np.nan if nan_outside else 0
+    nib.save(nib.Nifti1Image(data, np.diag([2, 2, 2, 1])), out_name)
+    return out_name
+
+
+def synthetic_processing_csv(out_name, seed=0):
+    """
+    Writes a csv laid out like the *_PROCESSINGresults.csv written by the SCD
+    MATLAB processing, with random values (and some -999s for missing values)
+
+
+    Parameters
+    ----------
+    out_name : str
+        path of the csv to write.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    str of out_name.
+
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # labels have no digits, periods or dashes, as parse_scd_csv strips everything else out of the lines
+    def pair(label, a, b):
+        return f'{label} one, {a}, {label} two, {b}'
+
+    lines = ['processing results for PTSTEN_000_01',
+             'ASL, PLD 1800, LD 1800, TR 4',
+             pair('Tb (s)', round(rng.uniform(0.05, 0.07), 4), -999), # a failed TRUST fit
+             pair('Yv bovine', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             pair('Yv HbF', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             pair('Yv HbAA', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             pair('Yv HbSS', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             f'white volume: {round(rng.uniform(400, 500), 2)}',
+             f'grey volume: {round(rng.uniform(550, 700), 2)}',
+             f'csf volume: {round(rng.uniform(150, 300), 2)}']
+    while len(lines) < 22:
+        if len(lines) in (15, 18):
+            values = rng.uniform(30, 80, 12).round(2).astype(str)
+            values[-1] = '-999' # a territory outside the ASL coverage
+            label = 'territory CBF' if len(lines) == 15 else 'territory CBF sd'
+            lines.append(f'{label}: ' + ', '.join(values))
+        else:
+            lines.append('unused')
+    with open(out_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return out_name
+
+
+
+def bench_filter_slices(repeats=5):
+    """
+    Times filter_zeroed_axial_slices on each volume size
+    """
+
+    from report_image_generation import filter_zeroed_axial_slices
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        for size, shape in VOLUME_SHAPES.items():
+            data = nib.load(synthetic_map(os.path.join(work, f'{size}.nii'), shape, nan_outside=True)).get_fdata()
+            results[size] = best_time(lambda: filter_zeroed_axial_slices(data), repeats)
+    return results
+
+
+def bench_nii_image(repeats=5):
+    """
+    Times rendering a 3x3 multislice png of each volume size with nii_image
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from report_image_generation import nii_image
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        for size, shape in VOLUME_SHAPES.items():
+            nii = synthetic_map(os.path.join(work, f'{size}.nii'), shape)
+            out = os.path.join(work, f'{size}.png')
+            def render():
+                nii_image(nii, (3, 3), out, cmap=matplotlib.cm.inferno, cmax=100)
+                plt.close('all')
+            results[size] = best_time(render, repeats)
+    return results
+
+
+def bench_compare_nii_images(repeats=5):
+    """
+    Times rendering a T1 next to a CBF map with compare_nii_images, as the SCD report does
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from report_image_generation import compare_nii_images
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        shape = VOLUME_SHAPES['mni2mm']
+        t1 = synthetic_nii(os.path.join(work, 't1.nii'), shape)
+        cbf = synthetic_map(os.path.join(work, 'cbf.nii'), shape, seed=1)
+        out = os.path.join(work, 'compare.png')
+        def render():
+            compare_nii_images(niis=[t1, cbf], cmaxes=[None, 100], out_name=out, save=True, frames=list(np.arange(17, 77, 10)))
+            plt.close('all')
+        results['mni2mm'] = best_time(render, repeats)
+    return results
+
+
+def bench_parse_scd_csv(repeats=5):
+    """
+    Times parse_scd_csv on a synthetic PROCESSINGresults.csv
+    """
+
+    from helpers import parse_scd_csv
+
+    with tempfile.TemporaryDirectory() as work:
+        csv = synthetic_processing_csv(os.path.join(work, 'PTSTEN_000_01_PROCESSINGresults.csv'))
+        return {'cbf':best_time(lambda: parse_scd_csv(csv, 0), repeats),
+                'std':best_time(lambda: parse_scd_csv(csv, 0, std=True), repeats)}
+
+
+def bench_replace_in_ppt(repeats=5):
+    """
+    Times one replace_in_ppt call on a fresh copy of the bundled template
+    """
+
+    from helpers import replace_in_ppt
+
+    with tempfile.TemporaryDirectory() as work:
+        ppt = os.path.join(work, 'report.pptx')
+        return {'one_replacement':best_time(lambda: replace_in_ppt('PTSTEN_###_##', 'PTSTEN_000_01', ppt), repeats,
+                                            setup=lambda: shutil.copyfile(PPT_TEMPLATE, ppt))}
+
+
+def bench_plot_dot(repeats=5):
+    """
+    Times plotting the 12 metric dots (6 territories on 2 slides) on the bundled template
+    """
+
+    from pptx import Presentation
+    from helpers import plot_dot
+
+    dots = [os.path.join(REPO_BIN_FOLDER, 'left_dot.png'), os.path.join(REPO_BIN_FOLDER, 'right_dot.png')]
+    pres = Presentation(PPT_TEMPLATE)
+    def plot_all():
+        for slide in (4, 8):
+            for i in range(6):
+                plot_dot(pres.slides[slide], dots[i % 2], 40 + i, 30 + 5*i, (1.0, 5.5), 24.7, 38.2, size=0.11)
+    return {'12_dots':best_time(plot_all, repeats)}
+
+
+def bench_pdf(repeats=5):
+    """
+    Times assembling and writing a two page FPDF report with three images and a table, like the SCD report
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from fpdf import FPDF
+    from report_image_generation import nii_image
+
+    with tempfile.TemporaryDirectory() as work:
+        images = []
+        for i in range(3):
+            nii = synthetic_map(os.path.join(work, f'map{i}.nii'), VOLUME_SHAPES['mni4mm'], seed=i)
+            images.append(os.path.join(work, f'map{i}.png'))
+            nii_image(nii, (3, 3), images[-1], cmap=matplotlib.cm.inferno, cmax=100)
+            plt.close('all')
+        pdf_out = os.path.join(work, 'report.pdf')
+
+        def assemble():
+            pdf = FPDF()
+            pdf.add_page()
+            pdf.set_font('arial', 'B', 16)
+            pdf.cell(210, 10, 'Scan report', 0, 2, 'C')
+            pdf.set_font('arial', '', 10)
+            for row in range(20):
+                for col in range(4):
+                    pdf.cell(45, 6, f'{row}.{col}: {row*col/3:.2f}', 1, 0, 'C')
+                pdf.ln()
+            pdf.add_page()
+            for im in images:
+                pdf.image(im, x=None, y=None, w=80, h=0, type='', link='')
+            pdf.output(pdf_out, 'F')
+
+        return {'two_pages':best_time(assemble, repeats)}
+
+
+HEAVY_MODULES = ['pandas', 'matplotlib', 'scipy', 'pptx', 'fpdf', 'redcap', 'requests', 'nibabel', 'numpy', 'PIL']
+
+# what is run in a fresh interpreter. none of these should import any of HEAVY_MODULES
+IMPORT_TARGETS = {'helpers':'import helpers',
+                  'report_image_generation':'import report_image_generation',
+                  'nii_io':'import nii_io',
+                  'process_bold_help':'import runpy, sys; sys.argv = ["process_bold.py", "-g"]; runpy.run_path("process_bold.py", run_name="__main__")',
+                  'process_scd_help':'import runpy, sys; sys.argv = ["process_scd.py", "-g"]; runpy.run_path("process_scd.py", run_name="__main__")'}
+
+
+def bench_import_time(repeats=5):
+    """
+    Times starting a fresh interpreter and importing each of IMPORT_TARGETS,
+    minus the time to start an interpreter that imports nothing
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, MPLBACKEND='Agg')
+
+    def run(code):
+        subprocess.run([sys.executable, '-c', code], cwd=here, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    empty = best_time(lambda: run('pass'), repeats)
+    results = {'interpreter':empty}
+    for name, code in IMPORT_TARGETS.items():
+        results[name] = max(best_time(lambda: run(code), repeats) - empty, 0)
+
+        # catch a heavy import creeping back in at module level
+        check = (f'import sys, io, contextlib\nwith contextlib.redirect_stdout(io.StringIO()):\n'
+                 f'    try:\n        exec({code!r})\n    except SystemExit:\n        pass\n'
+                 f'print(",".join([m for m in {HEAVY_MODULES!r} if m in sys.modules]))')
+        out = subprocess.run([sys.executable, '-c', check], cwd=here, env=env, check=True,
+                             capture_output=True, text=True).stdout.strip().split('\n')[-1]
+        loaded = [m for m in out.split(',') if m]
+        if loaded:
+            print(f'WARNING: {name} imports {", ".join(loaded)} at startup')
+    return results
+
+
+benchmarks = {'nii_reads':bench_nii_reads,
+              'filter_slices':bench_filter_slices,
+              'nii_image':bench_nii_image,
+              'compare_nii_images':bench_compare_nii_images,
+              'parse_scd_csv':bench_parse_scd_csv,
+              'replace_in_ppt':bench_replace_in_ppt,
+              'plot_dot':bench_plot_dot,
+              'pdf':bench_pdf,
+              'import_time':bench_import_time}
+
+
+def run_suite(names, repeats=5):
+    """
+    Runs a set of benchmarks
+
+
+    Parameters
+    ----------
+    names : list of str
+        keys of benchmarks.
+    repeats : int, optional
+        the number of times each measurement is repeated. The default is 5.
+
+    Returns
+    -------
+    dict of {benchmark.measurement: best time in seconds}.
+
+    """
+
+    results = {}
+    for name in names:
+        print(f'Running {name}')
+        for key, val in benchmarks[name](repeats=repeats).items():
+            results[f'{name}.{key}'] = val
+    return results
+
+
+def save_baseline(results, out_name, repeats):
+    """
+    Saves benchmark results, and what they were run on, as a baseline JSON
+    """
+
+    baseline = {'meta':{'date':time.strftime("%Y-%m-%d %H:%M:%S"),
+                        'python':platform.python_version(),
+                        'machine':platform.platform(),
+                        'repeats':repeats},
+                'results':results}
+    with open(out_name, 'w') as f:
+        json.dump(baseline, f, indent=1)
+
+
+def compare_to_baseline(results, baseline_name, threshold=THRESHOLD):
+    """
+    Compares benchmark results to a baseline
+
+
+    Parameters
+    ----------
+    results : dict
+        {benchmark.measurement: seconds}, e.g., from run_suite().
+    baseline_name : str
+        path to a baseline JSON written by save_baseline().
+    threshold : float, optional
+        the fractional slowdown that counts as a regression. The default is THRESHOLD.
+
+    Returns
+    -------
+    list of str of the measurements that regressed.
+
+    """
+
+    with open(baseline_name) as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    print(f'\n{"measurement":>32} {"baseline":>12} {"now":>12} {"change":>8}')
+    for key, now in results.items():
+        then = baseline.get(key)
+        if then is None:
+            print(f'{key:>32} {"-":>12} {now*1000:10.2f}ms {"new":>8}')
+            continue
+        change = now / then - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print(f'{key:>32} {then*1000:10.2f}ms {now*1000:10.2f}ms {change*100:7.1f}%{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "b:r:s:c:t:g", ['bench=', 'repeats=', 'save=', 'compare=', 'threshold=', 'help'])
+
+    bench = 'all'
+    repeats = 5
+    save_name = None
+    compare_name = None
+    threshold = THRESHOLD
+    for opt, arg in options:
+        if opt in ('-b', '--bench'):
+            bench = arg
+        elif opt in ('-r', '--repeats'):
+            repeats = int(arg)
+        elif opt in ('-s', '--save'):
+            save_name = arg
+        elif opt in ('-c', '--compare'):
+            compare_name = arg
+        elif opt in ('-t', '--threshold'):
+            threshold = float(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    names = list(benchmarks) if bench == 'all' else bench.split(',')
+    for name in names:
+        if name not in benchmarks:
+            raise ValueError(f'Unknown benchmark {name}. Choose from {list(benchmarks)}')
+
+    results = run_suite(names, repeats=repeats)
+    for key, val in results.items():
+        print(f'{key:>32} : {val*1000:10.2f} ms')
+
+    if save_name is not None:
+        save_baseline(results, save_name, repeats)
+        print(f'\nBaseline saved to {save_name}')
+
+    if compare_name is not None:
+        regressions = compare_to_baseline(results, compare_name, threshold)
+        if regressions:
+            print(f'\n{len(regressions)} measurement(s) regressed by more than {round(threshold*100)}%')
+            sys.exit(1)
+        print('\nNo regressions')
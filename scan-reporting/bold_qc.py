@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+This script computes quality control metrics for a 4D BOLD series:
+    per-volume mean intensity
+    global signal (mean intensity within the brain mask)
+    DVARS (RMS of the volume-to-volume intensity change within the brain mask)
+    a temporal SNR (tSNR) map
+
+Everything is computed in one chunked pass over the memory-mapped series, so
+memory use is a few volumes regardless of series length.
+The outputs are [prefix].npz (tSNR map and timecourses), [prefix].json
+(summary numbers) and [prefix].png (a small summary figure).
+
+input:
+    -i / --infile : the BOLD series (NiFTI or PAR)
+    -o / --outfolder : the folder to write the outputs to
+    -p / --prefix : the name of the outputs, without extension. default: bold_qc
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import getopt
+import json
+
+import numpy as np
+
+from nii_io import load_nii
+
+CHUNK_VOLUMES = 8 # volumes read at once
+MASK_FRACTION = 0.1 # voxels brighter than this fraction of the 98th percentile are "brain"
+
+
+def brain_mask(volume, fraction=MASK_FRACTION):
+    """
+    Makes a crude brain mask by thresholding an intensity volume
+
+
+    Parameters
+    ----------
+    volume : 3D numpy array
+        the intensity volume (e.g., a mean of a few BOLD volumes).
+    fraction : float, optional
+        the fraction of the 98th percentile intensity to threshold at. The default is MASK_FRACTION.
+
+    Returns
+    -------
+    3D bool numpy array.
+
+    """
+
+    return volume > fraction * np.percentile(volume, 98)
+
+
+def compute_qc(nii, chunk=CHUNK_VOLUMES):
+    """
+    Computes QC metrics for a 4D BOLD series in one chunked pass
+
+
+    Parameters
+    ----------
+    nii : str
+        path to the series.
+    chunk : int, optional
+        the number of volumes read at once. The default is CHUNK_VOLUMES.
+
+    Returns
+    -------
+    dict with
+        volume_mean : per-volume mean intensity over the whole field of view
+        global_signal : per-volume mean intensity within the brain mask
+        dvars : per-volume DVARS (the first volume is nan as it has no predecessor)
+        tsnr : 3D tSNR map (0 outside the mask)
+        mask : 3D brain mask
+
+    """
+
+    img = load_nii(nii, use_cache=True)
+    shape = img.shape
+    if len(shape) != 4:
+        raise ValueError(f'{nii} is not a 4D series (shape {shape})')
+    tees = shape[3]
+
+    volume_mean = np.empty(tees)
+    global_signal = np.empty(tees)
+    dvars = np.full(tees, np.nan)
+
+    # running voxelwise mean and sum of squared deviations, merged chunk by chunk (Chan et al.)
+    n = 0
+    vox_mean = np.zeros(shape[:3])
+    vox_m2 = np.zeros(shape[:3])
+
+    mask = None
+    prev = None
+    for a in range(0, tees, chunk):
+        b = min(a + chunk, tees)
+        block = np.asarray(img.dataobj[..., a:b], dtype=np.float64)
+        c = b - a
+
+        if mask is None:
+            mask = brain_mask(block.mean(axis=3))
+
+        volume_mean[a:b] = block.mean(axis=(0, 1, 2))
+        in_mask = block[mask] # (voxels, volumes)
+        global_signal[a:b] = in_mask.mean(axis=0)
+
+        if prev is not None:
+            in_mask = np.concatenate([prev[:, np.newaxis], in_mask], axis=1)
+            dvars[a:b] = np.sqrt(np.mean(np.diff(in_mask, axis=1)**2, axis=0))
+        else:
+            dvars[a+1:b] = np.sqrt(np.mean(np.diff(in_mask, axis=1)**2, axis=0))
+        prev = in_mask[:, -1]
+
+        chunk_mean = block.mean(axis=3)
+        chunk_m2 = ((block - chunk_mean[..., np.newaxis])**2).sum(axis=3)
+        delta = chunk_mean - vox_mean
+        total = n + c
+        vox_mean += delta * c / total
+        vox_m2 += chunk_m2 + delta**2 * n * c / total
+        n = total
+
+    std = np.sqrt(vox_m2 / max(n - 1, 1))
+    tsnr = np.zeros(shape[:3])
+    good = mask & (std > 0)
+    tsnr[good] = vox_mean[good] / std[good]
+
+    return {'volume_mean':volume_mean, 'global_signal':global_signal,
+            'dvars':dvars, 'tsnr':tsnr, 'mask':mask}
+
+
+def summarize_qc(qc):
+    """
+    Boils the output of compute_qc() down to a few numbers
+
+
+    Parameters
+    ----------
+    qc : dict
+        output of compute_qc().
+
+    Returns
+    -------
+    dict of floats and ints.
+
+    """
+
+    tsnr_in_mask = qc['tsnr'][qc['mask']]
+    dvars = qc['dvars'][1:]
+    gs = qc['global_signal']
+
+    # DVARS spikes are flagged with the usual boxplot outlier rule
+    q1, q3 = np.percentile(dvars, [25, 75]) if len(dvars) else (np.nan, np.nan)
+    spikes = np.flatnonzero(qc['dvars'] > q3 + 1.5*(q3 - q1))
+
+    return {'n_volumes':int(len(gs)),
+            'mask_voxels':int(qc['mask'].sum()),
+            'tsnr_mean':float(np.mean(tsnr_in_mask)) if tsnr_in_mask.size else float('nan'),
+            'tsnr_median':float(np.median(tsnr_in_mask)) if tsnr_in_mask.size else float('nan'),
+            'dvars_mean':float(np.mean(dvars)) if len(dvars) else float('nan'),
+            'dvars_max':float(np.max(dvars)) if len(dvars) else float('nan'),
+            'dvars_spikes':[int(i) for i in spikes],
+            'global_signal_drift_percent':float(100 * (gs[-1] - gs[0]) / gs[0]) if gs[0] else float('nan')}
+
+
+def write_qc(qc, out_folder, prefix='bold_qc'):
+    """
+    Writes the QC metrics as an npz, a json summary and a small png
+
+
+    Parameters
+    ----------
+    qc : dict
+        output of compute_qc().
+    out_folder : str
+        the folder to write to.
+    prefix : str, optional
+        name of the outputs, without extension. The default is 'bold_qc'.
+
+    Returns
+    -------
+    dict of the paths written, keyed by 'npz', 'json' and 'png'.
+
+    """
+
+    import matplotlib.pyplot as plt
+
+    outs = {ext:os.path.join(out_folder, f'{prefix}.{ext}') for ext in ('npz', 'json', 'png')}
+    summary = summarize_qc(qc)
+
+    np.savez_compressed(outs['npz'], tsnr=qc['tsnr'].astype(np.float32), mask=qc['mask'],
+                        volume_mean=qc['volume_mean'], global_signal=qc['global_signal'], dvars=qc['dvars'])
+    with open(outs['json'], 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    dynamics = np.arange(1, summary['n_volumes'] + 1)
+    fig, axs = plt.subplots(3, 1, figsize=(6, 4), gridspec_kw={'height_ratios':[1, 1, 1.4]})
+    axs[0].plot(dynamics, qc['global_signal'], lw=1, color='black')
+    axs[0].set_ylabel('Global')
+    axs[0].set_xticks([])
+    axs[1].plot(dynamics, qc['dvars'], lw=1, color='tab:red')
+    axs[1].scatter(dynamics[summary['dvars_spikes']], qc['dvars'][summary['dvars_spikes']], s=8, color='tab:red')
+    axs[1].set_ylabel('DVARS')
+    axs[1].set_xlabel('Dynamic Scan')
+    mid = qc['tsnr'].shape[2] // 2
+    axs[2].imshow(np.rot90(qc['tsnr'][:, :, mid]), cmap='inferno', vmin=0, vmax=np.percentile(qc['tsnr'][qc['mask']], 99) if summary['mask_voxels'] else 1)
+    axs[2].set_title(f"tSNR (median {summary['tsnr_median']:.1f})", fontsize=8)
+    axs[2].axis('off')
+    plt.tight_layout()
+    plt.savefig(outs['png'], dpi=100)
+    plt.close(fig)
+
+    return outs
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "i:o:p:g", ['infile=', 'outfolder=', 'prefix=', 'help'])
+
+    prefix = 'bold_qc'
+    in_file = out_folder = None
+    for opt, arg in options:
+        if opt in ('-i', '--infile'):
+            in_file = arg
+        elif opt in ('-o', '--outfolder'):
+            out_folder = arg
+        elif opt in ('-p', '--prefix'):
+            prefix = arg
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if None in (in_file, out_folder):
+        raise Exception('-i and -o must both be specified')
+
+    qc = compute_qc(in_file)
+    outs = write_qc(qc, out_folder, prefix)
+    print(json.dumps(summarize_qc(qc), indent=4))
+    print(f'Wrote {", ".join(outs.values())}')
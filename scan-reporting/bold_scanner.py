@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+This script finds BOLD series that were cancelled early (and so need to be
+repaired with fix_bold_file.py) across all the patients under the data roots.
+
+Only headers are read: the dim field of NiFTIs (which for a .nii.gz only
+needs the first few hundred bytes inflated) and the text of PAR files.
+No voxel data is touched, so thousands of series can be checked in seconds.
+
+input:
+    -r / --roots : the data folders to search, separated by commas.
+        default: the BOLD data folders on the lab machine and data drive
+    -e / --expected : the expected number of dynamics. default: 360
+    -o / --outfile : optional. a csv to write the series that need repair to
+    -a / --all : optional. if 1, the csv lists every series found, not just the ones that need repair. default: 0
+    -t / --threads : the number of headers read at once. default: 16
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import getopt
+import gzip
+import struct
+import csv
+from concurrent.futures import ThreadPoolExecutor
+
+DATA_ROOTS = ['/Users/manusdonahue/Desktop/Projects/BOLD/Data/',
+              '/Volumes/DonahueDataDrive/Data_sort/IC_Stenosis_Trial_ALL_DATA']
+EXPECTED_DYNAMICS = 360 # the number of dynamics passed to Master() in process_bold.py
+SKIP_FOLDERS = ['reporting_images', 'reporting'] # only hold links/copies of other files
+
+bold_exts = ('.PAR', '.par', '.nii', '.nii.gz')
+
+
+def find_bold_series(roots, signature='BOLD'):
+    """
+    Finds every BOLD series (PAR or NiFTI) under a set of folders
+
+
+    Parameters
+    ----------
+    roots : list of str
+        the folders to search recursively. Missing folders are skipped.
+    signature : str, optional
+        a substring that all BOLD filenames contain. The default is 'BOLD'.
+
+    Returns
+    -------
+    list of str of the paths to the series.
+
+    """
+
+    found = []
+    for root in roots:
+        if not os.path.isdir(root):
+            print(f'{root} does not exist. Skipping')
+            continue
+        for folder, subfolders, files in os.walk(root):
+            subfolders[:] = [s for s in subfolders if s not in SKIP_FOLDERS]
+            for f in files:
+                if signature in f and f.endswith(bold_exts):
+                    found.append(os.path.join(folder, f))
+    return found
+
+
+def nifti_shape(path):
+    """
+    Reads the image shape from a NiFTI-1 or NiFTI-2 header without reading
+    any voxel data
+
+
+    Parameters
+    ----------
+    path : str
+        path to a .nii or .nii.gz.
+
+    Returns
+    -------
+    tuple of int.
+
+    """
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        raw = f.read(40 + 8*8)
+
+    # sizeof_hdr is 348 for NiFTI-1 and 540 for NiFTI-2, and tells us the byte order
+    for endian in ('<', '>'):
+        sizeof_hdr = struct.unpack(f'{endian}i', raw[:4])[0]
+        if sizeof_hdr == 348:
+            dim = struct.unpack(f'{endian}8h', raw[40:56])
+            break
+        elif sizeof_hdr == 540:
+            dim = struct.unpack(f'{endian}8q', raw[16:80])
+            break
+    else:
+        raise ValueError(f'{path} does not have a NiFTI header')
+
+    return tuple(dim[1:dim[0]+1])
+
+
+def par_dynamics(path):
+    """
+    Reads the number of dynamics from a PAR file. The dynamics actually listed
+    in the image information are counted, since an early cancel can leave the
+    general information claiming the full number
+
+
+    Parameters
+    ----------
+    path : str
+        path to the PAR.
+
+    Returns
+    -------
+    int.
+
+    """
+
+    declared = None
+    dynamics = set()
+    with open(path, errors='ignore') as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if stripped.startswith('.'):
+                if 'Max. number of dynamics' in stripped:
+                    declared = int(stripped.split(':')[-1])
+            elif not stripped.startswith('#'):
+                cols = stripped.split()
+                try:
+                    dynamics.add(int(cols[2])) # third column is the dynamic scan number
+                except (IndexError, ValueError):
+                    pass
+
+    if dynamics:
+        return len(dynamics)
+    elif declared is not None:
+        return declared
+    raise ValueError(f'Could not find the number of dynamics in {path}')
+
+
+def series_dynamics(path):
+    """
+    Gets the number of dynamics in a PAR or NiFTI from its header
+
+
+    Parameters
+    ----------
+    path : str
+        path to the series.
+
+    Returns
+    -------
+    int.
+
+    """
+
+    if path.endswith(('.PAR', '.par')):
+        return par_dynamics(path)
+
+    shape = nifti_shape(path)
+    return shape[3] if len(shape) > 3 else 1
+
+
+def patient_of(path):
+    """
+    Gets the PTSTEN folder name a file is in, or '' if it is not in one
+    """
+
+    for part in reversed(os.path.normpath(path).split(os.sep)):
+        if part.startswith('PTSTEN'):
+            return part
+    return ''
+
+
+def scan_series(paths, expected=EXPECTED_DYNAMICS, threads=16):
+    """
+    Reads the number of dynamics of many series in parallel
+
+
+    Parameters
+    ----------
+    paths : list of str
+        the series to check.
+    expected : int, optional
+        the expected number of dynamics. The default is EXPECTED_DYNAMICS.
+    threads : int, optional
+        the number of headers read at once. The default is 16.
+
+    Returns
+    -------
+    list of dict, one per series, with keys path, patient, dynamics, expected,
+        needs_repair and error.
+
+    """
+
+    def check(path):
+        row = {'path':path, 'patient':patient_of(path), 'dynamics':None,
+               'expected':expected, 'needs_repair':False, 'error':''}
+        try:
+            row['dynamics'] = series_dynamics(path)
+            row['needs_repair'] = row['dynamics'] < expected
+        except (OSError, ValueError, EOFError, struct.error) as e:
+            row['error'] = str(e)
+        return row
+
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        return list(pool.map(check, paths))
+
+
+def write_report(rows, out_name):
+    """
+    Writes the output of scan_series() to a csv
+    """
+
+    fields = ['patient', 'path', 'dynamics', 'expected', 'needs_repair', 'error']
+    with open(out_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "r:e:o:a:t:g",
+                                       ['roots=', 'expected=', 'outfile=', 'all=', 'threads=', 'help'])
+
+    roots = DATA_ROOTS
+    expected = EXPECTED_DYNAMICS
+    out_name = None
+    list_all = 0
+    threads = 16
+    for opt, arg in options:
+        if opt in ('-r', '--roots'):
+            roots = arg.split(',')
+        elif opt in ('-e', '--expected'):
+            expected = int(arg)
+        elif opt in ('-o', '--outfile'):
+            out_name = arg
+        elif opt in ('-a', '--all'):
+            list_all = int(arg)
+        elif opt in ('-t', '--threads'):
+            threads = int(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    paths = find_bold_series(roots)
+    rows = scan_series(paths, expected=expected, threads=threads)
+    broken = [r for r in rows if r['needs_repair']]
+    unreadable = [r for r in rows if r['error']]
+
+    print(f'Checked {len(rows)} BOLD series. {len(broken)} need repair. {len(unreadable)} could not be read.')
+    for r in broken:
+        print(f'\t{r["patient"]}: {r["dynamics"]}/{expected} dynamics\n\t\t{r["path"]}')
+    for r in unreadable:
+        print(f'\tUNREADABLE: {r["path"]} ({r["error"]})')
+
+    if out_name:
+        write_report(rows if list_all else broken + unreadable, out_name)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pluggable backends for running the MATLAB processing functions.
+
+Every backend has the same interface: backend.call(function, args, cwd, log_file)
+runs a MATLAB function (e.g., Master) with the given arguments in the given
+working directory. The available backends are
+    shell  : starts a fresh MATLAB for every call (the original behavior)
+    engine : keeps a pool of long-lived MATLAB sessions through the MATLAB
+             Engine API for Python (the matlab.engine package, which must be
+             installed from the MATLAB installation) and submits calls to them,
+             so MATLAB's startup cost is only paid once per session
+    fake   : doesn't run MATLAB at all. Records the calls it gets, optionally
+             runs a Python stand-in for each function, and otherwise just waits.
+             For testing and for trying out batch runs without MATLAB
+
+get_backend() returns one shared instance per backend name, so a process that
+handles many patients (or several steps at once) keeps reusing the same warm
+sessions. The default backend name and session count come from the
+SCAN_REPORTING_BACKEND and SCAN_REPORTING_BACKEND_SESSIONS environment variables.
+
+"""
+
+import os
+import io
+import time
+import queue
+import atexit
+import threading
+
+import telemetry
+from external import matlab_command, run_logged
+
+DEFAULT_BACKEND = os.environ.get('SCAN_REPORTING_BACKEND', 'shell')
+DEFAULT_SESSIONS = int(os.environ.get('SCAN_REPORTING_BACKEND_SESSIONS', 2))
+
+
+def matlab_literal(value):
+    """
+    Converts a Python value to MATLAB source, e.g., 'abc' -> 'abc' (quoted), True -> 1
+    """
+
+    if isinstance(value, str):
+        escaped = value.replace("'", "''")
+        return f"'{escaped}'"
+    elif isinstance(value, bool):
+        return str(int(value))
+    return repr(value)
+
+
+def matlab_call_string(function, args):
+    """
+    Builds a MATLAB statement calling function with args, e.g., Master('PTSTEN_001_01','Baseline',360,1)
+    """
+
+    return f"{function}({','.join([matlab_literal(a) for a in args])})"
+
+
+class ComputeBackend:
+    """
+    Base class for backends. Subclasses implement _call()
+    """
+
+    name = None
+
+    def call(self, function, args, cwd, log_file=None):
+        """
+        Runs a MATLAB function
+
+
+        Parameters
+        ----------
+        function : str
+            name of the MATLAB function.
+        args : list
+            its arguments (str, int, float or bool).
+        cwd : str
+            the working directory to run it in (where the MATLAB scripts are).
+        log_file : str, optional
+            if given, output is appended here instead of going to the terminal. The default is None.
+
+        Returns
+        -------
+        None. Raises an exception if the call fails.
+
+        """
+
+        with telemetry.span('matlab', function, backend=self.name):
+            self._call(function, args, cwd, log_file)
+
+    def _call(self, function, args, cwd, log_file):
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases any sessions the backend holds
+        """
+
+        pass
+
+
+class ShellBackend(ComputeBackend):
+    """
+    Starts a new MATLAB process for every call
+    """
+
+    name = 'shell'
+
+    def _call(self, function, args, cwd, log_file):
+        command = matlab_command(matlab_call_string(function, args))
+        print(f'Call to MATLAB: {command}')
+        run_logged(command, cwd=cwd, log_file=log_file)
+
+
+class MatlabEngineBackend(ComputeBackend):
+    """
+    Submits calls to a pool of long-lived MATLAB sessions. Sessions are started
+    the first time they are needed, and each session runs one call at a time
+
+
+    Parameters
+    ----------
+    sessions : int, optional
+        the maximum number of MATLAB sessions. The default is DEFAULT_SESSIONS.
+
+    """
+
+    name = 'engine'
+
+    def __init__(self, sessions=DEFAULT_SESSIONS):
+        try:
+            import matlab.engine
+        except ImportError:
+            raise ImportError('The engine backend needs the MATLAB Engine API for Python (matlab.engine). '
+                              'Install it from your MATLAB installation or use the shell backend')
+        self._engine_module = matlab.engine
+        self.max_sessions = max(1, sessions)
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _acquire(self):
+        while True:
+            try:
+                eng = self._idle.get_nowait()
+            except queue.Empty:
+                eng = self._start()
+                if eng is None:
+                    eng = self._idle.get() # wait for a busy session to free up
+            if eng is not None: # None stands in for a dropped session, see _drop()
+                return eng
+
+    def _start(self):
+        with self._lock:
+            if self._started >= self.max_sessions:
+                return None
+            self._started += 1
+            print(f'Starting MATLAB session {self._started} of up to {self.max_sessions}')
+            try:
+                eng = self._engine_module.start_matlab('-nodesktop -nosplash')
+            except BaseException:
+                self._started -= 1
+                raise
+            self._all.append(eng)
+            return eng
+
+    def _drop(self, eng):
+        # forgets a session that has died, so a new one can be started in its place
+        with self._lock:
+            if eng in self._all:
+                self._all.remove(eng)
+            self._started -= 1
+        self._idle.put(None) # wakes a call waiting for a session, which then starts the new one
+        try:
+            eng.quit()
+        except Exception:
+            pass
+
+    def _call(self, function, args, cwd, log_file):
+        # the engine passes Python ints as int64, but the scripts were written for doubles from the command line
+        margs = [float(a) if isinstance(a, int) and not isinstance(a, bool) else a for a in args]
+        eng = self._acquire()
+        out = io.StringIO()
+        try:
+            print(f'Submitting to MATLAB session: {matlab_call_string(function, args)}')
+            eng.cd(cwd, nargout=0)
+            getattr(eng, function)(*margs, nargout=0, stdout=out, stderr=out)
+        finally:
+            if log_file is not None:
+                with open(log_file, 'a') as log:
+                    log.write(f'\n>> cd {cwd}\n>> {matlab_call_string(function, args)}\n')
+                    log.write(out.getvalue())
+            else:
+                print(out.getvalue())
+            try:
+                eng.clear('all', nargout=0) # don't leak workspace state between patients
+            except Exception as e:
+                # the session died (e.g., MATLAB crashed). Raising here would hide the error of the call itself
+                print(f'\n!!!!!\nWARNING: MATLAB session lost ({type(e).__name__}: {e}). It will be replaced\n!!!!!\n')
+                self._drop(eng)
+            else:
+                self._idle.put(eng)
+
+    def close(self):
+        for eng in self._all:
+            try:
+                eng.quit()
+            except Exception:
+                pass
+        self._all = []
+
+
+class FakeBackend(ComputeBackend):
+    """
+    Pretends to run MATLAB
+
+
+    Parameters
+    ----------
+    handlers : dict, optional
+        {MATLAB function name: Python function(args, cwd)} called in place of
+        the MATLAB function. The default is None.
+    delay : float, optional
+        seconds to wait for functions without a handler. The default is 0.
+
+    """
+
+    name = 'fake'
+
+    def __init__(self, handlers=None, delay=0):
+        self.handlers = handlers or {}
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _call(self, function, args, cwd, log_file):
+        with self._lock:
+            self.calls.append({'function':function, 'args':list(args), 'cwd':cwd,
+                               'thread':threading.current_thread().name, 'time':time.time()})
+        message = f'[fake MATLAB] {matlab_call_string(function, args)} in {cwd}'
+        if log_file is not None:
+            with open(log_file, 'a') as log:
+                log.write(message + '\n')
+        else:
+            print(message)
+
+        if function in self.handlers:
+            self.handlers[function](args, cwd)
+        elif self.delay:
+            time.sleep(self.delay)
+
+
+backend_classes = {'shell':ShellBackend, 'engine':MatlabEngineBackend, 'fake':FakeBackend}
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_backend(name=None, sessions=None):
+    """
+    Gets the shared instance of a backend, creating it if needed
+
+
+    Parameters
+    ----------
+    name : str, optional
+        'shell', 'engine' or 'fake'. The default is DEFAULT_BACKEND.
+    sessions : int, optional
+        the maximum number of sessions (engine backend only). The default is DEFAULT_SESSIONS.
+
+    Returns
+    -------
+    ComputeBackend.
+
+    """
+
+    if name is None:
+        name = DEFAULT_BACKEND
+    if name not in backend_classes:
+        raise ValueError(f'Backend must be one of {list(backend_classes)}, not {name}')
+
+    with _shared_lock:
+        if name not in _shared:
+            if name == 'engine':
+                _shared[name] = MatlabEngineBackend(sessions if sessions is not None else DEFAULT_SESSIONS)
+            elif name == 'fake':
+                _shared[name] = FakeBackend(delay=float(os.environ.get('STUB_MATLAB_SECONDS', 0)))
+            else:
+                _shared[name] = backend_classes[name]()
+        return _shared[name]
+
+
+def set_backend(backend):
+    """
+    Makes a backend instance (e.g., a FakeBackend with handlers) the shared instance for its name
+    """
+
+    with _shared_lock:
+        _shared[backend.name] = backend
+
+
+@atexit.register
+def close_all():
+    """
+    Closes every shared backend
+    """
+
+    with _shared_lock:
+        for backend in _shared.values():
+            backend.close()
+        _shared.clear()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Answers the questions the pipelines ask while they run, so a cohort can be
+processed without anyone at the keyboard.
+
+Every question has a key. Answers are looked up, in order, in
+    the patient's parameter file (params.yaml, params.yml or params.json in the
+        patient folder, or the file passed with --params)
+    the cohort defaults file (passed with --defaults, or set with SCAN_REPORTING_DEFAULTS)
+    the built-in --auto answer, if the pipeline was run with --auto and the question has one
+and only then is the user asked. Answers can be piped into stdin as before.
+When running unattended (--unattended), or when stdin is closed or runs out
+of answers, a question that can't be answered this way raises
+UnansweredDecision instead of waiting forever. If an answer from a
+file is rejected by the pipeline and the same question is asked again, that
+also raises UnansweredDecision rather than looping.
+
+Parameter files are flat mappings of key: answer. A file can also have
+"bold" and/or "scd" sections whose answers apply only to that pipeline and
+take precedence over the top level. For example, a params.yaml
+
+    nifti_beta: acknowledge
+    deidentify_missing: 'y'
+    bold:
+      asl_type: pCASL
+      thresh_search: 'n'
+      scan_date: 2019.07.12
+    scd:
+      redcap_push: 'n'
+
+Quote values like 'y', 'n' and '02' so YAML keeps them as text (true/false
+are also accepted and mean y/n). YAML files need PyYAML, JSON files don't.
+
+The keys are
+    both pipelines
+        nifti_beta : acknowledge / cancel. Processing NiFTIs is in beta
+        deidentify_missing : y / n / change. The name to deidentify isn't in any filename
+        deidentify_new_name : the name to use instead if deidentify_missing is change
+    process_bold.py
+        asl_type : PASL / pCASL
+        thresh_search : y / n. No thresh_vals.csv, search other scans of the patient for one?
+        thresh_scan : 0X / cancel. The scan number to take thresh_vals.csv from
+        thresh_index : number / cancel. Which of the found thresh_vals.csv files to use
+        scan_date : YYYY.mm.dd / skip. No scan date in the headers
+    process_scd.py
+        redcap_missing : y / n. The patient isn't in REDCap, continue anyway?
+        redcap_scan_confirm : y / n. Confirm which REDCap MR column the scan is
+        asl_missing : y / n. No PLD/LD in the filenames, continue anyway?
+        asl_params : y / n / show. Accept the found PLD, LD and TR?
+        asl_pld, asl_ld, asl_tr : the values to use if asl_params is n
+        trust_rename : fix / exit / info. The TRUST source file needs renaming
+        redcap_push : y / n / wipe
+
+"""
+
+import os
+import sys
+import json
+
+PARAM_FILENAMES = ('params.yaml', 'params.yml', 'params.json')
+DEFAULTS_FILE = os.environ.get('SCAN_REPORTING_DEFAULTS')
+
+
+class UnansweredDecision(Exception):
+    """
+    Raised when a question can't be answered without asking, but nobody can be asked
+    """
+    pass
+
+
+def read_param_file(path, pipeline=None):
+    """
+    Reads a YAML or JSON parameter file
+
+
+    Parameters
+    ----------
+    path : str
+        path to the file. Read as JSON if it ends in .json, otherwise as YAML.
+    pipeline : str, optional
+        'bold' or 'scd'. If given, the answers in that section of the file are
+        merged over the top-level answers. The default is None.
+
+    Returns
+    -------
+    dict of {key: answer}.
+
+    """
+
+    with open(path) as f:
+        if path.endswith('.json'):
+            data = json.load(f)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError(f'PyYAML is needed to read {path}. Install it or use a .json parameter file')
+            data = yaml.safe_load(f)
+
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise ValueError(f'{path} must contain a mapping of question keys to answers')
+
+    sections = {'bold', 'scd'}
+    answers = {key:val for key, val in data.items() if key not in sections}
+    if pipeline is not None:
+        answers.update(data.get(pipeline) or {})
+    return answers
+
+
+def find_param_file(pt_folder):
+    """
+    Gets the path to the parameter file in a patient folder, or None if there isn't one
+    """
+
+    for name in PARAM_FILENAMES:
+        path = os.path.join(pt_folder, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _as_answer(value):
+    if isinstance(value, bool):
+        return 'y' if value else 'n'
+    return str(value)
+
+
+class DecisionProvider:
+    """
+    Answers questions from parameter files, --auto answers or the user
+
+
+    Parameters
+    ----------
+    layers : list of (str, dict), optional
+        (description, {key: answer}) in order of precedence. The default is None.
+    auto : bool, optional
+        if True, questions that have an auto answer use it. The default is False.
+    interactive : bool, optional
+        if False, questions that can't otherwise be answered raise
+        UnansweredDecision instead of prompting. The default is True.
+
+    """
+
+    def __init__(self, layers=None, auto=False, interactive=True):
+        self.layers = layers or []
+        self.auto = auto
+        self.interactive = interactive
+        self.answered = {} # key: how it was answered (a file, 'auto' or 'prompt')
+        self.values = {} # key: the answer
+
+    @classmethod
+    def for_patient(cls, pt_folder, pipeline, params_file=None, defaults_file=None, auto=False, unattended=False):
+        """
+        Builds the provider for a patient
+
+
+        Parameters
+        ----------
+        pt_folder : str
+            the patient folder, searched for a parameter file if params_file isn't given.
+        pipeline : str
+            'bold' or 'scd'.
+        params_file : str, optional
+            the patient's parameter file. The default is None.
+        defaults_file : str, optional
+            the cohort defaults file. The default is DEFAULTS_FILE.
+        auto : bool, optional
+            whether --auto answers are used. The default is False.
+        unattended : bool, optional
+            if True, never prompt. The default is False.
+
+        Returns
+        -------
+        DecisionProvider.
+
+        """
+
+        if params_file is None:
+            params_file = find_param_file(pt_folder)
+        if defaults_file is None:
+            defaults_file = DEFAULTS_FILE
+
+        layers = []
+        for path in (params_file, defaults_file):
+            if path is not None:
+                layers.append((path, read_param_file(path, pipeline)))
+                print(f'Reading answers to processing questions from {path}')
+
+        interactive = not unattended and sys.stdin is not None # piped answers are read like typed ones
+        return cls(layers, auto=auto, interactive=interactive)
+
+    def ask(self, key, prompt, auto_answer=None):
+        """
+        Gets the answer to a question
+
+
+        Parameters
+        ----------
+        key : str
+            the question's key, as used in parameter files.
+        prompt : str
+            the question as shown to the user.
+        auto_answer : str, optional
+            the answer to use with --auto. The default is None (the question always needs an answer).
+
+        Returns
+        -------
+        str of the answer.
+
+        """
+
+        for where, answers in self.layers:
+            if key in answers:
+                if key in self.answered:
+                    raise UnansweredDecision(f'The answer for "{key}" in {where} ({answers[key]}) was not accepted.\nThe question was: {prompt}')
+                ans = _as_answer(answers[key])
+                self.answered[key] = where
+                self.values[key] = ans
+                print(prompt)
+                print(f'Answer from {os.path.basename(where)}: {ans}')
+                return ans
+
+        if self.auto and auto_answer is not None:
+            self.answered[key] = 'auto'
+            self.values[key] = auto_answer
+            print(prompt)
+            print(f'Auto response: {auto_answer}')
+            return auto_answer
+
+        if not self.interactive:
+            raise UnansweredDecision(f'Running unattended, but there is no answer for "{key}".\nThe question was: {prompt}\n'
+                                     f'Add an answer for {key} to the patient parameter file or the cohort defaults file')
+
+        try:
+            ans = input(prompt)
+        except EOFError:
+            raise UnansweredDecision(f'stdin ran out of answers before "{key}".\nThe question was: {prompt}\n'
+                                     f'Add an answer for {key} to the patient parameter file or the cohort defaults file')
+        self.answered[key] = 'prompt'
+        self.values[key] = ans
+        return ans
+
+    def peek(self, key, auto_answer=None):
+        """
+        The answer ask() would give without prompting, or None if it would prompt
+        """
+
+        for where, answers in self.layers:
+            if key in answers:
+                return _as_answer(answers[key])
+        if self.auto and auto_answer is not None:
+            return auto_answer
+        return None
+
+    def has_answer(self, key, auto_answer=None):
+        """
+        Whether ask() would answer a question without prompting
+        """
+
+        return self.peek(key, auto_answer) is not None
+
+    def answered_by(self, key):
+        """
+        How a question was last answered: the file it came from, 'auto', 'prompt' or None if it hasn't been asked
+        """
+
+        return self.answered.get(key)
+
+    def answer_of(self, key):
+        """
+        The last answer to a question, or None if it hasn't been asked
+        """
+
+        return self.values.get(key)
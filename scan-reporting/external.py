@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for calling the external programs (MATLAB and shell scripts) that
+the pipelines depend on.
+
+Commands are run with an explicit working directory instead of changing the
+process-wide working directory with os.chdir, so independent steps can run
+at the same time. The location of every external program, and of the bin
+folder with the report templates and images, can be overridden with an
+environment variable (e.g., to point them at the stubs in the stubs folder
+for local testing; see stub_environment()):
+    SCAN_REPORTING_MATLAB : the MATLAB executable
+    SCAN_REPORTING_BOLD_SCRIPTS / SCAN_REPORTING_SCD_SCRIPTS : the MATLAB processing scripts
+    SCAN_REPORTING_BOLD_DEIDENTIFY / SCAN_REPORTING_SCD_DEIDENTIFY : the deidentify scripts
+    SCAN_REPORTING_DCM2NII : dcm2nii
+    SCAN_REPORTING_PERL / SCAN_REPORTING_DICOM_CONVERTER : perl and the DICOM to PARREC converter script
+    SCAN_REPORTING_BIN : the bin folder. default: the bin folder of this repository
+
+"""
+
+import os
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+MATLAB_BIN = os.environ.get('SCAN_REPORTING_MATLAB', '/Applications/MATLAB_R2016b.app/bin/matlab')
+BOLD_SCRIPTS = os.environ.get('SCAN_REPORTING_BOLD_SCRIPTS', '/Users/manusdonahue/Desktop/Projects/BOLD/Scripts/')
+SCD_SCRIPTS = os.environ.get('SCAN_REPORTING_SCD_SCRIPTS', '/Users/manusdonahue/Desktop/Projects/SCD/Processing/Pipeline/')
+BOLD_DEIDENTIFY = os.environ.get('SCAN_REPORTING_BOLD_DEIDENTIFY', '/Users/manusdonahue/Desktop/Projects/BOLD/Scripts/deidentifySLW')
+SCD_DEIDENTIFY = os.environ.get('SCAN_REPORTING_SCD_DEIDENTIFY', '/Users/manusdonahue/Desktop/Projects/SCD/Processing/deidentifySLW/')
+DCM2NII = os.environ.get('SCAN_REPORTING_DCM2NII', '/Users/manusdonahue/Documents/Sky/mricron/dcm2nii')
+PERL_BIN = os.environ.get('SCAN_REPORTING_PERL', 'perl')
+DICOM_CONVERTER = os.environ.get('SCAN_REPORTING_DICOM_CONVERTER', '/Users/manusdonahue/Desktop/Projects/gstudy_converter/convert_dicom_to_xmlrec.pl')
+REPO_BIN_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin') # the templates, logos and dots in the repository
+BIN_FOLDER = os.environ.get('SCAN_REPORTING_BIN', REPO_BIN_FOLDER)
+
+STUBS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+
+def stub_environment(bin_folder=REPO_BIN_FOLDER, stubs_folder=STUBS_FOLDER):
+    """
+    Gets the environment variables that point every external program at the stubs
+
+
+    Parameters
+    ----------
+    bin_folder : str, optional
+        the bin folder to use. The default is REPO_BIN_FOLDER.
+    stubs_folder : str, optional
+        the folder of stubs. The default is STUBS_FOLDER.
+
+    Returns
+    -------
+    dict of {variable: value}, to be added to os.environ of the pipeline processes.
+
+    """
+
+    return {'SCAN_REPORTING_MATLAB':os.path.join(stubs_folder, 'matlab'),
+            'SCAN_REPORTING_BOLD_SCRIPTS':os.path.join(stubs_folder, 'bold_scripts'),
+            'SCAN_REPORTING_SCD_SCRIPTS':stubs_folder,
+            'SCAN_REPORTING_BOLD_DEIDENTIFY':os.path.join(stubs_folder, 'deidentify'),
+            'SCAN_REPORTING_SCD_DEIDENTIFY':os.path.join(stubs_folder, 'deidentify'),
+            'SCAN_REPORTING_DCM2NII':os.path.join(stubs_folder, 'dcm2nii'),
+            'SCAN_REPORTING_PERL':os.path.join(stubs_folder, 'perl'),
+            'SCAN_REPORTING_DICOM_CONVERTER':os.path.join(stubs_folder, 'convert_dicom_to_xmlrec.pl'),
+            'SCAN_REPORTING_BIN':bin_folder}
+
+
+def matlab_command(call, matlab_bin=None):
+    """
+    Builds the shell command that runs a MATLAB function call without the desktop
+
+
+    Parameters
+    ----------
+    call : str
+        the MATLAB statement to run, e.g., "Master('PTSTEN_001_01','Baseline',360,1)".
+    matlab_bin : str, optional
+        path to the MATLAB executable. The default is MATLAB_BIN.
+
+    Returns
+    -------
+    str.
+
+    """
+
+    if matlab_bin is None:
+        matlab_bin = MATLAB_BIN
+    return f'''{matlab_bin} -nodesktop -nosplash -r "{call}"'''
+
+
+def run_logged(command, cwd, log_file=None):
+    """
+    Runs a shell command in a given working directory
+
+
+    Parameters
+    ----------
+    command : str
+        the shell command.
+    cwd : str or None
+        the working directory to run it in. None runs it in the current working directory.
+    log_file : str, optional
+        if given, stdout and stderr are appended to this file instead of
+        going to the terminal. The default is None.
+
+    Returns
+    -------
+    None. Raises subprocess.CalledProcessError if the command fails.
+
+    """
+
+    program = os.path.basename(command.split()[0])
+    with telemetry.span('subprocess', program, command=command):
+        if log_file is None:
+            _run_measured(command, cwd)
+            return
+
+        with open(log_file, 'a') as log:
+            log.write(f'\n$ cd {cwd}\n$ {command}\n')
+            log.flush()
+            _run_measured(command, cwd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def _run_measured(command, cwd, **kwargs):
+    # like subprocess.run(check=True), but reaps the process with wait4 to get its own resource use
+    proc = subprocess.Popen(command, shell=True, cwd=cwd, **kwargs)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    telemetry.annotate(**telemetry.rusage_fields(usage))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def run_parallel(tasks):
+    """
+    Runs independent tasks at the same time, each in its own thread. The
+    tasks are expected to spend their time waiting on external processes
+
+
+    Parameters
+    ----------
+    tasks : dict
+        {name: function that takes no arguments}.
+
+    Returns
+    -------
+    dict of {name: wall time in seconds}. If any task fails, the others are
+        still allowed to finish and then the first failure is raised.
+
+    """
+
+    def timed(func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max(1, len(tasks))) as pool:
+        futures = {name:pool.submit(timed, func) for name, func in tasks.items()}
+
+    elapsed = {}
+    failure = None
+    for name, fut in futures.items():
+        try:
+            elapsed[name] = fut.result()
+        except Exception as e:
+            print(f'\n!!!!!\n{name} failed: {e}\n!!!!!\n')
+            if failure is None:
+                failure = e
+    if failure is not None:
+        raise failure
+
+    return elapsed
@@ -1,100 +1,312 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""
-
+help_info = """
 This script is intended to read in a BOLD NiFTI that has been prematurely cancelled
 (due to patient discomfort, technical issues, etc.) and then "reconstruct" the
 missing images so the file can be processed as normal
 
+The series is streamed a few volumes at a time into a memory-mapped output,
+so memory use does not depend on the length of the series.
+
+input:
+    -i / --infile : the truncated BOLD NiFTI
+    -r / --ref : a complete BOLD NiFTI from the same protocol. Only its header
+        (the number of dynamics) is used unless a figure is requested
+    -o / --outfile : the name of the repaired NiFTI to write (.nii or .nii.gz)
+    -p / --pad : how to fill the missing dynamics. 'repeat' (default) repeats the
+        last acquired volume. 'linear' extrapolates each voxel linearly using
+        a least squares fit over the last few acquired volumes
+    -w / --window : the number of acquired volumes used for the linear fit. default: 10
+    -f / --figure : optional. the name of a png to write comparing the mean intensity
+        timecourses of the reference, truncated and repaired series
+    -g / --help : brings up this helpful information. does not take an argument
 """
 
-
-
 import os
+import threading
 import sys
+import getopt
 
-import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 import nibabel as nib
 
-#####
-
-input_filename = '/Users/manusdonahue/Desktop/Projects/BOLD/Data/PTSTEN_187_02/bold_work/bold_work_WIPBOLD_CO2_ACPC2_STROKEWOCONTRAST_19770703150928_2.nii.gz' # this is the messed up one
-ref_filename = '/Users/manusdonahue/Desktop/Projects/BOLD/Data/PTSTEN_187_02/bold_work/ref/ref_WIPBOLD_CO2_ACPC2_STROKEWOCONTRAST_19770703150928_3.nii.gz' # this is a proper sample
-
-write_filename = '/Users/manusdonahue/Desktop/Projects/BOLD/Data/PTSTEN_187_02/bold_work/PTSTEN_187_02_WIPBOLD_CO2_ACPC2_STROKEWOCONTRAST_19770703150928_2_FIXED.nii.gz'
-
-#####
-
-img = nib.load(input_filename)
-head = img.header
-data = img.get_fdata()
-
-ref_img = nib.load(ref_filename)
-ref_head = ref_img.header
-ref_data = ref_img.get_fdata()
-
-
-tees = data.shape[3]
-
-exes = np.arange(0,tees,1)
-slices = [data[:,:,:,i] for i in exes]
-whys = [np.mean(i) for i in slices]
-
-
-
-ref_tees = ref_data.shape[3]
-
-ref_exes = np.arange(0,ref_tees,1)
-ref_slices = [ref_data[:,:,:,i] for i in ref_exes]
-ref_whys = [np.mean(i) for i in ref_slices]
-
-plt.figure()
-plt.plot(ref_exes,ref_whys,label='Reference',alpha=0.5)
-plt.plot(exes,whys,label='Target',alpha=1)
+from nii_io import load_nii, gzip_file_parallel
 
-slices_not_in = [i for i in range(ref_tees) if i not in range(tees)]
+CHUNK_VOLUMES = 8 # volumes read or written at once
 
-new_data = np.empty(ref_data.shape)
 
-for i in slices_not_in:
-    new_data[:,:,:,i] = data[:,:,:,tees-1]
-    
-for i in range(tees):
-    new_data[:,:,:,i] = data[:,:,:,i]
-    
+def timecourse_means(img, chunk=CHUNK_VOLUMES):
+    """
+    Gets the mean intensity of every volume in a 4D image, streaming a few
+    volumes at a time through the image's array proxy
 
 
-add_slices = [new_data[:,:,:,i] for i in ref_exes]
-add_whys = [np.mean(i) for i in add_slices]
-plt.plot(ref_exes,add_whys,label='Added',alpha=0.5)
-    
-plt.title('Rectification')
-plt.legend()
+    Parameters
+    ----------
+    img : nibabel image
+        a 4D image.
+    chunk : int, optional
+        the number of volumes read at once. The default is CHUNK_VOLUMES.
 
-head['dim'] = ref_head['dim']
+    Returns
+    -------
+    numpy array of the volume means.
 
-out_image = nib.Nifti1Image(new_data,img.affine,head)
-nib.save(out_image, write_filename)
+    """
+
+    tees = img.shape[3]
+    means = np.empty(tees)
+    for a in range(0, tees, chunk):
+        b = min(a + chunk, tees)
+        block = np.asarray(img.dataobj[..., a:b], dtype=np.float64)
+        means[a:b] = block.mean(axis=(0, 1, 2))
+    return means
 
 
-# check to make sure it worked
+def linear_fit(img, window=10):
+    """
+    Least squares fits a line through the last few volumes of a 4D image, voxelwise
+
 
-w_img = nib.load(write_filename)
-w_head = w_img.header
-w_data = w_img.get_fdata()
-w_tees = w_data.shape[3]
-w_exes = np.arange(0,w_tees,1)
-w_slices = [w_data[:,:,:,i] for i in w_exes]
-w_whys = [np.mean(i) for i in w_slices]
+    Parameters
+    ----------
+    img : nibabel image
+        a 4D image.
+    window : int, optional
+        the number of trailing volumes to fit. The default is 10.
 
-plt.figure()
-plt.title('Checking')
+    Returns
+    -------
+    tuple of (mean_volume, slope_volume, mean_time) such that the fitted value
+        at volume index t is mean_volume + slope_volume * (t - mean_time).
 
-plt.plot(ref_exes,ref_whys,label='Reference',alpha=0.5)
-plt.plot(w_exes,w_whys,label='Rectified',alpha=1)
+    """
 
-plt.legend()
+    tees = img.shape[3]
+    window = max(2, min(window, tees))
+    if tees < 2:
+        raise ValueError('At least two acquired volumes are needed for linear padding')
 
+    block = np.asarray(img.dataobj[..., tees-window:tees], dtype=np.float64)
+    t = np.arange(tees-window, tees, dtype=np.float64)
+    t_mean = t.mean()
+    t_dev = t - t_mean
 
+    y_mean = block.mean(axis=3)
+    slope = np.tensordot(block, t_dev, axes=([3], [0])) / np.sum(t_dev**2)
+
+    return y_mean, slope, t_mean
+
+
+def padding_volumes(strategy, img, start, stop, fit=None):
+    """
+    Makes the volumes that replace missing dynamics start to stop-1
+
+
+    Parameters
+    ----------
+    strategy : str
+        'repeat' or 'linear'.
+    img : nibabel image
+        the truncated 4D image.
+    start : int
+        index of the first volume to make.
+    stop : int
+        index after the last volume to make.
+    fit : tuple, optional
+        output of linear_fit(). Required if strategy is 'linear'.
+
+    Returns
+    -------
+    4D numpy array of (scaled) intensities with stop-start volumes.
+
+    """
+
+    n = stop - start
+    if strategy == 'repeat':
+        last = np.asarray(img.dataobj[..., img.shape[3]-1], dtype=np.float64)
+        return np.repeat(last[..., np.newaxis], n, axis=3)
+    elif strategy == 'linear':
+        y_mean, slope, t_mean = fit
+        t = np.arange(start, stop, dtype=np.float64) - t_mean
+        return y_mean[..., np.newaxis] + slope[..., np.newaxis] * t
+    else:
+        raise ValueError(f'Padding strategy must be "repeat" or "linear", not {strategy}')
+
+
+def _to_stored(vals, dtype, slope, inter):
+    # undo the header scaling so the output can reuse the input's header and dtype
+    raw = (vals - inter) / slope
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        raw = np.clip(np.round(raw), info.min, info.max)
+    return raw.astype(dtype)
+
+
+def fix_bold_file(input_filename, ref_filename, write_filename, strategy='repeat', window=10, chunk=CHUNK_VOLUMES):
+    """
+    Pads a truncated BOLD series out to the number of dynamics in a reference series
+
+
+    Parameters
+    ----------
+    input_filename : str
+        the truncated BOLD NiFTI.
+    ref_filename : str
+        a complete BOLD NiFTI from the same protocol.
+    write_filename : str
+        the repaired NiFTI to write (.nii or .nii.gz).
+    strategy : str, optional
+        'repeat' or 'linear'. The default is 'repeat'.
+    window : int, optional
+        number of trailing volumes used for the linear fit. The default is 10.
+    chunk : int, optional
+        the number of volumes read or written at once. The default is CHUNK_VOLUMES.
+
+    Returns
+    -------
+    dict with the per-volume means of the truncated series ('target') and of the
+        repaired series as written ('fixed').
+
+    """
+
+    if strategy not in ('repeat', 'linear'):
+        raise ValueError(f'Padding strategy must be "repeat" or "linear", not {strategy}')
+
+    img = load_nii(input_filename, use_cache=True)
+    ref_head = nib.load(ref_filename).header # header only. no voxel data is read
+
+    tees = img.shape[3]
+    ref_shape = ref_head.get_data_shape()
+    ref_tees = ref_shape[3]
+
+    if tuple(ref_shape[:3]) != tuple(img.shape[:3]):
+        raise ValueError(f'Spatial dimensions do not match: {img.shape[:3]} (target) vs {ref_shape[:3]} (reference)')
+    if ref_tees <= tees:
+        raise ValueError(f'The target already has {tees} dynamics, and the reference only has {ref_tees}. Nothing to fix')
+
+    head = img.header.copy()
+    head['dim'] = ref_head['dim']
+    out_shape = tuple(img.shape[:3]) + (ref_tees,)
+    dtype = head.get_data_dtype()
+    slope, inter = [float(i) for i in (img.dataobj.slope, img.dataobj.inter)]
+    head.set_slope_inter(slope, inter) # nibabel blanks the scaling in a loaded image's header
+
+    if write_filename.endswith('.gz'):
+        raw_name = f'{write_filename[:-3]}.{os.getpid()}.{threading.get_ident()}.tmp.nii'
+    else:
+        raw_name = write_filename
+
+    # write the header, then memory-map the (sparse) data block behind it
+    offset = max(int(head.get_data_offset()), head.single_vox_offset)
+    head.set_data_offset(offset)
+    with open(raw_name, 'wb') as f:
+        head.write_to(f)
+        f.seek(offset)
+        f.truncate(offset + int(np.prod(out_shape)) * dtype.itemsize)
+
+    fit = linear_fit(img, window) if strategy == 'linear' else None
+    target_means = np.empty(tees)
+    fixed_means = np.empty(ref_tees)
+
+    try:
+        out = np.memmap(raw_name, dtype=dtype, mode='r+', offset=offset, shape=out_shape, order='F')
+
+        for a in range(0, ref_tees, chunk):
+            b = min(a + chunk, ref_tees)
+            if b <= tees:
+                vals = np.asarray(img.dataobj[..., a:b], dtype=np.float64)
+                target_means[a:b] = vals.mean(axis=(0, 1, 2))
+            elif a >= tees:
+                vals = padding_volumes(strategy, img, a, b, fit)
+            else: # chunk straddles the end of the acquired data
+                acquired = np.asarray(img.dataobj[..., a:tees], dtype=np.float64)
+                target_means[a:tees] = acquired.mean(axis=(0, 1, 2))
+                vals = np.concatenate([acquired, padding_volumes(strategy, img, tees, b, fit)], axis=3)
+
+            stored = _to_stored(vals, dtype, slope, inter)
+            out[..., a:b] = stored
+            fixed_means[a:b] = (stored.astype(np.float64) * slope + inter).mean(axis=(0, 1, 2))
+
+        out.flush()
+        del out
+
+        if raw_name != write_filename:
+            gzip_file_parallel(raw_name, write_filename)
+    finally:
+        if raw_name != write_filename and os.path.exists(raw_name):
+            os.remove(raw_name)
+
+    return {'target':target_means, 'fixed':fixed_means}
+
+
+def plot_rectification(ref_filename, means, out_name):
+    """
+    Plots the mean intensity timecourses of the reference, truncated and repaired series
+
+
+    Parameters
+    ----------
+    ref_filename : str
+        the reference BOLD NiFTI.
+    means : dict
+        output of fix_bold_file().
+    out_name : str
+        name of the png to write.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    import matplotlib.pyplot as plt
+
+    ref_means = timecourse_means(load_nii(ref_filename, use_cache=True))
+
+    plt.figure()
+    plt.plot(np.arange(len(ref_means)), ref_means, label='Reference', alpha=0.5)
+    plt.plot(np.arange(len(means['fixed'])), means['fixed'], label='Rectified', alpha=0.5)
+    plt.plot(np.arange(len(means['target'])), means['target'], label='Target', alpha=1)
+    plt.title('Rectification')
+    plt.xlabel('Dynamic')
+    plt.ylabel('Mean intensity')
+    plt.legend()
+    plt.savefig(out_name)
+    plt.close()
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "i:r:o:p:w:f:g",
+                                       ['infile=', 'ref=', 'outfile=', 'pad=', 'window=', 'figure=', 'help'])
+
+    strategy = 'repeat'
+    window = 10
+    figure = None
+    input_filename = ref_filename = write_filename = None
+    for opt, arg in options:
+        if opt in ('-i', '--infile'):
+            input_filename = arg
+        elif opt in ('-r', '--ref'):
+            ref_filename = arg
+        elif opt in ('-o', '--outfile'):
+            write_filename = arg
+        elif opt in ('-p', '--pad'):
+            strategy = arg
+        elif opt in ('-w', '--window'):
+            window = int(arg)
+        elif opt in ('-f', '--figure'):
+            figure = arg
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if None in (input_filename, ref_filename, write_filename):
+        raise Exception('-i, -r and -o must all be specified')
+
+    means = fix_bold_file(input_filename, ref_filename, write_filename, strategy=strategy, window=window)
+    print(f'Wrote {write_filename}: {len(means["target"])} acquired + {len(means["fixed"]) - len(means["target"])} padded dynamics ({strategy})')
+
+    if figure:
+        plot_rectification(ref_filename, means, figure)
@@ -4,21 +4,26 @@
 Created on Thu Jul 30 12:38:31 2020
 
 @author: manusdonahue
+
+The heavy dependencies (python-pptx, PIL, numpy) are imported inside the
+functions that use them, so scripts that only need the light helpers
+(e.g., get_terminal) start quickly.
 """
 
 import os
 import time
-from PIL import Image
 import shutil
 import itertools
 import operator
 import re
 import glob
+import functools
+import contextlib
+import io
+import subprocess
 
-import numpy as np
-from pptx import Presentation
-from pptx.util import Inches
-import pandas as pd
+import telemetry
+from external import PERL_BIN, DICOM_CONVERTER
 
 
 def replace_in_ppt(search_str, repl_str, filename):
@@ -26,6 +31,7 @@ def replace_in_ppt(search_str, repl_str, filename):
     #Useful Links ;)
     #https://stackoverflow.com/questions/37924808/python-pptx-power-point-find-and-replace-text-ctrl-h
     #https://stackoverflow.com/questions/45247042/how-to-keep-original-text-formatting-of-text-with-python-powerpoint
+    from pptx import Presentation
     prs = Presentation(filename)
     for slide in prs.slides:
         for shape in slide.shapes:
@@ -43,6 +49,7 @@ def analyze_ppt(inp, output):
     The output file contains marked up information to make it easier
     for generating future powerpoint templates.
     """
+    from pptx import Presentation
     prs = Presentation(inp)
     # Each powerpoint file has multiple layouts
     # Loop through them all and  see where the various elements are
@@ -79,7 +86,7 @@ def plot_dot(slide, dot_img, x, y, origin, xpi, ypi, size=0.1):
     slide : pptx slide object
         the slide you're plotting in.
     dot_img : str
-        path to image you want to place
+        path to image you want to place (read with read_cached)
     x : float
         the x value to plot.
     y : float
@@ -98,6 +105,7 @@ def plot_dot(slide, dot_img, x, y, origin, xpi, ypi, size=0.1):
     None.
 
     """
+    from pptx.util import Inches
     
     # images are placed using the coords of their upper left corner
     
@@ -117,10 +125,12 @@ def plot_dot(slide, dot_img, x, y, origin, xpi, ypi, size=0.1):
 
     shp = slide.shapes
     #print(f'Plotting {plot_x,plot_y}. Origin: {origin}. xy: {x,y}')
-    picture = shp.add_picture(dot_img, Inches(plot_x), Inches(plot_y), width=Inches(size), height=Inches(size))
+    picture = shp.add_picture(io.BytesIO(read_cached(dot_img)), Inches(plot_x), Inches(plot_y), width=Inches(size), height=Inches(size))
 
 
 def add_ppt_image(slide, img, scale=0.3, insert_type='img', poster=None, at=(0,0)):
+    from PIL import Image
+    from pptx.util import Inches
     ex, why = at
     shp = slide.shapes
     
@@ -135,6 +145,7 @@ def add_ppt_image(slide, img, scale=0.3, insert_type='img', poster=None, at=(0,0
         
 
 def add_ppt_image_ph(slide, placeholder_id, image_url):
+    from PIL import Image
     placeholder = slide.placeholders[placeholder_id]
  
     # Calculate the image size of the image
@@ -212,7 +223,8 @@ def any_in_str(s, l):
     return any([substr in s for substr in l])
 
 
-def dicom_to_parrec(filename, out_folder, path_to_perl_script='/Users/manusdonahue/Desktop/Projects/gstudy_converter/convert_dicom_to_xmlrec.pl'):
+@telemetry.timed('subprocess', 'convert_dicom_to_xmlrec')
+def dicom_to_parrec(filename, out_folder, path_to_perl_script=DICOM_CONVERTER):
     """
     Calls Brian Welch's perl script that converts DICOMs to PARRECs (using default flags).
     
@@ -240,14 +252,11 @@ def dicom_to_parrec(filename, out_folder, path_to_perl_script='/Users/manusdonah
 
     Returns
     -------
-    None.
+    None. Raises subprocess.CalledProcessError if the converter fails.
 
     """
     new_wd = os.path.dirname(os.path.normpath(path_to_perl_script))
     
-    old_wd = os.getcwd()
-    os.chdir(new_wd)
-    
     parent_folder = os.path.dirname(os.path.normpath(filename))
     file_basename = os.path.basename(os.path.normpath(filename))
     tmp_folder = os.path.join(parent_folder, 'tmp')
@@ -262,9 +271,9 @@ def dicom_to_parrec(filename, out_folder, path_to_perl_script='/Users/manusdonah
     
     try:
     
-        call = f'perl {path_to_perl_script} -d {tmp_folder} -f {copyname}'
+        call = f'{PERL_BIN} {path_to_perl_script} -d {tmp_folder} -f {copyname}'
         #print(f'Call: {call}')
-        os.system(call)
+        subprocess.run(call, check=True, shell=True, cwd=new_wd)
         
         conv_files = [f for f in os.listdir(xml_folder) if os.path.isfile(os.path.join(xml_folder, f))]
         assert len(conv_files) == 4
@@ -276,10 +285,62 @@ def dicom_to_parrec(filename, out_folder, path_to_perl_script='/Users/manusdonah
             
     except AssertionError:
         print(f'Expected 4 files in {xml_folder}, but found {len(conv_files)}. Cleaning up....')
+        raise RuntimeError(f'{filename} did not convert to a PARREC')
     
     finally:
         shutil.rmtree(tmp_folder)
-        os.chdir(old_wd)
+    
+    
+def convert_dicom_folder(acq_folder, raw_folder, dcm_exts=('dcm', 'DCM')):
+    """
+    Replaces the DICOMs in acq_folder with PARRECs, keeping the original folder as raw_folder.
+    
+    The PARRECs are made in a staging folder (see staging_folder()) that only
+    replaces acq_folder once every DICOM has converted, so a failed conversion
+    leaves acq_folder as it was. If raw_folder already exists (an earlier run
+    was interrupted), the DICOMs are converted again from raw_folder
+    
+
+    Parameters
+    ----------
+    acq_folder : pathlike
+        the folder of DICOMs, e.g., Acquired.
+    raw_folder : pathlike
+        the folder the original DICOMs are kept in, e.g., rawdata.
+    dcm_exts : tuple of str, optional
+        the extensions of the files to convert. Other files are left in raw_folder only.
+
+    Returns
+    -------
+    None. Raises an exception if any DICOM fails to convert.
+
+    """
+    if not os.path.isdir(raw_folder):
+        staging = staging_folder(raw_folder)
+        shutil.copytree(acq_folder, staging, dirs_exist_ok=True)
+        swap_folder(staging, raw_folder) # so a rawdata folder is always a complete copy
+    
+    raw_files = [os.path.join(raw_folder, f) for f in sorted(os.listdir(raw_folder)) if os.path.isfile(os.path.join(raw_folder, f))]
+    staging = staging_folder(acq_folder)
+    try:
+        for fi in raw_files:
+            if fi.split('.')[-1] in dcm_exts:
+                dicom_to_parrec(fi, staging)
+    except BaseException:
+        shutil.rmtree(staging)
+        raise
+    swap_folder(staging, acq_folder)
+    
+    
+def dicom_conversion_done(acq_folder, raw_folder, dcm_exts=('dcm', 'DCM')):
+    """
+    Checks that acq_folder holds the 4 converted files (PAR, REC, V41 and XML) of
+    every DICOM in raw_folder, i.e., that convert_dicom_folder() finished
+    """
+    def files_with(folder, exts):
+        return [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and f.split('.')[-1] in exts]
+    
+    return len(files_with(acq_folder, ('PAR', 'REC', 'V41', 'XML'))) >= 4 * len(files_with(raw_folder, dcm_exts))
     
     
 def most_common(L):
@@ -324,6 +385,7 @@ def parse_scd_csv(in_csv, scan_index, std=False):
         DESCRIPTION.
 
     """
+    import numpy as np
     
     if std:
         row_add = 3
@@ -371,6 +433,210 @@ def parse_scd_csv(in_csv, scan_index, std=False):
     
     return parsed
     
+def link_or_copy(src, dst):
+    """
+    Makes dst refer to the same data as src without copying it if possible.
+    A hardlink is tried first, then a symlink, and a real copy is only made
+    if neither kind of link can be created (e.g., on some network drives)
+
+
+    Parameters
+    ----------
+    src : pathlike
+        the existing file.
+    dst : pathlike
+        the path that should refer to src. Must not already exist.
+
+    Returns
+    -------
+    str indicating how dst was created ('hardlink', 'symlink' or 'copy').
+
+    """
+
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+    except OSError:
+        pass
+
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+@functools.lru_cache(maxsize=32)
+def _file_bytes(path, mtime):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_cached(path):
+    """
+    The contents of a file that's used for every report (a template, a logo,
+    a dot image). It's only read once per process (and again if it changes),
+    so a process that makes many reports doesn't keep going back to the disk
+    or network share for it
+    """
+
+    return _file_bytes(path, os.path.getmtime(path))
+
+
+def copy_template(template, out_name):
+    """
+    Copies a report template to out_name, using read_cached()
+    """
+
+    with open(out_name, 'wb') as f:
+        f.write(read_cached(template))
+
+
+LOCK_FILE = '.patient.lock'
+
+
+@contextlib.contextmanager
+def patient_lock(folder, wait=True):
+    """
+    Holds the advisory lock of a patient folder, so two runs on the same
+    patient (e.g., a batch and the watch folder) don't write over each other.
+    The lock is released when the block exits, or by the OS if the process dies
+
+
+    Parameters
+    ----------
+    folder : str
+        the patient folder.
+    wait : bool, optional
+        if the patient is locked, wait for it. Otherwise raise an Exception. The default is True.
+
+    Yields
+    ------
+    bool, True if another run held the lock and this one waited for it.
+
+    """
+
+    import fcntl
+
+    f = open(os.path.join(folder, LOCK_FILE), 'a+')
+    waited = False
+    try:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            waited = True
+            f.seek(0)
+            holder = f.read().strip()
+            if not wait:
+                raise Exception(f'{folder} is being processed by {holder}')
+            print(f'{folder} is being processed by {holder}. Waiting for it to finish')
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        f.truncate()
+        f.write(f'{os.uname().nodename}:{os.getpid()} since {time.strftime("%Y-%m-%d %H:%M:%S")}\n')
+        f.flush()
+        yield waited
+    finally:
+        f.close()
+
+
+def temp_name(path):
+    """
+    A hidden temporary name next to path that keeps its extension (so e.g.
+    savefig still knows the format). See publish()
+    """
+
+    folder, base = os.path.split(path)
+    stem, ext = os.path.splitext(base)
+    return os.path.join(folder, f'.{stem}.{os.getpid()}.tmp{ext}')
+
+
+def publish(tmp, path):
+    """
+    Moves a finished temporary file into place. The rename is atomic, so
+    readers of path see the old file or the new one, never a partial one
+    """
+
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Yields a temporary name to write path under, and publishes it when the
+    block exits without an error. On an error the temporary file is removed
+    and path is left as it was
+    """
+
+    tmp = temp_name(path)
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    publish(tmp, path)
+
+
+def staging_folder(folder):
+    """
+    Makes an empty hidden folder next to folder to build its replacement in.
+    See swap_folder()
+    """
+
+    parent, base = os.path.split(os.path.normpath(folder))
+    staging = os.path.join(parent, f'.{base}.{os.getpid()}.new')
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.mkdir(staging)
+    return staging
+
+
+def swap_folder(staging, folder):
+    """
+    Replaces folder with a finished staging folder. Only renames are used, so
+    readers see the old folder or the new one complete (folder is missing for
+    the instant between the two renames)
+    """
+
+    parent, base = os.path.split(os.path.normpath(folder))
+    old = os.path.join(parent, f'.{base}.{os.getpid()}.old')
+    if os.path.exists(folder):
+        os.rename(folder, old)
+    os.rename(staging, folder)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+
+_TEMP_FILE = re.compile(r'\..+\.\d+\.tmp(\.[^.]*)?') # temp_name(), and the hidden temps of the step and resource state
+_STAGING = re.compile(r'\..+\.\d+\.(new|old)') # staging_folder() and swap_folder()
+
+
+def clean_partial(folder, subfolders=()):
+    """
+    Removes the temporary files and staging folders of runs on a patient that
+    died partway. Only names the pipelines make are removed, and only from the
+    patient folder and the given subfolders (the ones the pipeline writes
+    temporary files to), so e.g. scans still being copied into Acquired under
+    temporary names are left alone. Only call with the patient_lock() held
+    """
+
+    for where in [folder] + list(subfolders):
+        if not os.path.isdir(where):
+            continue
+        for name in os.listdir(where):
+            path = os.path.join(where, name)
+            if _TEMP_FILE.fullmatch(name) and os.path.isfile(path):
+                os.remove(path)
+            elif where == folder and _STAGING.fullmatch(name) and os.path.isdir(path):
+                shutil.rmtree(path)
+
+
 def find_all_folders_named(folder_name, top_level_folder):
     where_glob = os.path.join(top_level_folder, "**", folder_name)
     potential = glob.glob(where_glob, recursive=True)
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+A durable queue of patients to process, kept in an SQLite database (in WAL
+mode, so workers and status queries don't block each other). Each job is a
+pipeline and its options, as in batch.py, and its row records the requested
+steps, the state (queued, running, done or failed), the number of attempts,
+the steps finished so far, timing and the last error.
+
+Any number of workers, in any number of processes, can work on the same
+queue: a job is claimed atomically, so each job runs in one worker at a time.
+Workers run the jobs in-process (unattended), with the output going to
+logs/job_queue.log in the patient folder.
+
+Transient failures (REDCap and other network errors, and failures of the
+converters dcm2nii, the DICOM converter and perl) are retried with exponential
+backoff, up to the job's maximum number of attempts. Other failures fail the
+job straight away. A retried job resumes from where it stopped: the steps
+it already finished aren't run again. A job whose worker stops responding
+(e.g., the machine crashed) is requeued once its lease runs out, or straight
+away by a worker on the same machine if the old worker process is gone.
+
+input:
+    -m / --mode : add, import, work, status or retry. default: status
+        add : add the job given after --, e.g., job_queue.py -m add -- bold -i /path/to/PTSTEN_101_01 -s 0 -n Doe
+            a patient that already has an unfinished job for the same pipeline is not added again
+        import : add every job in a batch.py job file (-j)
+        work : claim and run jobs until the queue is empty (or forever with -f)
+        status : list the jobs and how many are in each state
+        retry : put the failed jobs (or the job given by -i) back in the queue
+    -d / --db : the queue database. default: SCAN_REPORTING_QUEUE, or scan_reporting_queue.db in the current folder
+    -j / --jobs : import: the job file
+    -a / --attempts : add/import: the maximum number of attempts of each job. default: 3
+    -f / --forever : work: keep waiting for new jobs when the queue is empty. does not take an argument
+    -i / --id : retry: the job to retry
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import getopt
+import json
+import time
+import random
+import socket
+import sqlite3
+import threading
+import traceback
+import subprocess
+import contextlib
+
+QUEUE_DB = os.environ.get('SCAN_REPORTING_QUEUE', 'scan_reporting_queue.db')
+MAX_ATTEMPTS = 3
+LEASE = 600 # seconds without a heartbeat before a running job is taken to be abandoned
+HEARTBEAT = 30 # seconds between heartbeats
+BACKOFF = 30 # seconds before the first retry. doubled for every retry after
+MAX_BACKOFF = 1800
+POLL = 5 # seconds between looks at an empty queue when working forever
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pipeline TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    args TEXT NOT NULL,
+    steps TEXT NOT NULL,
+    done_steps TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    not_before REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    seconds REAL NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, not_before);
+"""
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def is_transient(exc):
+    """
+    Whether a failure is worth retrying: network errors (including REDCap's)
+    and failures of the converters
+    """
+
+    from external import DCM2NII, DICOM_CONVERTER, PERL_BIN
+
+    if isinstance(exc, (subprocess.CalledProcessError, subprocess.TimeoutExpired)):
+        command = exc.cmd if isinstance(exc.cmd, str) else ' '.join([str(c) for c in exc.cmd])
+        return any([os.path.basename(c) in command for c in (DCM2NII, DICOM_CONVERTER, PERL_BIN) if c])
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return type(exc).__module__.split('.')[0] in ('requests', 'urllib3', 'redcap')
+
+
+def backoff(attempts):
+    # seconds to wait before retrying a job that has been attempted attempts times, with some jitter
+    return min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF) * random.uniform(0.8, 1.2)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z' # a zombie that nothing has reaped
+    except (OSError, IndexError):
+        return True
+
+
+class JobQueue:
+    """
+    The queue database
+
+
+    Parameters
+    ----------
+    path : str, optional
+        the SQLite database. Made if it doesn't exist. The default is QUEUE_DB.
+    lease : float, optional
+        seconds without a heartbeat before a running job is requeued. The default is LEASE.
+
+    """
+
+    def __init__(self, path=QUEUE_DB, lease=LEASE):
+        self.path = path
+        self.lease = lease
+        # autocommit mode; transactions are opened explicitly where they're needed
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock() # the heartbeat thread shares the connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read followed by a write can't race another worker
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def add(self, pipeline, args, max_attempts=MAX_ATTEMPTS):
+        """
+        Adds a job. The options are checked (and the requested steps found)
+        with the pipeline's parse_args(), and the patient folder must exist
+
+
+        Parameters
+        ----------
+        pipeline : str
+            'bold' or 'scd'.
+        args : list of str
+            the options of process_bold.py or process_scd.py.
+        max_attempts : int, optional
+            the most times the job is tried. The default is MAX_ATTEMPTS.
+
+        Returns
+        -------
+        int of the job id, or the id of the patient's unfinished job if it already has one.
+
+        """
+
+        import importlib
+        import batch
+
+        if pipeline not in batch.PIPELINES:
+            raise ValueError(f'the pipeline must be one of {list(batch.PIPELINES)}, not {pipeline}')
+        with contextlib.redirect_stdout(None): # parse_args notes a missing -s
+            run = importlib.import_module(batch.PIPELINES[pipeline]).parse_args(list(args))
+        folder = os.path.abspath(run.in_folder)
+        if not os.path.isdir(folder):
+            raise FileNotFoundError(f'input folder {folder} does not exist')
+
+        with self.transaction() as db:
+            existing = db.execute("SELECT id FROM jobs WHERE folder = ? AND pipeline = ? AND state IN ('queued', 'running')",
+                                  (folder, pipeline)).fetchone()
+            if existing is not None:
+                return existing['id']
+            cursor = db.execute('INSERT INTO jobs (pipeline, folder, args, steps, max_attempts, created) VALUES (?, ?, ?, ?, ?, ?)',
+                                (pipeline, folder, json.dumps(list(args)), run.steps, max_attempts, time.time()))
+            return cursor.lastrowid
+
+    def requeue_stale(self, db):
+        # running jobs whose worker has stopped: no heartbeat within the lease, or a dead process on this machine
+        now = time.time()
+        host = socket.gethostname()
+        for job in db.execute("SELECT id, worker, heartbeat, attempts, max_attempts FROM jobs WHERE state = 'running'").fetchall():
+            worker_host, pid = job['worker'].rsplit(':', 1)
+            gone = worker_host == host and not process_alive(int(pid))
+            if not gone and now - job['heartbeat'] < self.lease:
+                continue
+            state = 'queued' if job['attempts'] < job['max_attempts'] else 'failed'
+            db.execute("UPDATE jobs SET state = ?, worker = NULL, error = ? WHERE id = ?",
+                       (state, f'interrupted: worker {job["worker"]} stopped', job['id']))
+            print(f'Job {job["id"]} was interrupted (worker {job["worker"]} stopped). {"Requeued" if state == "queued" else "Out of attempts"}')
+
+    def claim(self, worker=None):
+        """
+        Takes the next job that is ready to run, if any
+
+
+        Parameters
+        ----------
+        worker : str, optional
+            who is claiming it. The default is None (this host and process).
+
+        Returns
+        -------
+        dict of the job's row, or None if no job is ready.
+
+        """
+
+        worker = worker or worker_name()
+        now = time.time()
+        with self.transaction() as db:
+            self.requeue_stale(db)
+            job = db.execute("SELECT * FROM jobs WHERE state = 'queued' AND not_before <= ? ORDER BY not_before, id LIMIT 1",
+                             (now,)).fetchone()
+            if job is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1, "
+                       "started = COALESCE(started, ?), error = NULL WHERE id = ?", (worker, now, now, job['id']))
+            return dict(db.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone())
+
+    def heartbeat(self, job_id, worker):
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ?", (time.time(), job_id, worker))
+
+    def step_done(self, job_id, name):
+        """
+        Records that a step of a job has finished, as soon as it has, so an
+        interrupted job resumes after it
+        """
+
+        with self.transaction() as db:
+            job = db.execute('SELECT steps, done_steps FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            done = set(job['done_steps']) | {name}
+            db.execute('UPDATE jobs SET done_steps = ? WHERE id = ?', (''.join([s for s in job['steps'] if s in done]), job_id))
+
+    def finish(self, job, seconds, error=None, transient=False):
+        """
+        Records the end of an attempt at a job. A failed attempt is requeued
+        (with backoff) if it's transient and the job has attempts left
+        """
+
+        now = time.time()
+        if error is None:
+            state, not_before = 'done', 0
+        elif transient and job['attempts'] < job['max_attempts']:
+            state, not_before = 'queued', now + backoff(job['attempts'])
+        else:
+            state, not_before = 'failed', 0
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET state = ?, not_before = ?, seconds = seconds + ?, error = ?, "
+                       "finished = ?, worker = NULL WHERE id = ?",
+                       (state, not_before, seconds, error, now if state != 'queued' else None, job['id']))
+        return state, not_before
+
+    def retry(self, job_id=None):
+        """
+        Puts failed jobs (or one job) back in the queue with their attempts reset
+        """
+
+        with self.transaction() as db:
+            if job_id is None:
+                cursor = db.execute("UPDATE jobs SET state = 'queued', attempts = 0, not_before = 0 WHERE state = 'failed'")
+            else:
+                cursor = db.execute("UPDATE jobs SET state = 'queued', attempts = 0, not_before = 0 WHERE id = ? AND state != 'running'", (job_id,))
+            return cursor.rowcount
+
+    def next_ready(self):
+        # when the next queued job can run, or None if there are none
+        row = self.db.execute("SELECT MIN(not_before) AS t FROM jobs WHERE state = 'queued'").fetchone()
+        return row['t']
+
+    def counts(self):
+        return {row['state']:row['n'] for row in self.db.execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state')}
+
+    def jobs(self):
+        return [dict(row) for row in self.db.execute('SELECT * FROM jobs ORDER BY id')]
+
+
+def run_job(queue, job, worker):
+    """
+    Makes one attempt at a claimed job, resuming after the steps it finished
+    in earlier attempts, and records the outcome in the queue
+    """
+
+    import importlib
+    import batch
+    from report_daemon import output_to
+
+    done = list(job['done_steps'])
+    remaining = ''.join([s for s in job['steps'] if s not in done])
+    print(f'Job {job["id"]}: {job["pipeline"]} {job["folder"]}, attempt {job["attempts"]} of {job["max_attempts"]}, steps {remaining}'
+          + (f' (steps {"".join(done)} already done)' if done else ''), flush=True)
+
+    if not os.path.isdir(job['folder']): # moved or deleted since it was added. don't make a new one by logging into it
+        error = f'FileNotFoundError: input folder {job["folder"]} does not exist'
+        state, not_before = queue.finish(job, 0, error, False)
+        print(f'Job {job["id"]}: {state} - {error}', flush=True)
+        return state
+
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(HEARTBEAT):
+            queue.heartbeat(job['id'], worker)
+    threading.Thread(target=beat, daemon=True).start()
+
+    start = time.time()
+    error, transient = None, False
+    log_folder = os.path.join(job['folder'], 'logs')
+    os.makedirs(log_folder, exist_ok=True)
+    with open(os.path.join(log_folder, 'job_queue.log'), 'a', buffering=1) as log, output_to(log):
+        print(f'\n##### {time.strftime("%Y-%m-%d %H:%M:%S")} job {job["id"]} attempt {job["attempts"]} ({worker}): steps {remaining}\n')
+        try:
+            module = importlib.import_module(batch.PIPELINES[job['pipeline']])
+            run = module.parse_args(json.loads(job['args']))
+            run.unattended = True
+            run.steps = remaining
+            module.plan(run)
+            run.graph.listeners.append(lambda name: queue.step_done(job['id'], name))
+            module.process(run)
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            error = f'{type(e).__name__}: {e}'
+            transient = is_transient(e)
+        finally:
+            batch.release_figures()
+            stop.set()
+
+    state, not_before = queue.finish(job, time.time() - start, error, transient)
+
+    message = f'Job {job["id"]}: {state} in {round(time.time() - start, 1)} s'
+    if error is not None:
+        message += f' - {error}'
+    if state == 'queued':
+        message += f'. Transient, retrying in {round(not_before - time.time())} s'
+    print(message, flush=True)
+    return state
+
+
+def work(queue, forever=False, worker=None):
+    """
+    Claims and runs jobs until the queue is empty (or forever)
+
+
+    Parameters
+    ----------
+    queue : JobQueue
+        the queue.
+    forever : bool, optional
+        keep waiting for new jobs when the queue is empty. The default is False.
+    worker : str, optional
+        the worker name. The default is None (this host and process).
+
+    Returns
+    -------
+    dict of the number of attempts by outcome.
+
+    """
+
+    worker = worker or worker_name()
+    outcomes = {}
+    while True:
+        job = queue.claim(worker)
+        if job is not None:
+            state = run_job(queue, job, worker)
+            outcomes[state] = outcomes.get(state, 0) + 1
+            continue
+        next_ready = queue.next_ready()
+        if next_ready is None and not forever:
+            break
+        # wait for a job waiting out its backoff (or, when working forever, for new jobs)
+        wait = POLL if next_ready is None else min(max(next_ready - time.time(), 0.1), POLL)
+        time.sleep(wait)
+    return outcomes
+
+
+def print_status(queue):
+    counts = queue.counts()
+    print(f'Queue {queue.path}: ' + ', '.join([f'{n} {state}' for state, n in sorted(counts.items())]))
+    for job in queue.jobs():
+        wait = ''
+        if job['state'] == 'queued' and job['not_before'] > time.time():
+            wait = f' (retry in {round(job["not_before"] - time.time())} s)'
+        print(f'\t{job["id"]}: {job["state"]}{wait} {job["pipeline"]} {os.path.basename(job["folder"])} '
+              f'steps {job["steps"]} (done: {job["done_steps"] or "-"}) attempts {job["attempts"]}/{job["max_attempts"]} '
+              f'{round(job["seconds"], 1)} s' + (f' - {job["error"]}' if job['error'] else ''))
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "m:d:j:a:fi:g", ['mode=', 'db=', 'jobs=', 'attempts=', 'forever', 'id=', 'help'])
+
+    mode = 'status'
+    db_path = QUEUE_DB
+    job_file = None
+    max_attempts = MAX_ATTEMPTS
+    forever = False
+    job_id = None
+
+    for opt, arg in options:
+        if opt in ('-m', '--mode'):
+            mode = arg
+        elif opt in ('-d', '--db'):
+            db_path = arg
+        elif opt in ('-j', '--jobs'):
+            job_file = arg
+        elif opt in ('-a', '--attempts'):
+            max_attempts = int(arg)
+        elif opt in ('-f', '--forever'):
+            forever = True
+        elif opt in ('-i', '--id'):
+            job_id = int(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    queue = JobQueue(db_path)
+    if mode == 'add':
+        if not remainder:
+            raise ValueError('The job (the pipeline and its options) must follow --')
+        print(f'Job {queue.add(remainder[0], remainder[1:], max_attempts)}')
+    elif mode == 'import':
+        import batch
+        if job_file is None:
+            raise ValueError('A job file (-j) is required')
+        ids = []
+        for pipeline, argv in batch.read_jobs(job_file):
+            try:
+                ids.append(queue.add(pipeline, argv, max_attempts))
+            except FileNotFoundError as e:
+                print(f'Not added: {e}')
+        print(f'Added {len(ids)} job(s): {ids}')
+    elif mode == 'work':
+        outcomes = work(queue, forever)
+        print(f'\nAttempts: {outcomes}')
+        print_status(queue)
+        if outcomes.get('failed'):
+            sys.exit(1)
+    elif mode == 'status':
+        print_status(queue)
+    elif mode == 'retry':
+        print(f'Requeued {queue.retry(job_id)} job(s)')
+    else:
+        raise ValueError(f'Unknown mode {mode}. Must be add, import, work, status or retry')
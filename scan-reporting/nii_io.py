@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for reading NiFTIs without paying for gzip decompression on
+every access.
+
+A .nii.gz cannot be seeked into, so reading even a single slice means
+inflating the file from the start. For callers that slice the same series
+again and again (load_nii with use_cache=True), the first read of a .nii.gz
+inflates it once into an uncompressed shadow copy in a local cache folder,
+and every read after that memory-maps the shadow so slices and volumes are
+read directly from disk. Callers that read a whole image once should not use
+the cache, as the shadow would only add a write of the inflated image.
+Shadows are keyed on the source file (device and inode, so hard links share
+a shadow), size and modification time, so a rewritten source gets a fresh
+shadow. The cache is bounded in size and the least recently used shadows are
+evicted first.
+
+The cache location and size can be set with the SCAN_REPORTING_NII_CACHE and
+SCAN_REPORTING_NII_CACHE_BYTES environment variables.
+
+Writing goes the other way: save_nii compresses independent blocks of the
+uncompressed image in parallel threads (zlib releases the GIL) and
+concatenates them as gzip members. A multi-member gzip is a standard gzip
+stream, so nibabel and any other gzip reader open the output as usual. The
+compression level and thread count default to SCAN_REPORTING_GZIP_LEVEL and
+SCAN_REPORTING_GZIP_THREADS.
+
+"""
+
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+CACHE_FOLDER = os.environ.get('SCAN_REPORTING_NII_CACHE',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'scan-reporting', 'nii'))
+CACHE_MAX_BYTES = int(os.environ.get('SCAN_REPORTING_NII_CACHE_BYTES', 8 * 1024**3))
+
+GZIP_LEVEL = int(os.environ.get('SCAN_REPORTING_GZIP_LEVEL', 1)) # nibabel's own default
+GZIP_THREADS = int(os.environ.get('SCAN_REPORTING_GZIP_THREADS', os.cpu_count() or 1))
+GZIP_BLOCK_BYTES = 16 * 1024**2
+
+_COPY_BUFFER = 4 * 1024**2
+
+
+def shadow_name(nii):
+    """
+    Gets the file name (not the full path) of the uncompressed shadow of a .nii.gz
+
+
+    Parameters
+    ----------
+    nii : pathlike
+        path to the .nii.gz.
+
+    Returns
+    -------
+    str of the shadow's file name. The same for every link to the source, and
+    changes whenever the source changes.
+
+    """
+
+    st = os.stat(nii)
+    key = f'{st.st_dev}|{st.st_ino}|{st.st_size}|{st.st_mtime_ns}'
+    return f'{hashlib.sha1(key.encode()).hexdigest()}.nii'
+
+
+def prune_cache(cache_folder=CACHE_FOLDER, max_bytes=CACHE_MAX_BYTES, keep=None):
+    """
+    Deletes the least recently used shadows until the cache fits in max_bytes
+
+
+    Parameters
+    ----------
+    cache_folder : pathlike
+        the shadow cache folder.
+    max_bytes : int
+        the maximum total size of the cache.
+    keep : pathlike, optional
+        a shadow that should not be deleted even if it is the oldest.
+
+    Returns
+    -------
+    int of the number of bytes freed.
+
+    """
+
+    shadows = []
+    for f in os.listdir(cache_folder):
+        if not f.endswith('.nii'):
+            continue
+        full = os.path.join(cache_folder, f)
+        try:
+            st = os.stat(full)
+        except FileNotFoundError: # another process evicted it
+            continue
+        shadows.append((st.st_mtime, st.st_size, full))
+
+    total = sum([s[1] for s in shadows])
+    freed = 0
+    for _, size, full in sorted(shadows):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.samefile(full, keep):
+            continue
+        try:
+            os.remove(full)
+        except FileNotFoundError:
+            pass
+        total -= size
+        freed += size
+
+    return freed
+
+
+def get_shadow(nii, cache_folder=CACHE_FOLDER, max_bytes=CACHE_MAX_BYTES):
+    """
+    Gets the path to an uncompressed, memory-mappable version of a NiFTI,
+    creating it in the cache if needed. Uncompressed NiFTIs are returned as is
+
+
+    Parameters
+    ----------
+    nii : pathlike
+        path to the NiFTI.
+    cache_folder : pathlike
+        the shadow cache folder.
+    max_bytes : int
+        the maximum total size of the cache.
+
+    Returns
+    -------
+    str of the path to read from.
+
+    """
+
+    if not str(nii).endswith('.gz'):
+        return nii
+
+    os.makedirs(cache_folder, exist_ok=True)
+    shadow = os.path.join(cache_folder, shadow_name(nii))
+
+    if os.path.exists(shadow):
+        os.utime(shadow) # mark as recently used
+        return shadow
+
+    # inflate into a temp file and rename it into place so concurrent readers never see a partial shadow
+    handle, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=cache_folder)
+    try:
+        with gzip.open(nii, 'rb') as src, os.fdopen(handle, 'wb') as dst:
+            shutil.copyfileobj(src, dst, _COPY_BUFFER)
+        os.replace(tmp_name, shadow)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    prune_cache(cache_folder, max_bytes, keep=shadow)
+
+    return shadow
+
+
+def load_nii(nii, use_cache=False):
+    """
+    Drop-in replacement for nib.load that can read .nii.gz files through the
+    shadow cache. With the cache, the returned image's dataobj is memory-mapped,
+    so slicing it (e.g., img.dataobj[:,:,:,i]) only reads the requested voxels
+
+
+    Parameters
+    ----------
+    nii : pathlike
+        path to the image.
+    use_cache : bool, optional
+        if False, this is just nib.load. Only worth it for images that are
+        sliced many times. The default is False.
+
+    Returns
+    -------
+    nibabel image.
+
+    """
+    import nibabel as nib # imported here so the gzip helpers don't need it
+
+    if not use_cache:
+        return nib.load(nii)
+
+    try:
+        path = get_shadow(nii)
+    except OSError as e:
+        # an unwritable or full cache shouldn't stop a report from being made
+        print(f'Could not use the NiFTI cache ({e}). Reading {nii} directly')
+        return nib.load(nii)
+
+    return nib.load(path, mmap=True)
+
+
+def _compress_block(block, compresslevel):
+    # mtime=0 keeps the output reproducible and lets gzip hand the whole block to zlib at once
+    return gzip.compress(block, compresslevel=compresslevel, mtime=0)
+
+
+def gzip_file_parallel(src, dst, compresslevel=GZIP_LEVEL, threads=GZIP_THREADS, block_size=GZIP_BLOCK_BYTES):
+    """
+    Gzips a file by compressing fixed-size blocks in parallel and writing
+    them in order as consecutive gzip members
+
+
+    Parameters
+    ----------
+    src : pathlike
+        the file to compress.
+    dst : pathlike
+        the gzipped file to write. Replaced atomically once complete.
+    compresslevel : int, optional
+        zlib compression level, 0-9. The default is GZIP_LEVEL.
+    threads : int, optional
+        the number of compression threads. The default is GZIP_THREADS.
+    block_size : int, optional
+        the number of uncompressed bytes per gzip member. The default is GZIP_BLOCK_BYTES.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    threads = max(1, int(threads))
+    # opened normally (not mkstemp) so the output gets the usual permissions. the thread id keeps threads of one process apart
+    tmp_name = f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    try:
+        with open(src, 'rb') as fin, open(tmp_name, 'wb') as fout, ThreadPoolExecutor(threads) as pool:
+            # only keep a couple of blocks per thread in flight so memory stays bounded for big 4D series
+            pending = []
+            while True:
+                block = fin.read(block_size)
+                if block:
+                    pending.append(pool.submit(_compress_block, block, compresslevel))
+                if pending and (len(pending) >= 2*threads or not block):
+                    fout.write(pending.pop(0).result())
+                if not block and not pending:
+                    break
+        os.replace(tmp_name, dst)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def save_nii(img, filename, compresslevel=GZIP_LEVEL, threads=GZIP_THREADS):
+    """
+    Drop-in replacement for nib.save that compresses .nii.gz outputs with
+    multiple threads. Other extensions are passed straight to nib.save
+
+
+    Parameters
+    ----------
+    img : nibabel image
+        the image to save.
+    filename : pathlike
+        the output name.
+    compresslevel : int, optional
+        zlib compression level, 0-9. The default is GZIP_LEVEL.
+    threads : int, optional
+        the number of compression threads. The default is GZIP_THREADS.
+
+    Returns
+    -------
+    None.
+
+    """
+    import nibabel as nib
+
+    filename = os.fspath(filename)
+    if not filename.endswith('.gz'):
+        nib.save(img, filename)
+        return
+
+    tmp_name = f'{filename[:-3]}.{os.getpid()}.{threading.get_ident()}.tmp.nii'
+    try:
+        nib.save(img, tmp_name)
+        gzip_file_parallel(tmp_name, filename, compresslevel=compresslevel, threads=threads)
+    finally:
+        if os.path.exists(tmp_name): # nib.save may have failed before creating it
+            os.remove(tmp_name)
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Checks that patients have everything the requested steps will need before
+they are processed, so a broken input is caught in a second instead of after
+a 20 minute MATLAB run. Only filenames and headers are read (no image data).
+
+The jobs are given as a job file (see batch.py), or as one job after --, e.g.,
+
+    preflight.py -j cohort.jobs -o preflight.json
+    preflight.py -- scd -i /path/to/PTSTEN_202_01 -n Roe -s 124 -h 0.3 -p sca -a 0.98 -r 0
+
+Problems are errors (the run will fail) or warnings (the run will go on, but
+e.g. without the EtCO2 graph). The checks are
+    every run : the Acquired folder has scans in a supported format (PARREC, DICOM or
+        NiFTI), every PAR has its REC and every REC is as big as its PAR says
+    step 1 : the patient name is in the scan filenames
+    step 2, BOLD : there is a BOLD series and it has all its dynamics (-e)
+    step 2, SCD : the TRUST source (*SOURCE*TRUST*) exists and has TRUST_VEIN in its name,
+        the pCASL scan has PLD and LD in its name (the first *_PLD* and *_LD* files are the same
+        scan, and its PAR has a repetition time), and the hematocrit, arterial oxygen saturation
+        and patient type are given if REDCap won't be contacted
+    step 5, BOLD : thresh_vals.csv and an axial FLAIR exist
+    step 6, BOLD : etco2.csv and the report template exist
+    any step : the outputs of the steps it depends on exist, if those steps aren't requested
+For unattended jobs (-q in the job, or -q here) every question the run will
+ask must have an answer in a parameter file (see decisions.py).
+
+input:
+    -j / --jobs : the job file
+    -o / --outfile : write the report (every patient's errors and warnings) to this JSON file
+    -e / --expected : the number of dynamics a BOLD series should have. default: 360
+    -q / --unattended : check as if every job runs unattended, as in batch.py -q, -w or -d.
+        does not take an argument
+    -t / --threads : the number of patients checked at once. default: 16
+    -g / --help : brings up this helpful information. does not take an argument
+
+The exit status is 1 if any patient has an error.
+"""
+
+import os
+import sys
+import getopt
+import json
+import time
+import glob
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+import helpers as hp
+from bold_scanner import series_dynamics, EXPECTED_DYNAMICS
+from decisions import DecisionProvider, find_param_file, read_param_file, DEFAULTS_FILE
+from step_graph import bold_steps, scd_steps
+from external import BIN_FOLDER
+from batch import PIPELINES, read_jobs
+
+PARREC_EXTS = ['PAR', 'REC', 'V41', 'XML']
+DICOM_EXTS = ['dcm', 'DCM']
+NIFTI_EXTS = ['nii', 'gz']
+
+
+def rec_shortfall(par):
+    """
+    How many bytes the REC of a PAR is missing, from the image lines of the
+    PAR (each image is its recon resolution times its pixel size)
+
+
+    Parameters
+    ----------
+    par : str
+        path to the PAR.
+
+    Returns
+    -------
+    int, 0 if the REC is complete. None if the PAR has no image lines.
+
+    """
+
+    expected = 0
+    with open(par, errors='ignore') as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped[0] in '.#':
+                continue
+            cols = stripped.split()
+            try:
+                expected += int(cols[7]) // 8 * int(cols[9]) * int(cols[10]) # pixel size (bits), recon resolution x and y
+            except (IndexError, ValueError):
+                pass
+    if not expected:
+        return None
+    rec = os.path.splitext(par)[0] + ('.REC' if par.endswith('.PAR') else '.rec')
+    return max(0, expected - os.path.getsize(rec))
+
+
+def par_value(par, label):
+    # the value of a general information line of a PAR, e.g., 'Repetition time', or None
+    with open(par, errors='ignore') as f:
+        for line in f:
+            if line.startswith('.') and label in line:
+                return line.split(':', 1)[-1].strip()
+            if not line.startswith(('.', '#')) and line.strip():
+                break
+    return None
+
+
+class Report:
+    """
+    The errors and warnings of one patient
+    """
+
+    def __init__(self, pipeline, folder, steps):
+        self.result = {'patient':os.path.basename(os.path.normpath(folder)) if folder else None, 'pipeline':pipeline,
+                       'folder':folder, 'steps':steps, 'ok':True, 'errors':[], 'warnings':[], 'seconds':None}
+
+    def error(self, check, message):
+        self.result['errors'].append({'check':check, 'message':message})
+        self.result['ok'] = False
+
+    def warning(self, check, message):
+        self.result['warnings'].append({'check':check, 'message':message})
+
+
+def check_answers(report, decide, unattended, questions):
+    """
+    For an unattended run, makes an error of each question that will be
+    asked but has no answer
+
+
+    Parameters
+    ----------
+    questions : list of (key, auto_answer, why) tuples
+        the questions the run will ask.
+
+    """
+
+    if not unattended:
+        return
+    for key, auto_answer, why in questions:
+        if not decide.has_answer(key, auto_answer):
+            report.error('answers', f'{why}, so the run will ask "{key}", but it runs unattended and there is no answer for it')
+
+
+def check_acquired(report, run, decide, unattended):
+    # the checks every run needs: the raw scans are there and readable
+    acq_folder = os.path.join(run.in_folder, 'Acquired')
+    if not os.path.isdir(acq_folder):
+        report.error('acquired', f'{acq_folder} does not exist')
+        return None
+    files = [f for f in sorted(os.listdir(acq_folder)) if os.path.isfile(os.path.join(acq_folder, f))]
+    if not files:
+        report.error('acquired', f'{acq_folder} has no scans')
+        return None
+
+    guess_ext = hp.most_common([f.split('.')[-1] for f in files])
+    if guess_ext in PARREC_EXTS:
+        for f in files:
+            stem, ext = os.path.splitext(f)
+            if ext in ('.PAR', '.par'):
+                rec = stem + ('.REC' if ext == '.PAR' else '.rec')
+                if rec not in files:
+                    report.error('parrec', f'{f} has no {rec}')
+                    continue
+                shortfall = rec_shortfall(os.path.join(acq_folder, f))
+                if shortfall:
+                    report.error('parrec', f'{rec} is {shortfall} bytes shorter than {f} says. It may not have finished copying')
+            elif ext in ('.REC', '.rec') and stem + ('.PAR' if ext == '.REC' else '.par') not in files:
+                report.error('parrec', f'{f} has no PAR')
+    elif guess_ext in DICOM_EXTS:
+        from external import DICOM_CONVERTER, PERL_BIN
+        for tool in (DICOM_CONVERTER, PERL_BIN):
+            if not os.path.exists(tool):
+                report.error('dicom', f'The scans are DICOMs, but {tool} (needed to convert them) does not exist')
+    elif guess_ext in NIFTI_EXTS:
+        check_answers(report, decide, unattended, [('nifti_beta', None, 'The scans are NiFTIs')])
+    else:
+        report.error('acquired', f'The scans in {acq_folder} seem to be .{guess_ext}, which is not supported')
+    return guess_ext
+
+
+def check_name(report, run, decide, unattended, guess_ext):
+    # step 1 replaces the patient name in the scan filenames
+    if '1' not in run.steps or not guess_ext:
+        return
+    if not isinstance(run.deidentify_name, str):
+        report.error('deidentify', 'Step 1 is requested but no patient name (-n) was given')
+    elif not any([run.deidentify_name in f for f in os.listdir(os.path.join(run.in_folder, 'Acquired'))]):
+        report.warning('deidentify', f'The name {run.deidentify_name} is not in any scan filename')
+        check_answers(report, decide, unattended, [('deidentify_missing', None, f'The name {run.deidentify_name} is not in any scan filename')])
+
+
+def check_dependencies(report, run, steps):
+    # a requested step needs the outputs of the steps it depends on, if those aren't requested too
+    steps = {s.name:s for s in steps}
+    for step in steps.values():
+        if step.name not in run.steps:
+            continue
+        for dep in step.depends:
+            if dep in run.steps:
+                continue
+            missing = [pattern for pattern in steps[dep].outputs
+                       if not glob.glob(os.path.join(run.in_folder, pattern), recursive=True)]
+            if missing:
+                report.error('dependencies', f'Step {step.name} needs the outputs of step {dep} ({", ".join(missing)}), '
+                                             f'which are missing and step {dep} is not requested')
+
+
+def check_bold(report, run, decide, unattended, expected=EXPECTED_DYNAMICS):
+    in_folder = run.in_folder
+    acq_folder = os.path.join(in_folder, 'Acquired')
+    guess_ext = check_acquired(report, run, decide, unattended)
+    check_dependencies(report, run, bold_steps(run.pt_id))
+
+    check_name(report, run, decide, unattended, guess_ext)
+
+    if '2' in run.steps and guess_ext:
+        series = sorted([f for f in glob.glob(os.path.join(acq_folder, '**', '*BOLD*'), recursive=True)
+                         if f.endswith(('.PAR', '.par', '.nii', '.nii.gz'))])
+        if not series:
+            report.error('bold_series', f'There is no BOLD series (*BOLD*.PAR or *BOLD*.nii[.gz]) in {acq_folder}')
+        for path in series:
+            try:
+                dynamics = series_dynamics(path)
+            except (OSError, ValueError, EOFError) as e:
+                report.error('bold_series', f'Could not read the header of {os.path.basename(path)}: {e}')
+                continue
+            if dynamics < expected:
+                report.error('bold_series', f'{os.path.basename(path)} has {dynamics} of {expected} dynamics. '
+                                            f'The scan may have been cancelled early (see fix_bold_file.py)')
+        check_answers(report, decide, unattended, [('asl_type', None, 'Step 2 asks for the ASL type')])
+
+    if '5' in run.steps:
+        if not os.path.exists(os.path.join(in_folder, 'thresh_vals.csv')):
+            report.warning('thresh_vals', 'There is no thresh_vals.csv. The report images will use automatic color scales')
+            check_answers(report, decide, unattended, [('thresh_search', None, 'There is no thresh_vals.csv')])
+        flairs = [f for f in glob.glob(os.path.join(acq_folder, '**', '*FLAIR*'), recursive=True)
+                  if not hp.any_in_str(f, ['cor', 'COR', 'coronal', 'CORONAL'])]
+        if guess_ext and not flairs:
+            report.warning('flair', 'There is no axial FLAIR. It will be missing from the report')
+
+    if '6' in run.steps:
+        if not os.path.exists(os.path.join(in_folder, 'etco2.csv')):
+            report.warning('etco2', 'There is no etco2.csv. The EtCO2 graph will be missing from the report')
+        template = os.path.join(BIN_FOLDER, 'TEMPLATE_BOLD_PLACEHOLDERS.pptx')
+        if not os.path.exists(template):
+            report.error('template', f'The report template {template} does not exist')
+
+
+def check_scd(report, run, decide, unattended):
+    in_folder = run.in_folder
+    acq_folder = os.path.join(in_folder, 'Acquired')
+    guess_ext = check_acquired(report, run, decide, unattended)
+    check_dependencies(report, run, scd_steps(run.pt_id))
+
+    check_name(report, run, decide, unattended, guess_ext)
+
+    if '2' not in run.steps or not guess_ext:
+        return
+
+    if run.do_run['trust']:
+        sources = glob.glob(os.path.join(acq_folder, '*SOURCE*TRUST*'))
+        if not sources:
+            report.error('trust', 'There is no TRUST source (*SOURCE*TRUST*). Add it or exclude TRUST processing (-e trust)')
+        elif 'TRUST_VEIN' not in sources[0]:
+            report.warning('trust', f'The TRUST source {os.path.basename(sources[0])} does not have TRUST_VEIN in its name. '
+                                    f'It will be renamed')
+            check_answers(report, decide, unattended, [('trust_rename', 'fix', 'The TRUST source needs renaming')])
+
+    names_with_pld = sorted(glob.glob(os.path.join(acq_folder, '*_PLD*')))
+    names_with_ld = sorted(glob.glob(os.path.join(acq_folder, '*_LD*')))
+    if not names_with_pld or not names_with_ld:
+        report.warning('asl', 'No scan has PLD and LD in its name. The PLD, LD and TR will be 0')
+        check_answers(report, decide, unattended, [('asl_missing', 'y', 'No scan has PLD and LD in its name')])
+    elif names_with_pld[0] != names_with_ld[0]:
+        report.error('asl', f'The PLD ({os.path.basename(names_with_pld[0])}) and LD ({os.path.basename(names_with_ld[0])}) '
+                            f'are not in the name of the same file. Rename the pCASL scan so both are in its name')
+    else:
+        pcasl = names_with_pld[0]
+        parts = os.path.basename(pcasl).split('.')[0].split('_')
+        pld = [p for p in parts if 'PLD' in p][0][3:]
+        ld = [p for p in parts if 'LD' in p and 'PLD' not in p][0][2:]
+        for what, value in (('PLD', pld), ('LD', ld)):
+            try:
+                float(value)
+            except ValueError:
+                report.error('asl', f'The {what} in {os.path.basename(pcasl)} is not a number ({value or "empty"})')
+        if pcasl.endswith(('.PAR', '.REC')):
+            par = os.path.splitext(pcasl)[0] + '.PAR'
+            if not os.path.exists(par) or par_value(par, 'Repetition time') is None:
+                report.error('asl', f'No repetition time found in {os.path.basename(par)}')
+    check_answers(report, decide, unattended, [('asl_params', 'y', 'Step 2 asks to confirm the ASL parameters')])
+
+    if not run.contact_redcap:
+        needed = [('patient type (-p)', run.pt_type)]
+        if run.do_run['trust']:
+            needed.append(('hematocrit (-h)', run.hematocrit))
+            if '4' in run.steps:
+                needed.append(('arterial oxygen saturation (-a)', run.art_ox_sat))
+        for what, value in needed:
+            if value == 'redcap':
+                report.error('redcap', f'The {what} is to come from REDCap, but REDCap will not be contacted (-r 0)')
+
+
+def check_job(pipeline, argv, unattended=False, expected=EXPECTED_DYNAMICS):
+    """
+    Checks one job
+
+
+    Parameters
+    ----------
+    pipeline : str
+        'bold' or 'scd'.
+    argv : list of str
+        the options of process_bold.py or process_scd.py.
+    unattended : bool, optional
+        check as if -q was passed. The default is False.
+    expected : int, optional
+        the number of dynamics a BOLD series should have. The default is EXPECTED_DYNAMICS.
+
+    Returns
+    -------
+    dict of the patient's errors and warnings.
+
+    """
+
+    start = time.perf_counter()
+    module = importlib.import_module(PIPELINES[pipeline])
+    try:
+        run = module.parse_args(argv)
+    except (Exception, SystemExit) as e:
+        report = Report(pipeline, None, None)
+        report.error('options', f'The options could not be read: {type(e).__name__}: {e}')
+        report.result['seconds'] = round(time.perf_counter() - start, 3)
+        return report.result
+
+    report = Report(pipeline, run.in_folder, run.steps)
+    if not os.path.isdir(run.in_folder):
+        report.error('folder', f'{run.in_folder} does not exist')
+    else:
+        run.pt_id = hp.get_terminal(run.in_folder)
+        unattended = unattended or run.unattended
+        try:
+            # the answers the run would get (see DecisionProvider.for_patient, which also prints where they come from)
+            params_file = run.params_file or find_param_file(run.in_folder)
+            layers = [(path, read_param_file(path, pipeline)) for path in (params_file, run.defaults_file or DEFAULTS_FILE) if path]
+            decide = DecisionProvider(layers, auto=bool(getattr(run, 'auto', False)), interactive=False)
+            if pipeline == 'bold':
+                check_bold(report, run, decide, unattended, expected)
+            else:
+                check_scd(report, run, decide, unattended)
+        except Exception as e:
+            report.error('preflight', f'The checks themselves failed: {type(e).__name__}: {e}')
+
+    report.result['seconds'] = round(time.perf_counter() - start, 3)
+    return report.result
+
+
+def check_jobs(jobs, unattended=False, expected=EXPECTED_DYNAMICS, threads=16):
+    """
+    Checks many jobs in parallel
+
+
+    Parameters
+    ----------
+    jobs : list of (pipeline, argv) tuples
+        see batch.read_jobs().
+    unattended, expected : see check_job().
+    threads : int, optional
+        the number of jobs checked at once. The default is 16.
+
+    Returns
+    -------
+    dict of the report: the counts, and the errors and warnings of every job in job order.
+
+    """
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        results = list(pool.map(lambda job: check_job(job[0], job[1], unattended, expected), jobs))
+    return {'checked':len(results), 'passed':sum([r['ok'] for r in results]),
+            'failed':sum([not r['ok'] for r in results]), 'wall_seconds':round(time.perf_counter() - start, 3),
+            'jobs':results}
+
+
+def print_report(report):
+    for r in report['jobs']:
+        if r['errors'] or r['warnings']:
+            print(f"{r['patient']} ({r['pipeline']} steps {r['steps']}): {'OK' if r['ok'] else 'FAILED'}")
+            for e in r['errors']:
+                print(f"\tERROR ({e['check']}): {e['message']}")
+            for w in r['warnings']:
+                print(f"\twarning ({w['check']}): {w['message']}")
+    print(f"\n{report['checked']} jobs checked in {report['wall_seconds']} s. {report['passed']} passed, {report['failed']} failed")
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "j:o:e:qt:g", ['jobs=', 'outfile=', 'expected=', 'unattended', 'threads=', 'help'])
+
+    job_file = None
+    out_name = None
+    expected = EXPECTED_DYNAMICS
+    unattended = False
+    threads = 16
+
+    for opt, arg in options:
+        if opt in ('-j', '--jobs'):
+            job_file = arg
+        elif opt in ('-o', '--outfile'):
+            out_name = arg
+        elif opt in ('-e', '--expected'):
+            expected = int(arg)
+        elif opt in ('-q', '--unattended'):
+            unattended = True
+        elif opt in ('-t', '--threads'):
+            threads = int(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if job_file is not None:
+        jobs = read_jobs(job_file)
+    elif remainder:
+        if remainder[0] not in PIPELINES:
+            raise ValueError(f'The pipeline must be one of {list(PIPELINES)}, not {remainder[0]}')
+        jobs = [(remainder[0], remainder[1:])]
+    else:
+        raise ValueError('A job file (-j) or a job after -- is required')
+
+    report = check_jobs(jobs, unattended, expected, threads)
+    print_report(report)
+    if out_name is not None:
+        with open(out_name, 'w') as f:
+            json.dump(report, f, indent=4)
+    if report['failed']:
+        sys.exit(1)
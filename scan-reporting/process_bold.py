@@ -7,8 +7,9 @@ This involves:
     1) deidentifying the scans
     2) generating derived images - CBF, CVR, CVR_Max, and CVR_Delay images in native space, T1 space, and 4 mm MNI space.
     3) generating the CVR movie
-    4) metrics calculation
-    5) reporting image generation
+    4) metrics calculation (if run together, steps 3 and 4 run at the same time and
+        their output is logged to the logs subfolder of the PTSTEN folder)
+    5) reporting image generation, including timeseries QC (tSNR, DVARS, global signal) of the BOLD series
     6) creating patient scan report as a powerpoint
     
 Note that to have the EtCO2 trace generated for you (step 6), you should add
@@ -16,6 +17,12 @@ a CSV with two columns in the PTSTEN folder (not the Acquired subdirectory)
 called ‘etco2.csv’. Each column should have a header (though the header name
 does not matter). The first column should be the dynamic scan numbers,
 and the second column should be the EtCO2 values.
+
+The pipeline can also be used from Python, e.g., to process many patients in
+one process (see batch.py):
+    import process_bold
+    run = process_bold.BoldRun('/path/to/PTSTEN_001_01', deidentify_name='DOEJANE', steps='0', unattended=True)
+    process_bold.process(run)
     
     
 input:
@@ -32,188 +39,339 @@ input:
         scan date in PAR files and DOB). If -d is an age, only the age and metric
         plotting is completed. If -d is not supplied, then neither the dob or age is completed,
         and plotting is carried out using age=0.
+    -z / --force : rerun every requested step, even if its outputs are up to date. does not take an argument
+        by default, a requested step is skipped if its outputs exist and its inputs, the options
+        it uses (e.g., -d) and its answers (see -o) have not changed since it last ran (tracked in step_state.json in the PTSTEN folder)
+    -l / --dryrun : list which of the requested steps would run (and why) and exit. does not take an argument
+    -k / --hash : also compare file contents (SHA-1) when deciding if a step is up to date,
+        not just sizes and modification times. does not take an argument
+    -w / --backend : how the MATLAB functions are run. shell (default) starts MATLAB
+        for every call, engine keeps warm MATLAB sessions through the MATLAB Engine API for Python,
+        fake doesn't run MATLAB (for testing). The default can also be set with SCAN_REPORTING_BACKEND
+    -o / --params : a YAML or JSON file of answers to the questions asked during processing.
+        if not given, params.yaml, params.yml or params.json in the PTSTEN folder is used if it exists.
+        see decisions.py for the question keys
+    -v / --defaults : a YAML or JSON file of cohort-wide default answers, used for questions
+        the patient's parameter file doesn't answer. can also be set with SCAN_REPORTING_DEFAULTS
+    -q / --unattended : never prompt. a question with no answer in the parameter files stops processing
+        with an error instead. this is also the behavior when answers piped into stdin run out. does not take an argument
+    -m / --profile : profile the reporting steps (5 and 6) with cProfile and tracemalloc. the .pstats files
+        and summaries of time and memory allocations are written to reporting_images/profile. does not take an argument
     -g / --help : brings up this helpful information. does not take an argument
 """
 
+
 import os
 import sys
 import getopt
-import subprocess
 import time
 import datetime
 import glob
 import shutil
-import datetime
+from dataclasses import dataclass, field
 
-from pptx import Presentation
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas as pd
-import nibabel as nib
+# the heavy dependencies (python-pptx, matplotlib, pandas, nibabel, numpy) are imported in
+# the steps that use them, so --help, dry runs and deidentification don't wait on them
 
 from helpers import get_terminal, str_time_elapsed, any_in_str, replace_in_ppt, analyze_ppt, add_ppt_image, add_ppt_image_ph, plot_dot
 import helpers as hp
 from report_image_generation import par2nii, nii_image
+from step_graph import StepGraph, bold_steps
+from external import BOLD_SCRIPTS, BOLD_DEIDENTIFY, BIN_FOLDER, run_logged, run_parallel
+from compute_backend import get_backend
+from decisions import DecisionProvider
+import telemetry
+from profiling import stage_profiler
 
-#sys.exit()
-
-inp = sys.argv
-bash_input = inp[1:]
-options, remainder = getopt.getopt(bash_input, "i:n:s:d:c:g", ["infolder=","name=",'steps=','dob=', 'clean', 'help'])
-
-for opt, arg in options:
-    if opt in ('-i', '--infile'):
-        in_folder = arg
-    elif opt in ('-n', '--name'):
-        deidentify_name = arg
-    elif opt in ('-s', '--steps'):
-        steps = arg
-    elif opt in ('-d', '--dob'):
-        dobage = arg
-    elif opt in ('-g', '--help'):
-        print(help_info)
-        sys.exit()
-
-try:
-    if steps == '0':
-        steps = '123456'
-except NameError:
-    print('-s not specified. running all steps')
-    steps = '123456'
-        
-try:
-    assert os.path.isdir(in_folder)
-except AssertionError:
-    raise AssertionError('input folder does not exist')
-    
-    
-
-
-
+STEPS = '123456'
 
-start_stamp = time.time()
-now = datetime.datetime.now()
-pretty_now = now.strftime("%Y-%m-%d %H:%M:%S")
-
-inp_copy = inp.copy()
-for i, s in enumerate(inp_copy):
-    if s == '-n' or s== '--name':
-        inp_copy[i+1] = '[REDACTED]'
+signature_relationships = {('FLAIR_AX', 'T2W_FLAIR'):
+                               {'basename': 'axFLAIR', 'excl':['cor','COR','coronal','CORONAL'], 'isin':'Acquired', 'ext':None, 'cmap':'gray', 'dims':(4,6)}, # THIS NEEDS TO BE UPDATED - the input FLAIR will not always be PAR!
+                           ('CBF_MNI',):
+                               {'basename': 'CBF', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':'jet', 'dims':(3,10)},
+                           ('ZSTAT1_MNI_normalized',):
+                               {'basename': 'CVR', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':'jet', 'dims':(3,10)},
+                           ('ZMAX2STANDARD_normalized',):
+                               {'basename': 'CVRmax', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':'jet', 'dims':(3,10)},
+                           ('TMAX2STANDARD',):
+                               {'basename': 'CVRdelay', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':'jet', 'dims':(3,10)},
+                          } # an 'ext' of None means the extension of the raw scans
 
-thecommand = ' '.join(inp_copy)
-meta_file_name = os.path.join(in_folder, 'meta.txt')
-meta_file = open(meta_file_name, 'w')
-meta_file.write(f'Processing started {pretty_now}')
-meta_file.write('\n\n')
-meta_file.write(thecommand)
-meta_file.close()
 
-print(f'\nBegin processing: {pretty_now}')
+@dataclass
+class BoldRun:
+    """
+    Everything about one run of the BOLD pipeline on one patient. The options
+    are the command line options (see help_info); the rest is filled in by
+    prepare() and the steps
+
+
+    Parameters
+    ----------
+    in_folder : str
+        the PTSTEN folder.
+    deidentify_name : str, optional
+        the patient name to deidentify. Only needed for step 1.
+    steps : str, optional
+        the steps to run. '0' means all of them. The default is STEPS.
+    dobage : str, optional
+        the date of birth as YYYY.mm.dd, or the age. The default is None.
+    force, dry_run, use_hash, unattended, profile : bool, optional
+        as -z, -l, -k, -q and -m. The default is False.
+    backend_name : str, optional
+        as -w. The default is None (SCAN_REPORTING_BACKEND).
+    params_file, defaults_file : str, optional
+        as -o and -v. The default is None.
+    command : str, optional
+        how the run was started, written to meta.txt. The default is None (built from the options).
 
+    """
 
+    in_folder: str
+    deidentify_name: str = None
+    steps: str = STEPS
+    dobage: str = None
+    force: bool = False
+    dry_run: bool = False
+    use_hash: bool = False
+    backend_name: str = None
+    params_file: str = None
+    defaults_file: str = None
+    unattended: bool = False
+    profile: bool = False
+    command: str = None
+
+    # filled in by prepare()
+    pt_id: str = field(default=None, init=False)
+    graph: StepGraph = field(default=None, init=False, repr=False)
+    backend: object = field(default=None, init=False, repr=False)
+    decide: DecisionProvider = field(default=None, init=False, repr=False)
+    start_stamp: float = field(default=None, init=False)
+    fig_ext: str = field(default=None, init=False)
+
+    def __post_init__(self):
+        if self.steps == '0':
+            self.steps = STEPS
+
+    @property
+    def reporting_folder(self):
+        return os.path.join(self.in_folder, 'reporting_images')
+
+    @property
+    def conversion_folder(self):
+        return os.path.join(self.reporting_folder, 'gathered')
+
+    def describe_command(self):
+        """
+        The command line equivalent of the run, with the patient name redacted
+        """
+
+        if self.command is not None:
+            return self.command
+        parts = ['process_bold.py', '-i', self.in_folder, '-s', self.steps]
+        if self.deidentify_name is not None:
+            parts.extend(['-n', '[REDACTED]'])
+        if self.dobage is not None:
+            parts.extend(['-d', self.dobage])
+        return ' '.join(parts)
+
+
+def parse_args(argv):
+    """
+    Builds a BoldRun from command line arguments (without the program name)
+    """
 
+    options, remainder = getopt.getopt(argv, "i:n:s:d:c:w:o:v:gzlkqm", ["infolder=","name=",'steps=','dob=', 'clean', 'help', 'force', 'dryrun', 'hash', 'backend=',
+                                                                   'params=', 'defaults=', 'unattended', 'profile'])
+
+    kwargs = {}
+    for opt, arg in options:
+        if opt in ('-i', '--infolder'):
+            kwargs['in_folder'] = arg
+        elif opt in ('-n', '--name'):
+            kwargs['deidentify_name'] = arg
+        elif opt in ('-s', '--steps'):
+            kwargs['steps'] = arg
+        elif opt in ('-d', '--dob'):
+            kwargs['dobage'] = arg
+        elif opt in ('-z', '--force'):
+            kwargs['force'] = True
+        elif opt in ('-l', '--dryrun'):
+            kwargs['dry_run'] = True
+        elif opt in ('-k', '--hash'):
+            kwargs['use_hash'] = True
+        elif opt in ('-w', '--backend'):
+            kwargs['backend_name'] = arg
+        elif opt in ('-o', '--params'):
+            kwargs['params_file'] = arg
+        elif opt in ('-v', '--defaults'):
+            kwargs['defaults_file'] = arg
+        elif opt in ('-q', '--unattended'):
+            kwargs['unattended'] = True
+        elif opt in ('-m', '--profile'):
+            kwargs['profile'] = True
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if 'steps' not in kwargs:
+        print('-s not specified. running all steps')
+    if 'in_folder' not in kwargs:
+        raise AssertionError('input folder (-i) is required')
+
+    command = ['process_bold.py'] + list(argv)
+    for i, s in enumerate(command[:-1]):
+        if s == '-n' or s == '--name':
+            command[i+1] = '[REDACTED]'
+    kwargs['command'] = ' '.join(command)
+
+    return BoldRun(**kwargs)
+
+
+def plan(run):
+    """
+    Reads the run's answers to processing questions, builds its step graph
+    and prints what would run
+    """
 
+    try:
+        assert os.path.isdir(run.in_folder)
+    except AssertionError:
+        raise AssertionError('input folder does not exist')
 
+    run.pt_id = get_terminal(run.in_folder) # if the input folder is named correctly, it is the ID that will replace the pt name
+    # the answers are read here, as a changed answer (or option) means a step is out of date
+    run.decide = DecisionProvider.for_patient(run.in_folder, 'bold', run.params_file, run.defaults_file, unattended=run.unattended)
+    params = {name:getattr(run, name) for name in ['dobage']}
+    run.graph = StepGraph(run.in_folder, bold_steps(run.pt_id), run.steps, force=run.force, use_hash=run.use_hash,
+                          params=params, decide=run.decide)
+    print(f'\nStep plan:\n{run.graph.describe()}')
+    return run.graph
 
-acq_folder = os.path.join(in_folder, 'Acquired')
-orig_files = [os.path.join(acq_folder, f) for f in os.listdir(acq_folder) if os.path.isfile(os.path.join(acq_folder, f))]
-extensions = [f.split('.')[-1] for f in orig_files]
-guess_ext = hp.most_common(extensions)
 
-orig_data_copy_folder = os.path.join(in_folder, 'rawdata')
-    
-dcm_exts = ['dcm', 'DCM']
-parrec_exts = ['PAR', 'REC', 'V41', 'XML']
-nii_exts = ['nii', 'gz']
-
-if guess_ext in parrec_exts:
-    print('Input files seem to be PARREC - proceeding as normal')
-elif guess_ext in dcm_exts:
-    print('Input files seem to be DICOM - converting to PARREC before continuing (original DICOMs will be retained)')
-    shutil.copytree(acq_folder, orig_data_copy_folder)
-    shutil.rmtree(acq_folder)
-    os.mkdir(acq_folder)
-    
-    moved_files = [os.path.join(orig_data_copy_folder, f) for f in os.listdir(orig_data_copy_folder) if os.path.isfile(os.path.join(orig_data_copy_folder, f))]
-    moved_extensions = [f.split('.')[-1] for f in orig_files]
-    for fi, ext in zip(moved_files, moved_extensions):
-        if ext in dcm_exts:
-            #print(f'\n\n\nCONVERTING: {fi}')
-            hp.dicom_to_parrec(fi, acq_folder)
-elif guess_ext in nii_exts:
-    has_ans = False
-    while not has_ans:
-        ans = input(f'Input files seem to be NiFTI. ASL processing of NiFTIs is in an UNSTABLE BETA state.\nRESULTS MUST BE MANUALLY INSPECTED FOR CORRECTNESS. Please acknowledge this or cancel processing. [acknowledge/cancel]\n')
-        if ans in ('acknowledge', 'cancel'):
-            has_ans = True
-            if ans == 'cancel':
-                raise Exception('Aborting processing')
-            elif ans == 'acknowledge':
-                print('Continuing with beta processing of NiFTIs')
-        else:
-            print('Answer must be "acknowledge" or "cancel"')
-else:
-    raise Exception(f'Filetype ({guess_ext}) does not seem to be supported')
+def prepare(run):
+    """
+    Sets up a run: the MATLAB backend, telemetry and meta.txt, then checks (and if needed converts) the raw scans
+    """
 
-if guess_ext in nii_exts:
-    fig_ext = 'nii.gz'
-else:
-    fig_ext = guess_ext
+    if run.graph is None:
+        plan(run)
+    in_folder = run.in_folder
+
+    run.backend = get_backend(run.backend_name)
+    telemetry.configure(in_folder, 'bold')
+
+    run.start_stamp = time.time()
+    now = datetime.datetime.now()
+    pretty_now = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    hp.clean_partial(in_folder, [run.reporting_folder])
+
+    meta_file_name = os.path.join(in_folder, 'meta.txt')
+    with hp.atomic_output(meta_file_name) as tmp_name:
+        with open(tmp_name, 'w') as meta_file:
+            meta_file.write(f'Processing started {pretty_now}')
+            meta_file.write('\n\n')
+            meta_file.write(run.describe_command())
+
+    print(f'\nBegin processing: {pretty_now}')
+
+    acq_folder = os.path.join(in_folder, 'Acquired')
+    orig_data_copy_folder = os.path.join(in_folder, 'rawdata')
+    orig_files = [os.path.join(acq_folder, f) for f in sorted(os.listdir(acq_folder)) if os.path.isfile(os.path.join(acq_folder, f))]
+    if os.path.isdir(orig_data_copy_folder) and not hp.dicom_conversion_done(acq_folder, orig_data_copy_folder):
+        # an earlier conversion from DICOM was cut short, so it's redone from the copy of the DICOMs
+        orig_files = [os.path.join(orig_data_copy_folder, f) for f in sorted(os.listdir(orig_data_copy_folder))
+                      if os.path.isfile(os.path.join(orig_data_copy_folder, f))]
+    extensions = [f.split('.')[-1] for f in orig_files]
+    guess_ext = hp.most_common(extensions)
+
+    dcm_exts = ['dcm', 'DCM']
+    parrec_exts = ['PAR', 'REC', 'V41', 'XML']
+    nii_exts = ['nii', 'gz']
+
+    if guess_ext in parrec_exts:
+        print('Input files seem to be PARREC - proceeding as normal')
+    elif guess_ext in dcm_exts:
+        print('Input files seem to be DICOM - converting to PARREC before continuing (original DICOMs will be retained)')
+        hp.convert_dicom_folder(acq_folder, orig_data_copy_folder, dcm_exts)
+    elif guess_ext in nii_exts:
+        has_ans = False
+        while not has_ans:
+            ans = run.decide.ask('nifti_beta', f'Input files seem to be NiFTI. ASL processing of NiFTIs is in an UNSTABLE BETA state.\nRESULTS MUST BE MANUALLY INSPECTED FOR CORRECTNESS. Please acknowledge this or cancel processing. [acknowledge/cancel]\n')
+            if ans in ('acknowledge', 'cancel'):
+                has_ans = True
+                if ans == 'cancel':
+                    raise Exception('Aborting processing')
+                elif ans == 'acknowledge':
+                    print('Continuing with beta processing of NiFTIs')
+            else:
+                print('Answer must be "acknowledge" or "cancel"')
+    else:
+        raise Exception(f'Filetype ({guess_ext}) does not seem to be supported')
 
+    if guess_ext in nii_exts:
+        run.fig_ext = 'nii.gz'
+    else:
+        run.fig_ext = guess_ext
+    return run
 
-original_wd = os.getcwd()
-pt_id = replacement = get_terminal(in_folder) # if the input folder is named correctly, it is the ID that will replace the pt name
 
-if '1' in steps:
+def deidentify(run):
     ##### step 1 : deidentification
-    
+    in_folder = run.in_folder
+    deidentify_name = run.deidentify_name
+    replacement = run.pt_id
+
     assert type(deidentify_name) == str, 'patient name must be a string'
-        
+
     files_of_interest = os.listdir(os.path.join(in_folder, 'Acquired'))
     has_deid_name = any([deidentify_name in f for f in files_of_interest])
     if not has_deid_name:
         has_ans = False
         while not has_ans:
-            ans = input(f'\nName "{deidentify_name}" not found in Acquired folder. Would you like to proceed anyway? [y/n/change]\n')
+            ans = run.decide.ask('deidentify_missing', f'\nName "{deidentify_name}" not found in Acquired folder. Would you like to proceed anyway? [y/n/change]\n')
             if ans in ('y','n', 'change'):
                 has_ans = True
                 if ans == 'n':
                     raise Exception('Aborting processing')
                 elif ans == 'change':
-                    deidentify_name = input(f'Enter a new deidentification string to replace {deidentify_name}:\n')
+                    deidentify_name = run.decide.ask('deidentify_new_name', f'Enter a new deidentification string to replace {deidentify_name}:\n')
             else:
                 print('Answer must be "y", "n" or "change')
-        
+
     print(f'\nStep 1: deidentification. {deidentify_name} will be replaced with {replacement}')
-        
+
     # build the call to the deidentify script
-    deid_scripts_loc = r'/Users/manusdonahue/Desktop/Projects/BOLD/Scripts/deidentifySLW'
-    
+    deid_scripts_loc = BOLD_DEIDENTIFY
+
     strip_filename_input = f'deidentifyFileNames.sh {in_folder} {deidentify_name} {replacement}'
     strip_header_input = f'deidentifyPARfiles.sh {in_folder}'
-    
+
     deid_commands = [os.path.join(deid_scripts_loc, c) for c in (strip_filename_input, strip_header_input)]
-    
+
     for com in deid_commands:
-        subprocess.run([com], check=True, shell=True)
-        
-    print(f'\nDeidentification complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+        run_logged(com, cwd=None)
+
 
-if '2' in steps:    
+def main_processing(run):
     ##### step 2 : main processing
-    
+
     print(f'Step 2: begin main processing sequence\n')
-    
+
     asltype = 'Baseline'
     dynamics = 360
-    
+
 
     has_ans = False
     while not has_ans:
-        ans = input('What is the ASL type? [PASL / pCASL]\n')
+        ans = run.decide.ask('asl_type', 'What is the ASL type? [PASL / pCASL]\n')
         if ans in ('pCASL', 'PASL'):
             has_ans = True
-            confirm = input(f'Please confirm that ASL type is {ans} by entering the ASL type again\n')
+            if run.decide.answered_by('asl_type') == 'prompt':
+                confirm = run.decide.ask('asl_type_confirm', f'Please confirm that ASL type is {ans} by entering the ASL type again\n')
+            else:
+                confirm = ans # no typos to catch in a parameter file
             if ans != confirm:
                 has_ans = False
                 print(f'\nConfirmation failed ({ans} != {confirm})\n')
@@ -221,99 +379,114 @@ if '2' in steps:
                 print('\nEntry confirmed\n')
         else:
             print('Answer must be PASL or pCASL')
-            
+
     if ans == 'pCASL':
         pcaslBool = 1
     elif ans == 'PASL':
         pcaslBool = 0
-    
-    
-    processing_scripts_loc = r'/Users/manusdonahue/Desktop/Projects/BOLD/Scripts/'
-    os.chdir(processing_scripts_loc)
-    processing_input = f'''/Applications/MATLAB_R2016b.app/bin/matlab -nodesktop -nosplash -r "Master('{pt_id}','{asltype}',{dynamics},{pcaslBool})"'''
-    
-    print(f'Call to MATLAB: {processing_input}')
-    
-    subprocess.run(processing_input, check=True, shell=True)
-    # subprocess.run('quit force', check=True, shell=True)
-    
-    os.chdir(original_wd)
-    
-    print(f'\nMain processing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
-    
-if '3' in steps:
+
+
+    run.backend.call('Master', [run.pt_id, asltype, dynamics, pcaslBool], cwd=BOLD_SCRIPTS)
+
+
+def make_cvr_movie(run, log_file=None):
     ##### step 3 : generate cvr movie
-    
-    print(f'\nStep 3: generating CVR movie')
-    
-    movie_scripts_loc = r'/Users/manusdonahue/Desktop/Projects/BOLD/Scripts/zstatMov'
-    os.chdir(movie_scripts_loc)
-    
-    pt1 = f'./mkZstatMov_part1_v2.sh /Users/manusdonahue/Desktop/Projects/BOLD/Data/{pt_id}'
-    subprocess.run(pt1, check=True, shell=True)
-    
-    mov_filepath = f'/Users/manusdonahue/Desktop/Projects/BOLD/Data/{pt_id}/{pt_id}_zstatMovie.nii.gz'
-    
-    pt2 = f'''/Applications/MATLAB_R2016b.app/bin/matlab -nodesktop -nosplash -r "mkZstatMov_part2_v4('{mov_filepath}')"'''
-    subprocess.run(pt2, check=True, shell=True)
-    # subprocess.run('quit force', check=True, shell=True)
-    
-    os.chdir(original_wd)
-    
-    print(f'\nCVR movie generation complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
-    
 
-if '4' in steps:
+    movie_scripts_loc = os.path.join(BOLD_SCRIPTS, 'zstatMov')
+    pt_folder = os.path.abspath(run.in_folder)
+
+    pt1 = f'./mkZstatMov_part1_v2.sh {pt_folder}'
+    run_logged(pt1, cwd=movie_scripts_loc, log_file=log_file)
+
+    mov_filepath = os.path.join(pt_folder, f'{run.pt_id}_zstatMovie.nii.gz')
+
+    run.backend.call('mkZstatMov_part2_v4', [mov_filepath], cwd=movie_scripts_loc, log_file=log_file)
+
+
+def calculate_metrics(run, log_file=None):
     ##### step 4 : metrics calculation
-    
-    print(f'\nStep 4: calculating metrics')
-    
-    processing_scripts_loc = r'/Users/manusdonahue/Desktop/Projects/BOLD/Scripts/'
-    os.chdir(processing_scripts_loc)
-    
-    cmd = f'''/Applications/MATLAB_R2016b.app/bin/matlab -nodesktop -nosplash -r "Calculate_Metrics('{pt_id}', 1)"'''
-    subprocess.run(cmd, check=True, shell=True)
-    
-    os.chdir(original_wd)
-    
-    print(f'\nMetrics calculation complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
-    
 
-signature_relationships = {('FLAIR_AX', 'T2W_FLAIR'):
-                               {'basename': 'axFLAIR', 'excl':['cor','COR','coronal','CORONAL'], 'isin':'Acquired', 'ext':fig_ext, 'cmap':matplotlib.cm.gray, 'dims':(4,6)}, # THIS NEEDS TO BE UPDATED - the input FLAIR will not always be PAR!
-                           ('CBF_MNI',):
-                               {'basename': 'CBF', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':matplotlib.cm.jet, 'dims':(3,10)},
-                           ('ZSTAT1_MNI_normalized',):
-                               {'basename': 'CVR', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':matplotlib.cm.jet, 'dims':(3,10)},
-                           ('ZMAX2STANDARD_normalized',):
-                               {'basename': 'CVRmax', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':matplotlib.cm.jet, 'dims':(3,10)},
-                           ('TMAX2STANDARD',):
-                               {'basename': 'CVRdelay', 'excl':[], 'isin':'processed', 'ext':'nii.gz', 'cmap':matplotlib.cm.jet, 'dims':(3,10)},
-                          }
-    
-reporting_folder = os.path.join(in_folder, 'reporting_images')
-conversion_folder = os.path.join(reporting_folder, 'gathered')
-if '5' in steps:
+    run.backend.call('Calculate_Metrics', [run.pt_id, 1], cwd=BOLD_SCRIPTS, log_file=log_file)
+
+
+def movie_and_metrics(run, run_movie, run_metrics):
+    """
+    Runs steps 3 and 4. Both only need step 2's outputs, so if both are run
+    they run at the same time, with their output going to logs so it doesn't interleave
+    """
+
+    in_folder = run.in_folder
+    start_stamp = run.start_stamp
+    graph = run.graph
+
+    if run_movie and run_metrics:
+        log_folder = os.path.join(in_folder, 'logs')
+        os.makedirs(log_folder, exist_ok=True)
+        movie_log = os.path.join(log_folder, 'step3_cvr_movie.log')
+        metrics_log = os.path.join(log_folder, 'step4_metrics.log')
+
+        print(f'\nSteps 3 and 4: generating CVR movie and calculating metrics concurrently')
+        print(f'Output is being written to\n\t{movie_log}\n\t{metrics_log}')
+
+        def movie():
+            make_cvr_movie(run, movie_log)
+            graph.mark_done('3') # as soon as it's made, so it's kept if step 4 fails
+
+        def metrics():
+            calculate_metrics(run, metrics_log)
+            graph.mark_done('4')
+
+        parallel_start = time.time()
+        try:
+            elapsed = run_parallel({'3':movie, '4':metrics})
+        finally:
+            wall = time.time() - parallel_start
+
+        print(f'\nCVR movie generation took {round(elapsed["3"]/60, 2)} minutes and metrics calculation took {round(elapsed["4"]/60, 2)} minutes')
+        print(f'Steps 3 and 4 complete in {round(wall/60, 2)} minutes of wall time. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+    else:
+        if run_movie:
+            print(f'\nStep 3: generating CVR movie')
+            make_cvr_movie(run)
+            graph.mark_done('3')
+            print(f'\nCVR movie generation complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+        if run_metrics:
+            print(f'\nStep 4: calculating metrics')
+            calculate_metrics(run)
+            graph.mark_done('4')
+            print(f'\nMetrics calculation complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+
+def reporting_images(run):
     ##### step 5 : reporting image generation
+    import matplotlib
+    import pandas as pd
+    from bold_qc import compute_qc, write_qc
+    from bold_scanner import series_dynamics
+
+    in_folder = run.in_folder
+    decide = run.decide
     ## FLAIR, CBF, CVR, CVRmax, CVRdelay
     # EtCO2 and OEF?
-    
+
     print(f'\nStep 5: generating reporting images')
-    
+
     thresh_names = []
     thresh_vals = []
-    
+
     thresh_file = os.path.join(in_folder, 'thresh_vals.csv')
-    
+
     has_thresh_file = 0
     try:
-        thresh_data = pd.read_csv(thresh_file, header=None, index_col=0)
+        thresh_data = pd.read_csv(thresh_file, header=None, index_col=0).iloc[:, 0]
         has_thresh_file = 1
     except FileNotFoundError:
         has_ans = False
         do_search = False
         while not has_ans:
-            ans = input(f'No thresh file found. Would you like to search for one?\n(y / n)\n')
+            ans = decide.ask('thresh_search', f'No thresh file found. Would you like to search for one?\n(y / n)\n')
             if ans == 'n':
                 has_ans = True
             elif ans =='y':
@@ -324,30 +497,30 @@ if '5' in steps:
                 has_ans = True
             else:
                 print('\nAnswer must be "y" or "n"')
-                
+
         if do_search:
             has_ans = False
             while not has_ans:
-                ans = input(f'The ID basename is {pt_basename}. Please enter a scan number (e.g., 02) that you would like to try to grab a threshhold file from, or cancel.\n(0X / cancel)\n')
-                
+                ans = decide.ask('thresh_scan', f'The ID basename is {pt_basename}. Please enter a scan number (e.g., 02) that you would like to try to grab a threshhold file from, or cancel.\n(0X / cancel)\n')
+
                 if ans == 'cancel':
                     print('Okay. We can make a thresh file from scratch.')
                     has_ans = True
                 elif not ans.isdigit():
                     print('\nAnswer must be composed of digits only.')
                 else:
-                    
+
                     folder_to_look_for = f'{pt_basename}_{ans}'
                     print(f'Searching for folders matching {folder_to_look_for}. This may take a minute....')
-                    
+
                     f1 = '/Users/manusdonahue/Desktop/Projects/BOLD/Data/'
                     f2 = '/Volumes/DonahueDataDrive/Data_sort/IC_Stenosis_Trial_ALL_DATA'
                     potentials = hp.find_all_folders_named(folder_to_look_for, f1)
                     potentials.extend(hp.find_all_folders_named(folder_to_look_for, f2))
-                    
+
                     potential_threshes = [os.path.join(p, 'thresh_vals.csv') for p in potentials]
                     potential_threshes = [p for p in potential_threshes if os.path.exists(p)]
-                    
+
                     if len(potential_threshes) == 0:
                         print("Sorry, I didn't find anything that matches.")
                     else:
@@ -356,14 +529,15 @@ if '5' in steps:
                             print(f'{i}:\n\t{fi}')
                         has_subans = False
                         while not has_subans:
-                            subans = input('Please enter the index of the file you want to use.\n(number / cancel)\n')
+                            subans = decide.ask('thresh_index', 'Please enter the index of the file you want to use.\n(number / cancel)\n')
                             if subans == 'cancel':
                                 has_subans = True
                                 continue
                             try:
                                 winner = potential_threshes[int(subans)]
-                                shutil.copyfile(winner, thresh_file)
-                                thresh_data = pd.read_csv(thresh_file, header=None, index_col=0)
+                                with hp.atomic_output(thresh_file) as tmp_name:
+                                    shutil.copyfile(winner, tmp_name)
+                                thresh_data = pd.read_csv(thresh_file, header=None, index_col=0).iloc[:, 0]
                                 has_thresh_file = 1
                                 has_subans = True
                                 has_ans = True
@@ -372,13 +546,18 @@ if '5' in steps:
                             except ValueError:
                                 print('Your input must be an integer matching the indices displayed or "cancel"')
 
-    if os.path.exists(reporting_folder):
-        shutil.rmtree(reporting_folder)
-    os.mkdir(reporting_folder)
+    # the images are made in a staging folder that replaces the old one when it's complete
+    reporting_folder = hp.staging_folder(run.reporting_folder)
+    conversion_folder = os.path.join(reporting_folder, 'gathered')
     os.mkdir(conversion_folder)
 
+    # gathered files are links to the processed maps rather than copies. the manifest records where each one came from
+    manifest = {}
+
     for signature, subdict in signature_relationships.items():
-        
+
+        ext = subdict['ext'] or run.fig_ext
+
         if has_thresh_file:
             try:
                 cmax = float(thresh_data.loc[subdict['basename']])
@@ -386,36 +565,41 @@ if '5' in steps:
                 cmax=None
         else:
             cmax = None
-            
-        
+
+
         candidates = []
         # note that the signature matching includes the full path. probably not a great idea
         for subsig in signature:
-            where_glob = os.path.join(in_folder, subdict['isin'], "**", f'*{subsig}*.{subdict["ext"]}')
+            where_glob = os.path.join(in_folder, subdict['isin'], "**", f'*{subsig}*.{ext}')
             potential = glob.glob(where_glob, recursive=True)
             potential = [f for f in potential if not any_in_str(f, subdict['excl'])]
             candidates.extend(potential)
-            
+
         if candidates:
             foi = candidates[-1] # pick the last in list. file of interest
         else:
             continue
-        
+
         new_stem = f'{subdict["basename"]}.nii.gz'
         new_name = os.path.join(conversion_folder, new_stem)
-        
-        if subdict['ext'] == 'PAR':
+
+        if ext == 'PAR':
             moved_name = par2nii(foi, conversion_folder)
             os.rename(moved_name, new_name)
         else:
-            shutil.copy(foi, new_name)
-            
+            hp.link_or_copy(foi, new_name)
+        manifest[new_stem] = os.path.abspath(foi)
+
         im_name = os.path.join(reporting_folder, f'{subdict["basename"]}_report_image.png')
-        thresh_vals.append(nii_image(new_name, subdict['dims'], im_name, cmap=subdict['cmap'], cmax=cmax))
+        cmap = getattr(matplotlib.cm, subdict['cmap']) # nii_image checks for matplotlib.cm.gray itself, so this must not be a copy
+        thresh_vals.append(nii_image(new_name, subdict['dims'], im_name, cmap=cmap, cmax=cmax))
         thresh_names.append(subdict["basename"])
-    
+
+    manifest_file = os.path.join(conversion_folder, 'gathered_manifest.csv')
+    pd.Series(manifest, dtype=str).to_csv(manifest_file, header=False)
+
     thresh_dict = {key:val for key,val in zip(thresh_names, thresh_vals)}
-    
+
     if has_thresh_file:
         try:
             thresh_dict['etco2min'] = float(thresh_data.loc['etco2min'])
@@ -426,23 +610,53 @@ if '5' in steps:
     else:
         thresh_dict['etco2min'] = 30
         thresh_dict['etco2max'] = 60
-        
+
     thresh_ser = pd.Series(thresh_dict)
-    thresh_ser.to_csv(thresh_file, header=False)
-    
-    
-    print(f'\nReporting images generated. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
-    
-if '6' in steps:
+    with hp.atomic_output(thresh_file) as tmp_name:
+        thresh_ser.to_csv(tmp_name, header=False)
+
+    # timeseries QC of the BOLD series. the summary figure goes next to the EtCO2 trace in step 6
+    where_glob = os.path.join(in_folder, 'Acquired', "**", f'*BOLD*.{run.fig_ext}')
+    bold_candidates = {}
+    for f in glob.glob(where_glob, recursive=True):
+        try:
+            bold_candidates[f] = series_dynamics(f)
+        except (OSError, ValueError) as e:
+            print(f'Could not read the header of {f} ({e})')
+    bold_candidates = {f:n for f, n in bold_candidates.items() if n > 1} # 3D files aren't timeseries
+    if bold_candidates:
+        bold_series = max(bold_candidates, key=bold_candidates.get) # the series with the most dynamics
+        try:
+            qc = compute_qc(bold_series)
+            write_qc(qc, reporting_folder)
+        except Exception as e:
+            print(f'\n!!!!!\n\nWarning: the BOLD QC of {bold_series} failed ({type(e).__name__}: {e}). The QC summary will not be generated\n\n!!!!!\n')
+    else:
+        print('No 4D BOLD series found in the Acquired folder. The QC summary will not be generated')
+
+    hp.swap_folder(reporting_folder, run.reporting_folder)
+
+
+def make_powerpoint(run):
     ##### step 6: make the powerpoint
-    
+    from pptx import Presentation
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import nibabel as nib
+
+    in_folder = run.in_folder
+    pt_id = run.pt_id
+    dobage = run.dobage
+    reporting_folder = run.reporting_folder
+
     print(f'\nStep 6: generating powerpoint')
-    
+
     # get pt info if available
     has_age = 0
     has_dob = 0
     has_scan_date = 0
-    try:
+    pt_age = 0
+    if dobage is not None:
         if '.' in dobage:
             dob = dobage
             format_str = '%Y.%m.%d' # The format
@@ -451,8 +665,6 @@ if '6' in steps:
         else:
             pt_age = int(dobage)
             has_age = 1
-    except NameError:
-        pt_age = 0
 
     try:
         where_glob = os.path.join(in_folder, 'Acquired', "**", f'*.PAR') # just looking for any PAR
@@ -477,19 +689,19 @@ if '6' in steps:
         read_this_one = potential[-1]
         fob = nib.load(read_this_one)
         head = fob.header
-        
+
         print("Unfortunately NiFTI headers do not seem to store scan dates. You'll have to set it yourself!")
         pt_age = 0
-        
+
 
     if not has_scan_date:
         has_ans = False
         while not has_ans:
-            ans = input(f'No scan date found. You can manually enter it now, or skip it\n(YYYY.mm.dd / skip)\n')
+            ans = run.decide.ask('scan_date', f'No scan date found. You can manually enter it now, or skip it\n(YYYY.mm.dd / skip)\n')
             if ans == 'skip':
                 has_ans = True
             else:
-                try:    
+                try:
                     format_str = '%Y.%m.%d' # The format
                     scan_dt_obj = datetime.datetime.strptime(ans, format_str)
                     has_scan_date = 1
@@ -497,36 +709,35 @@ if '6' in steps:
                     has_ans = True
                 except ValueError:
                     print('\nAnswer must be "skip" or a date formatted as YYYY.mm.dd')
-    
+
 
     if has_scan_date and has_dob:
         pt_age = scan_dt_obj - dob_dt_obj
         pt_age = int(pt_age.days/365.25)
         has_age = 1
-        
-    
-    
+
+
+
     # make the etco2 trace
     thresh_file = os.path.join(in_folder, 'thresh_vals.csv')
     has_thresh_file = 0
     try:
-        thresh_data = pd.read_csv(thresh_file, header=None, index_col=0)    
-        etmin = float(thresh_data.loc['etco2min'])  
+        thresh_data = pd.read_csv(thresh_file, header=None, index_col=0).iloc[:, 0]
+        etmin = float(thresh_data.loc['etco2min'])
         etmax = float(thresh_data.loc['etco2max'])
         has_thresh_file = 1
     except FileNotFoundError:
         print('No thresh file found. Using default threshes for EtCO2 trace.')
         etmin = 30
         etmax = 60
-    
+
+    etco2_file = os.path.join(in_folder, 'etco2.csv')
+    etco2_fig = os.path.join(reporting_folder, 'etco2.png')
     try:
-        etco2_file = os.path.join(in_folder, 'etco2.csv')
-        etco2_fig = os.path.join(reporting_folder, 'etco2.png')
-        
         etco2_data = pd.read_csv(etco2_file)
         dynamics = etco2_data.iloc[:, 0]
         co2 = etco2_data.iloc[:, 1]
-        
+
         plt.figure(figsize=((12,8)))
         plt.plot(dynamics, co2, lw=1)
         plt.scatter(dynamics, co2, color='black')
@@ -534,17 +745,20 @@ if '6' in steps:
         plt.xlabel('Dynamic Scan')
         plt.ylim(etmin, etmax)
         plt.tight_layout()
-        plt.savefig(etco2_fig)
+        with hp.atomic_output(etco2_fig) as tmp_name:
+            plt.savefig(tmp_name)
         plt.close()
     except FileNotFoundError:
         print(f'EtCO2 trace not found. The graph will not be generated and added to report.')
-        
-    
-    template_loc = r'/Users/manusdonahue/Documents/Sky/repositories/scan-reporting/bin/TEMPLATE_BOLD_PLACEHOLDERS.pptx'
-    template_out = os.path.join(in_folder, f'{pt_id}_report.pptx')
-    
-    shutil.copyfile(template_loc, template_out)
-    
+
+
+    template_loc = os.path.join(BIN_FOLDER, 'TEMPLATE_BOLD_PLACEHOLDERS.pptx')
+    # the report is built under a temporary name and published when it's complete
+    report_out = os.path.join(in_folder, f'{pt_id}_report.pptx')
+    template_out = hp.temp_name(report_out)
+
+    hp.copy_template(template_loc, template_out)
+
     replace_in_ppt('PTSTEN_###_##', pt_id, template_out)
     if has_dob:
         replace_in_ppt('dobYYYYmmdd', dob, template_out)
@@ -555,12 +769,12 @@ if '6' in steps:
     if has_scan_date:
         replace_in_ppt('scan_dateYYYYmmdd', sd, template_out)
         print(f'Scan date is {sd}')
-        
+
     # replace_in_ppt('IMAGING', 'it worked!', template_out)
-    
+
     #markup = os.path.join(in_folder, f'{pt_id}_report_MARKUP.pptx')
     #analyze_ppt(template_out, markup)
-    
+
     """
     Slide 3: FLAIR
     Slide 4: CBF
@@ -570,9 +784,9 @@ if '6' in steps:
     Slide 10: CVR video
     Slide 11: EtCO2
     """
-    
+
     pres = Presentation(template_out)
-    
+
     im_names = [os.path.join(reporting_folder, f"{val['basename']}_report_image.png") for key,val in signature_relationships.items()]
     slides = [2, 3, 5, 6, 7]
 
@@ -581,47 +795,51 @@ if '6' in steps:
     movie_slide = 9
     add_ppt_image(pres.slides[movie_slide], movie, insert_type='mov', poster=im_names[0])
     """
-    
+
     etco2_slide = 10
-    
+
     slides.append(etco2_slide)
     im_names.append(etco2_fig)
-    
-    
+
+
     for slide, name in zip(slides, im_names):
         #add_ppt_image_ph(pres.slides[slide], 10, name) # don't ask why idx is 10. it for all the placeholders in this template
         try:
             add_ppt_image(pres.slides[slide], name)
         except FileNotFoundError:
             print(f'\n!!!!!\nWARNING: image {name} not found and could not be added to report\n!!!!!\n')
-    
+
+    qc_fig = os.path.join(reporting_folder, 'bold_qc.png')
+    if os.path.exists(qc_fig):
+        add_ppt_image(pres.slides[etco2_slide], qc_fig, scale=0.6, at=(5.5, 1))
+
     # metrics are written as CSVs in the PSTEN_ID folder called TMAX_metrics and CBF_metrics
     # the values within are ordered as lACA, rACA, lMCA, rMCA, lPCA, rPCA
     # but the origins are MCA, ACA, PCA
 
-    
+
     # plotting values by converting units to positions on a powerpoint slide
     # father forgive me for I must sin
 
     plot_indices = {'MCA':0, 'ACA':1, 'PCA':2}
-    
+
     metric_names = 'lACA, rACA, lMCA, rMCA, lPCA, rPCA'.split(', ')
     plot_on = [i[1:] for i in metric_names]
     lr = [i[0] for i in metric_names]
-    
+
     dot_sides = ['left_dot.png', 'right_dot.png']
     dot_keys = ['l', 'r']
-    dot_dict = {key:os.path.join(r'/Users/manusdonahue/Documents/Sky/repositories/scan-reporting/bin', val) for key,val in zip(dot_keys, dot_sides)}
-    
+    dot_dict = {key:os.path.join(BIN_FOLDER, val) for key,val in zip(dot_keys, dot_sides)}
+
     file_names = ['CBF_metrics.csv', 'TMAX_metrics.csv']
     metrics_files = [os.path.join(in_folder, fn) for fn in file_names]
     slides = [4, 8]
-    
+
     x_units_per_inch = 60 / (3.41 - 0.98) # years per inch
     y_units_per_inch_cbv = 100 / (5.5 - 2.88)
     y_units_per_inch_cvrdelay = 50 / (5.5 - 2.88)
     yupis = [y_units_per_inch_cbv, y_units_per_inch_cvrdelay]
-    
+
     origins_cbv = [[1.03,5.51], [4.56,5.51], [8.10,5.51]] # false origins at (20yrs, 0y_units). must be adjusted
     origins_cvrd = [[0.98,5.51], [4.51,5.51], [8.05,5.51]] # false origins at (20yrs, 0y_units). must be adjusted
     adjustment = 20 / x_units_per_inch
@@ -629,7 +847,7 @@ if '6' in steps:
     for i in origins:
         for j in i:
             j[0] -= adjustment
-    
+
     for fi, slide, yupi, origins in zip(file_names, slides, yupis, origins):
         # print(f'On slide {slide}')
         mets = pd.read_csv(os.path.join(in_folder, fi), index_col=False, header=0)
@@ -637,14 +855,95 @@ if '6' in steps:
         for met, plottype, side in zip(mets, plot_on, lr):
             origin = origins[plot_indices[plottype]]
             image = dot_dict[side]
-            
+
             ad_x = pt_age / x_units_per_inch
             ad_y = met / yupi
-            
+
             plot_dot(pres.slides[slide], image, pt_age, met,
                      origin, x_units_per_inch, yupi, size=0.11)
-            
+
     pres.save(template_out)
-    print(f'\nPowerpoint generated. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+    hp.publish(template_out, report_out)
+
+
+def process(run):
+    """
+    Runs the requested steps of the BOLD pipeline on one patient
+
+
+    Parameters
+    ----------
+    run : BoldRun
+        the run. Steps that are up to date are skipped (see step_graph.py).
+
+    Returns
+    -------
+    BoldRun, filled in.
+
+    """
+
+    if run.graph is None:
+        plan(run)
+    if run.dry_run:
+        return run
+
+    # one run at a time per patient. a run that had to wait replans, as the other run may have brought steps up to date
+    with hp.patient_lock(run.in_folder) as waited:
+        if waited:
+            run.graph.refresh()
+            print(f'\nStep plan:\n{run.graph.describe()}')
+        graph = run.graph
+        try:
+            prepare(run) # inside the try, so a run that fails here still ends its telemetry
+            start_stamp = run.start_stamp
+            if graph.should_run('1'):
+                deidentify(run)
+                graph.mark_done('1')
+                print(f'\nDeidentification complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+            if graph.should_run('2'):
+                main_processing(run)
+                graph.mark_done('2')
+                print(f'\nMain processing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+            movie_and_metrics(run, graph.should_run('3'), graph.should_run('4'))
+
+            if graph.should_run('5'):
+                profiler = stage_profiler('step5_images', run.reporting_folder, run.profile)
+                profiler.start()
+                try:
+                    reporting_images(run)
+                finally:
+                    profiler.stop() # the profile of a failed stage is the one most wanted
+                graph.mark_done('5')
+                print(f'\nReporting images generated. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+            if graph.should_run('6'):
+                profiler = stage_profiler('step6_powerpoint', run.reporting_folder, run.profile)
+                profiler.start()
+                try:
+                    make_powerpoint(run)
+                finally:
+                    profiler.stop()
+                graph.mark_done('6')
+                print(f'\nPowerpoint generated. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+        except BaseException as e:
+            telemetry.finish(ok=False, error=f'{type(e).__name__}: {e}')
+            raise
+
+        telemetry.finish()
+        print(f'\nProcessing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes\n')
+    return run
+
+
+def main(argv=None):
+    """
+    The command line interface. argv defaults to sys.argv[1:]
+    """
+
+    run = parse_args(sys.argv[1:] if argv is None else argv)
+    return process(run)
+
 
-print(f'\nProcessing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes\n')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
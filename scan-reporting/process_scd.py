@@ -32,6 +32,10 @@ input:
     -e / --exclude: subprocessing steps to exclude. The subprocessing steps are
         TRUST (trust), volumetrics (vol) and ASL (asl). To exclude a step, or steps,
         enter the steps to exclude separated by a comma, e.g., -e vol,trust
+    -j / --split: if 1, the TRUST, volumetrics and ASL subprocessing steps that are not excluded
+        are run as separate MATLAB jobs at the same time instead of one after another in a single
+        Master_v2 call. Their output is logged to the logs subfolder of the PTSTEN folder and their
+        results are merged into the usual PROCESSINGresults csv. 0 by default
     -a / --artox: the arterial oxygen saturation from the pulse oximeter, reported as a number between 0 and 1. Only required if generating the report (step 4)
         Fetch from REDCap by passing redcap. default: redcap
     -y / --auto: if 1, will skip some manual prompts and quality checks. 0 by default. Does not skip critical checks or unusual flags. Intended mostly
@@ -44,6 +48,24 @@ input:
     -u / -gender: any string, but typically male or female. If redcap is contacted, the redcap value takes precedence
     -t / --scandate: the date of the scan as YYYY.mm.dd. If redcap is contacted, the redcap value takes precedence
     -x / --studyid: the study ID for the scan (eg., Jordan_1934848). If redcap is contacted, the redcap value takes precedence
+    -z / --force : rerun every requested step, even if its outputs are up to date. does not take an argument
+        by default, a requested step is skipped if its outputs exist and its inputs, the options
+        it uses (e.g., -d) and its answers (see -o) have not changed since it last ran (tracked in step_state.json in the PTSTEN folder). Step 3 always runs if requested
+    -l / --dryrun : list which of the requested steps would run (and why) and exit. does not take an argument
+    -k / --hash : also compare file contents (SHA-1) when deciding if a step is up to date,
+        not just sizes and modification times. does not take an argument
+    -w / --backend : how the MATLAB functions are run. shell (default) starts MATLAB
+        for every call, engine keeps warm MATLAB sessions through the MATLAB Engine API for Python,
+        fake doesn't run MATLAB (for testing). The default can also be set with SCAN_REPORTING_BACKEND
+    -o / --params : a YAML or JSON file of answers to the questions asked during processing.
+        if not given, params.yaml, params.yml or params.json in the PTSTEN folder is used if it exists.
+        see decisions.py for the question keys. answers from parameter files take precedence over --auto
+    -v / --defaults : a YAML or JSON file of cohort-wide default answers, used for questions
+        the patient's parameter file doesn't answer. can also be set with SCAN_REPORTING_DEFAULTS
+    -q / --unattended : never prompt. a question with no answer in the parameter files (or from --auto)
+        stops processing with an error instead. this is also the behavior when answers piped into stdin run out. does not take an argument
+    -m / --profile : profile the PDF report step (4) with cProfile and tracemalloc. the .pstats file
+        and summaries of time and memory allocations are written to reporting/profile. does not take an argument
     -g / --help : brings up this helpful information. does not take an argument
 """
 #     -m / --mrid: the MR ID for the scan (e.g., PTSTEN_180)
@@ -55,21 +77,23 @@ import subprocess
 import time
 import datetime
 import glob
-import shutil
-import requests
 import re
+import functools
+from dataclasses import dataclass, field
 
-import redcap
-import pandas as pd
-from pylab import title, figure, xlabel, ylabel, xticks, bar, legend, axis, savefig
-import matplotlib
-from fpdf import FPDF
-import numpy as np
-import matplotlib.pyplot as plt
+# the heavy dependencies (redcap, requests, pandas, numpy, matplotlib, fpdf) are imported in
+# the stages that use them, so --help, dry runs and deidentification don't wait on them
 
 from helpers import get_terminal, str_time_elapsed
 import helpers as hp
 from report_image_generation import par2nii, nii_image, compare_nii_images
+from step_graph import StepGraph, scd_steps
+from external import SCD_SCRIPTS, SCD_DEIDENTIFY, BIN_FOLDER, run_logged, run_parallel
+from compute_backend import get_backend
+from decisions import DecisionProvider
+import telemetry
+from profiling import stage_profiler
+from scd_split import SUBPROCESSES, job_id, make_job_folder, collect_job_outputs
 
 #sys.exit()
 wizard = """                
@@ -107,372 +131,507 @@ wizard = """
                             \\
                                 """
 
-inp = sys.argv
-bash_input = inp[1:]
-options, remainder = getopt.getopt(bash_input, "i:n:s:h:f:p:e:a:y:r:b:u:t:x:g",
-                                   ["infolder=", "name=", 'steps=', 'hct=', 'flip=', 'pttype=', 'excl=', 'artox=', 'auto=', 'redcap=',
-                                    'dob=', 'gender=', 'scandate=', 'studyid=', 'help'])
-
-
-
-flip = 0
-asl_tr = 4
-auto = 0
-contact_redcap = 1
-
-art_ox_sat = 'redcap'
-hematocrit = 'redcap'
-pt_type_num = 'redcap'
-pt_type = 'redcap'
-
-scan_date = None
-birth_date = None
-gender = None
-
-mrid = None
-study_id = None
-
-
-do_run = {'trust':1,
-          'vol':1,
-          'asl':1
-          }
-
-for opt, arg in options:
-    if opt in ('-i', '--infolder'):
-        in_folder = arg
-    elif opt in ('-n', '--name'):
-        deidentify_name = arg
-    elif opt in ('-r', '--redcap'):
-        contact_redcap = int(arg)
-    elif opt in ('-y', '--auto'):
-        auto = int(arg)
-    elif opt in ('-s', '--steps'):
-        steps = arg
-    elif opt in ('-h', '--hct'):
-        if arg != 'redcap':
-            hematocrit = float(arg)
-            if hematocrit > 1 or hematocrit < 0:
+STEPS = '1234'
+
+REDCAP_API_URL = 'https://redcap.vanderbilt.edu/api/'
+REDCAP_TOKEN_LOC = '/Users/manusdonahue/Desktop/Projects/redcaptoken_scd_real.txt'
+
+mri_cols = ['mr1_mr_id',
+            'mr2_mr_id',
+            'mr3_mr_id',
+            'mr4_mr_id',
+            'mr5_mr_id',
+            'mr6_mr_id'
+            ]
+
+pt_types = {'control':(0, '0', 'non-anemic'),
+            'sca':(1, '1', 'SCD'),
+            'anemia':(1, '2', 'anemia')
+            } # pt type: (pt_type_num, the_num, descrip)
+
+case_controls = {'0':(0, 'non-anemic'),
+                 '1':(1, 'SCD'),
+                 '2':(1, 'anemia')
+                 } # REDCap case_control: (pt_type_num, descrip)
+
+
+@functools.lru_cache(maxsize=4)
+def redcap_project(api_url, token_loc):
+    """
+    The REDCap project for an API url and token file. The connection (and the
+    project metadata it pulls) is made once per process, so a batch of patients
+    doesn't reconnect for each one. Records are not cached: export them from
+    the project when they're needed
+    """
+
+    import redcap
+    token = open(token_loc).read()
+    with telemetry.span('redcap', 'connect'):
+        return redcap.Project(api_url, token)
+
+
+@dataclass
+class ScdRun:
+    """
+    Everything about one run of the SCD pipeline on one patient. The options
+    are the command line options (see help_info); the rest is filled in by
+    prepare(), check_redcap() and the steps
+
+
+    Parameters
+    ----------
+    in_folder : str
+        the PTSTEN folder.
+    deidentify_name : str, optional
+        the patient name to deidentify. Only needed for step 1.
+    steps : str, optional
+        the steps to run. '0' means all of them. The default is STEPS.
+    hematocrit, art_ox_sat : float or str, optional
+        as -h and -a, a float between 0 and 1 or 'redcap'. The default is 'redcap'.
+    pt_type : str, optional
+        as -p, 'sca', 'anemia', 'control' or 'redcap'. The default is 'redcap'.
+    exclude : list of str, optional
+        as -e, the subprocessing steps not to run. The default is None.
+    flip, split, auto, contact_redcap : int, optional
+        as -f, -j, -y and -r.
+    birth_date, gender, scan_date, study_id : str, optional
+        as -b, -u, -t and -x. The default is None.
+    force, dry_run, use_hash, unattended, profile : bool, optional
+        as -z, -l, -k, -q and -m. The default is False.
+    backend_name : str, optional
+        as -w. The default is None (SCAN_REPORTING_BACKEND).
+    params_file, defaults_file : str, optional
+        as -o and -v. The default is None.
+    command : str, optional
+        how the run was started, written to meta.txt. The default is None (built from the options).
+
+    """
+
+    in_folder: str
+    deidentify_name: str = None
+    steps: str = STEPS
+    hematocrit: object = 'redcap'
+    art_ox_sat: object = 'redcap'
+    pt_type: str = 'redcap'
+    exclude: list = None
+    flip: int = 0
+    split: int = 0
+    auto: int = 0
+    contact_redcap: int = 1
+    birth_date: str = None
+    gender: str = None
+    scan_date: str = None
+    study_id: str = None
+    force: bool = False
+    dry_run: bool = False
+    use_hash: bool = False
+    backend_name: str = None
+    params_file: str = None
+    defaults_file: str = None
+    unattended: bool = False
+    profile: bool = False
+    command: str = None
+
+    # filled in from pt_type, or from REDCap by check_redcap()
+    pt_type_num: object = field(default='redcap', init=False)
+    the_num: str = field(default=None, init=False)
+    descrip: str = field(default=None, init=False)
+    do_run: dict = field(default=None, init=False)
+
+    # filled in by prepare() and check_redcap()
+    pt_id: str = field(default=None, init=False)
+    graph: StepGraph = field(default=None, init=False, repr=False)
+    backend: object = field(default=None, init=False, repr=False)
+    decide: DecisionProvider = field(default=None, init=False, repr=False)
+    start_stamp: float = field(default=None, init=False)
+    name_in_redcap: bool = field(default=False, init=False)
+    scan_index: int = field(default=None, init=False)
+    scan_mr_col: str = field(default=None, init=False)
+    redcap_data: object = field(default=None, init=False, repr=False) # the REDCap records indexed by study_id
+    redcap_row: object = field(default=None, init=False, repr=False) # this scan's record
+
+    # filled in by step 2
+    asl_pld: object = field(default=None, init=False)
+    asl_ld: object = field(default=None, init=False)
+    asl_tr: float = field(default=4, init=False)
+
+    def __post_init__(self):
+        if self.steps == '0':
+            self.steps = STEPS
+
+        if self.hematocrit != 'redcap':
+            self.hematocrit = float(self.hematocrit)
+            if self.hematocrit > 1 or self.hematocrit < 0:
                 raise Exception('Hematocrit must be between 0 and 1')
-        else:
-            hematocrit = arg
-    elif opt in ('-f', '--flip'):
-        flip = int(arg)
-    elif opt in ('-p', '--pttype'):
-        pt_type = arg
-        if pt_type == 'control':
-            pt_type_num = 0
-            the_num = '0'
-            descrip = 'non-anemic'
-        elif pt_type == 'sca':
-            pt_type_num = 1
-            the_num = '1'
-            descrip = 'SCD'
-        elif pt_type == 'anemia':
-            pt_type_num = 1
-            the_num = '2'
-            descrip = 'anemia'
-        elif pt_type == 'redcap':
-            pt_type_num = pt_type
-        else:
+        if self.art_ox_sat != 'redcap':
+            self.art_ox_sat = float(self.art_ox_sat)
+            if self.art_ox_sat > 1 or self.art_ox_sat < 0:
+                raise Exception('Arterial oxygenation fraction must be between 0 and 1')
+
+        if self.pt_type in pt_types:
+            self.pt_type_num, self.the_num, self.descrip = pt_types[self.pt_type]
+        elif self.pt_type != 'redcap':
             raise Exception('Patient type must be "sca", "control" or "anemia"')
-    elif opt in ('-e', '--excl'):
-        parsed_excl = arg.split(',')
-        for p in parsed_excl:
-            if p not in do_run:
+
+        self.do_run = {'trust':1,
+                       'vol':1,
+                       'asl':1
+                       }
+        for p in (self.exclude or []):
+            if p not in self.do_run:
                 raise ValueError('Input for -e/--excl must contain only the processes to exclude (trust, vol or asl) separated by a comma with no spaces\ne.g., vol,trust')
-            do_run[p] = 0
-    elif opt in ('-g', '--help'):
-        print(help_info)
-        sys.exit()
-    elif opt in ('-a', '--artox'):
-        if arg != 'redcap':
-            art_ox_sat = float(arg)
-            if art_ox_sat > 1 or art_ox_sat < 0:
-                raise Exception('Arterial oxygenation fraction must be between 0 and 1')
-        else:
-            art_ox_sat = arg
-
-    elif opt in ('-b', '--dob'):
-        birth_date = arg
-    elif opt in ('-u', '--gender'):
-        gender = arg
-    elif opt in ('-t', '--scandate'):
-        scan_date = arg
-    elif opt in ('-x', '--studyid'):
-        study_id = arg
+            self.do_run[p] = 0
+
+    @property
+    def reporting_folder(self):
+        return os.path.join(self.in_folder, 'reporting')
+
+    def describe_command(self):
+        """
+        The command line equivalent of the run, with the patient name redacted
+        """
+
+        if self.command is not None:
+            return self.command
+        parts = ['process_scd.py', '-i', self.in_folder, '-s', self.steps,
+                 '-h', str(self.hematocrit), '-p', self.pt_type, '-a', str(self.art_ox_sat)]
+        if self.deidentify_name is not None:
+            parts.extend(['-n', '[REDACTED]'])
+        if self.exclude:
+            parts.extend(['-e', ','.join(self.exclude)])
+        return ' '.join(parts)
+
+
+def parse_args(argv):
     """
-    elif opt in ('-m', '--mrid'):
-        steps = arg
+    Builds a ScdRun from command line arguments (without the program name)
     """
 
-try:
-    if steps == '0':
-        steps = '1234'
-except NameError:
-    print('-s not specified. running all steps')
-    steps = '1234'
-        
-try:
-    assert os.path.isdir(in_folder)
-except AssertionError:
-    raise AssertionError('input folder does not exist')
-
-start_stamp = time.time()
-now = datetime.datetime.now()
-pretty_now = now.strftime("%Y-%m-%d %H:%M:%S")
-
-inp_copy = inp.copy()
-for i, s in enumerate(inp_copy):
-    if s == '-n' or s== '--name':
-        inp_copy[i+1] = '[REDACTED]'
-
-thecommand = ' '.join(inp_copy)
-meta_file_name = os.path.join(in_folder, 'meta.txt')
-meta_file = open(meta_file_name, 'w')
-meta_file.write(f'Processing started {pretty_now}')
-meta_file.write('\n\n')
-meta_file.write(thecommand)
-meta_file.close()
-
-print(f'\nBegin processing: {pretty_now}')
-
-
-acq_folder = os.path.join(in_folder, 'Acquired')
-orig_files = [os.path.join(acq_folder, f) for f in os.listdir(acq_folder) if os.path.isfile(os.path.join(acq_folder, f))]
-extensions = [f.split('.')[-1] for f in orig_files]
-guess_ext = hp.most_common(extensions)
-
-orig_data_copy_folder = os.path.join(in_folder, 'rawdata')
-    
-dcm_exts = ['dcm', 'DCM']
-parrec_exts = ['PAR', 'REC', 'V41', 'XML']
-nii_exts = ['nii', 'gz']
-
-if guess_ext in parrec_exts:
-    print('Input files seem to be PARREC - proceeding as normal')
-elif guess_ext in dcm_exts:
-    print('Input files seem to be DICOM - converting to PARREC before continuing (original DICOMs will be retained)')
-    shutil.copytree(acq_folder, orig_data_copy_folder)
-    shutil.rmtree(acq_folder)
-    os.mkdir(acq_folder)
-    
-    moved_files = [os.path.join(orig_data_copy_folder, f) for f in os.listdir(orig_data_copy_folder) if os.path.isfile(os.path.join(orig_data_copy_folder, f))]
-    moved_extensions = [f.split('.')[-1] for f in orig_files]
-    for fi, ext in zip(moved_files, moved_extensions):
-        if ext in dcm_exts:
-            #print(f'\n\n\nCONVERTING: {fi}')
-            hp.dicom_to_parrec(fi, acq_folder)      
-elif guess_ext in nii_exts:
-    has_ans = False
-    while not has_ans:
-        if not auto:
-            ans = input(f'Input files seem to be NiFTI. ASL processing of NiFTIs is in an UNSTABLE BETA state.\nRESULTS MUST BE MANUALLY INSPECTED FOR CORRECTNESS.\nAlso note that volumetric calculations may be differ slightly from those obtained from the PARREC pipeline.\nPlease acknowledge this or cancel processing. [acknowledge/cancel]\n')
-        else:
-            ans = 'acknowledge'
-            print(f'Auto response: {ans}')
-        if ans in ('acknowledge', 'cancel'):
-            has_ans = True
-            if ans == 'cancel':
-                raise Exception('Aborting processing')
-            elif ans == 'acknowledge':
-                print('Continuing with beta processing of NiFTIs')
-                #raise Exception('SORRY! NiFTI processing not yet fully implemented in the process_scd.py pipeline')
-        else:
-            print('Answer must be "acknowledge" or "cancel"')
-else:
-    raise Exception(f'Filetype ({guess_ext}) does not seem to be supported')
+    options, remainder = getopt.getopt(argv, "i:n:s:h:f:p:e:j:a:y:r:b:u:t:x:w:o:v:gzlkqm",
+                                       ["infolder=", "name=", 'steps=', 'hct=', 'flip=', 'pttype=', 'excl=', 'split=', 'artox=', 'auto=', 'redcap=',
+                                        'dob=', 'gender=', 'scandate=', 'studyid=', 'help', 'force', 'dryrun', 'hash', 'backend=',
+                                        'params=', 'defaults=', 'unattended', 'profile'])
 
+    kwargs = {}
+    for opt, arg in options:
+        if opt in ('-i', '--infolder'):
+            kwargs['in_folder'] = arg
+        elif opt in ('-n', '--name'):
+            kwargs['deidentify_name'] = arg
+        elif opt in ('-r', '--redcap'):
+            kwargs['contact_redcap'] = int(arg)
+        elif opt in ('-y', '--auto'):
+            kwargs['auto'] = int(arg)
+        elif opt in ('-s', '--steps'):
+            kwargs['steps'] = arg
+        elif opt in ('-h', '--hct'):
+            kwargs['hematocrit'] = arg
+        elif opt in ('-f', '--flip'):
+            kwargs['flip'] = int(arg)
+        elif opt in ('-p', '--pttype'):
+            kwargs['pt_type'] = arg
+        elif opt in ('-e', '--excl'):
+            kwargs['exclude'] = arg.split(',')
+        elif opt in ('-j', '--split'):
+            kwargs['split'] = int(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+        elif opt in ('-a', '--artox'):
+            kwargs['art_ox_sat'] = arg
+        elif opt in ('-b', '--dob'):
+            kwargs['birth_date'] = arg
+        elif opt in ('-u', '--gender'):
+            kwargs['gender'] = arg
+        elif opt in ('-t', '--scandate'):
+            kwargs['scan_date'] = arg
+        elif opt in ('-x', '--studyid'):
+            kwargs['study_id'] = arg
+        elif opt in ('-z', '--force'):
+            kwargs['force'] = True
+        elif opt in ('-l', '--dryrun'):
+            kwargs['dry_run'] = True
+        elif opt in ('-k', '--hash'):
+            kwargs['use_hash'] = True
+        elif opt in ('-w', '--backend'):
+            kwargs['backend_name'] = arg
+        elif opt in ('-o', '--params'):
+            kwargs['params_file'] = arg
+        elif opt in ('-v', '--defaults'):
+            kwargs['defaults_file'] = arg
+        elif opt in ('-q', '--unattended'):
+            kwargs['unattended'] = True
+        elif opt in ('-m', '--profile'):
+            kwargs['profile'] = True
 
-original_wd = os.getcwd()
-pt_id = replacement = get_terminal(in_folder) # if the input folder is named correctly, it is the ID that will replace the pt name
+    if 'steps' not in kwargs:
+        print('-s not specified. running all steps')
+    if 'in_folder' not in kwargs:
+        raise AssertionError('input folder (-i) is required')
+
+    command = ['process_scd.py'] + list(argv)
+    for i, s in enumerate(command[:-1]):
+        if s == '-n' or s == '--name':
+            command[i+1] = '[REDACTED]'
+    kwargs['command'] = ' '.join(command)
+
+    return ScdRun(**kwargs)
+
+
+def plan(run):
+    """
+    Reads the run's answers to processing questions, builds its step graph
+    and prints what would run
+    """
+
+    try:
+        assert os.path.isdir(run.in_folder)
+    except AssertionError:
+        raise AssertionError('input folder does not exist')
+
+    run.pt_id = get_terminal(run.in_folder) # if the input folder is named correctly, it is the ID that will replace the pt name
+    # the answers are read here, as a changed answer (or option) means a step is out of date
+    run.decide = DecisionProvider.for_patient(run.in_folder, 'scd', run.params_file, run.defaults_file, auto=bool(run.auto), unattended=run.unattended)
+    params = {name:getattr(run, name) for name in ['hematocrit', 'art_ox_sat', 'pt_type', 'exclude', 'flip', 'auto', 'birth_date', 'gender', 'scan_date', 'study_id']}
+    run.graph = StepGraph(run.in_folder, scd_steps(run.pt_id), run.steps, force=run.force, use_hash=run.use_hash,
+                          params=params, decide=run.decide)
+    print(f'\nStep plan:\n{run.graph.describe()}')
+    return run.graph
+
+
+def prepare(run):
+    """
+    Sets up a run: the MATLAB backend, telemetry and meta.txt, then checks (and if needed converts) the raw scans
+    """
+
+    if run.graph is None:
+        plan(run)
+    in_folder = run.in_folder
+
+    run.backend = get_backend(run.backend_name)
+    telemetry.configure(in_folder, 'scd')
+
+    run.start_stamp = time.time()
+    now = datetime.datetime.now()
+    pretty_now = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    hp.clean_partial(in_folder, [run.reporting_folder])
+
+    meta_file_name = os.path.join(in_folder, 'meta.txt')
+    with hp.atomic_output(meta_file_name) as tmp_name:
+        with open(tmp_name, 'w') as meta_file:
+            meta_file.write(f'Processing started {pretty_now}')
+            meta_file.write('\n\n')
+            meta_file.write(run.describe_command())
+
+    print(f'\nBegin processing: {pretty_now}')
+
+    acq_folder = os.path.join(in_folder, 'Acquired')
+    orig_data_copy_folder = os.path.join(in_folder, 'rawdata')
+    orig_files = [os.path.join(acq_folder, f) for f in sorted(os.listdir(acq_folder)) if os.path.isfile(os.path.join(acq_folder, f))]
+    if os.path.isdir(orig_data_copy_folder) and not hp.dicom_conversion_done(acq_folder, orig_data_copy_folder):
+        # an earlier conversion from DICOM was cut short, so it's redone from the copy of the DICOMs
+        orig_files = [os.path.join(orig_data_copy_folder, f) for f in sorted(os.listdir(orig_data_copy_folder))
+                      if os.path.isfile(os.path.join(orig_data_copy_folder, f))]
+    extensions = [f.split('.')[-1] for f in orig_files]
+    guess_ext = hp.most_common(extensions)
+
+    dcm_exts = ['dcm', 'DCM']
+    parrec_exts = ['PAR', 'REC', 'V41', 'XML']
+    nii_exts = ['nii', 'gz']
+
+    if guess_ext in parrec_exts:
+        print('Input files seem to be PARREC - proceeding as normal')
+    elif guess_ext in dcm_exts:
+        print('Input files seem to be DICOM - converting to PARREC before continuing (original DICOMs will be retained)')
+        hp.convert_dicom_folder(acq_folder, orig_data_copy_folder, dcm_exts)
+    elif guess_ext in nii_exts:
+        has_ans = False
+        while not has_ans:
+            ans = run.decide.ask('nifti_beta', f'Input files seem to be NiFTI. ASL processing of NiFTIs is in an UNSTABLE BETA state.\nRESULTS MUST BE MANUALLY INSPECTED FOR CORRECTNESS.\nAlso note that volumetric calculations may be differ slightly from those obtained from the PARREC pipeline.\nPlease acknowledge this or cancel processing. [acknowledge/cancel]\n',
+                                 auto_answer='acknowledge')
+            if ans in ('acknowledge', 'cancel'):
+                has_ans = True
+                if ans == 'cancel':
+                    raise Exception('Aborting processing')
+                elif ans == 'acknowledge':
+                    print('Continuing with beta processing of NiFTIs')
+                    #raise Exception('SORRY! NiFTI processing not yet fully implemented in the process_scd.py pipeline')
+            else:
+                print('Answer must be "acknowledge" or "cancel"')
+    else:
+        raise Exception(f'Filetype ({guess_ext}) does not seem to be supported')
+
+    return run
+
+
+def check_redcap(run):
+    """
+    Checks that the patient (pt_id) is in the REDCap database, and fills in
+    the hematocrit, patient type and arterial oxygen saturation from it where
+    they were given as 'redcap'. Sets run.name_in_redcap
+    """
+
+    import requests
+    import pandas as pd
+
+    pt_id = run.pt_id
+    decide = run.decide
 
-name_in_redcap = False
-if contact_redcap:
-    # check the redcap database to make sure the folder name is (pt_id) is in the redcap database
-    
     print('\nContacting the REDCap database...')
-    
-    name_in_redcap = True
-    
+
+    run.name_in_redcap = True
+
     try:
-        api_url = 'https://redcap.vanderbilt.edu/api/'
-        token_loc = '/Users/manusdonahue/Desktop/Projects/redcaptoken_scd_real.txt'
-        token = open(token_loc).read()
-        
-        project = redcap.Project(api_url, token)
-        project_data_raw = project.export_records()
+        project = redcap_project(REDCAP_API_URL, REDCAP_TOKEN_LOC)
+        with telemetry.span('redcap', 'export_records'):
+            project_data_raw = project.export_records()
         project_data = pd.DataFrame(project_data_raw)
-        
-        mri_cols = ['mr1_mr_id',
-                    'mr2_mr_id',
-                    'mr3_mr_id',
-                    'mr4_mr_id',
-                    'mr5_mr_id',
-                    'mr6_mr_id'
-                    ]
-    
-        
+
         which_scan = [pt_id in list(project_data[i]) for i in mri_cols]
-        
+
         if not any(which_scan):
             has_ans = False
             while not has_ans:
                 print(f'The mr_id ({pt_id}) was not found in the REDCap database')
                 print("You can still process this data, but you won't be able to push the results to REDCap automatically, and I won't be able to find the patient's hct.")
-                ans = input('Is this okay? [y/n]\n')
+                ans = decide.ask('redcap_missing', 'Is this okay? [y/n]\n')
                 if ans in ('y','n'):
                     has_ans = True
                     if ans == 'n':
                         raise Exception('Aborting processing')
                     elif ans == 'y':
                         print(f'Continuing with processing. Remember to fix the discrepancy between the local and REDCap mr_id values.')
-                        if 'redcap' in [hematocrit, pt_type_num]:
+                        if 'redcap' in [run.hematocrit, run.pt_type_num]:
                             raise Exception('Cannot use pull hct or pt type from REDCap without a database connection')
                         time.sleep(3)
-                        name_in_redcap = False
+                        run.name_in_redcap = False
                 else:
                     print('Answer must be "y" or "n"')
         else:
             if sum(which_scan) > 1:
                 raise Exception(f'The patient id ({pt_id}) appears in more than one mr_id column in the REDCap database\n{[(i,j) for i,j in zip(mri_cols, which_scan)]}\nPlease correct the database')
-            
+
             has_ans = False
             while not has_ans:
                 print(f"MR ID {pt_id} appears to correspond to MR scan column {which_scan.index(True)+1} for this patient.")
                 print(f'(the mr_id was found in column {mri_cols[which_scan.index(True)]})')
-                if not auto:
-                    ans = input(f'Please confirm that this is correct, especially if you intend to push processing results to REDCap or are using the database values for hct/pt type. [y/n]\n')
-                else:
-                    ans = 'y'
-                    print(f'Auto response: {ans}')
+                ans = decide.ask('redcap_scan_confirm', f'Please confirm that this is correct, especially if you intend to push processing results to REDCap or are using the database values for hct/pt type. [y/n]\n',
+                                 auto_answer='y')
                 if ans in ('y','n'):
                     has_ans = True
                     if ans == 'n':
                         raise Exception('Aborting processing')
                     elif ans == 'y':
-                        scan_index = which_scan.index(True)
-                        scan_mr_col = mri_cols[scan_index]
-                        studyid_index_data = project_data.set_index('study_id')
-                        
+                        scan_index = run.scan_index = which_scan.index(True)
+                        scan_mr_col = run.scan_mr_col = mri_cols[scan_index]
+                        studyid_index_data = run.redcap_data = project_data.set_index('study_id')
+
                         inds = studyid_index_data[scan_mr_col] == pt_id
                         cands = studyid_index_data[inds]
-                        
+
                         if len(cands) != 1:
                             raise Exception(f'There are {len(cands)} mr_id candidates in the database. There must be exactly one')
-                        
-                        study_id = cands.index[0]
-                        
-                        try:
-                            if hematocrit == 'redcap':
-                                try:
-                                    hematocrit = float(cands.iloc[0][f'blood_draw_hct{scan_index+1}'])/100
-                                except ValueError:
-                                    raise Exception(f'There is no hct value in blood_draw_hct{scan_index+1} in REDCap')
-                                print(f'The study hematocrit I found is {hematocrit}')
-                        except NameError:
-                            pass
-                          
-                        try:
-                            if pt_type_num == 'redcap':
-                                the_num = cands.iloc[0]['case_control']
-                                if the_num == '0':
-                                    pt_type_num = 0
-                                    descrip = 'non-anemic'
-                                elif the_num == '1':
-                                    pt_type_num = 1
-                                    descrip = 'SCD'
-                                elif the_num == '2':
-                                    pt_type_num = 1
-                                    descrip = 'anemia'
-                                print(f'The patient type I found is {the_num} ({descrip})')
-                            print(f'The study id is {study_id}')
-                        except NameError:
-                            pass
-                        
-                        try:
-                            if art_ox_sat == 'redcap':
-                                try:
-                                    art_ox_sat = float(cands.iloc[0][f'mr{scan_index+1}_pulse_ox_result'])/100
-                                except ValueError:
-                                    raise Exception(f'There is no pulse ox (arterial ox sat) value in mr{scan_index+1}_pulse_ox_result in REDCap')
-                                print(f'The study pulse ox (arterial ox sat) I found is {art_ox_sat}')
-                        except NameError:
-                            pass
-                        
+
+                        run.study_id = cands.index[0]
+                        run.redcap_row = cands.iloc[0]
+
+                        if run.hematocrit == 'redcap':
+                            try:
+                                run.hematocrit = float(cands.iloc[0][f'blood_draw_hct{scan_index+1}'])/100
+                            except ValueError:
+                                raise Exception(f'There is no hct value in blood_draw_hct{scan_index+1} in REDCap')
+                            print(f'The study hematocrit I found is {run.hematocrit}')
+
+                        if run.pt_type_num == 'redcap':
+                            run.the_num = cands.iloc[0]['case_control']
+                            if run.the_num in case_controls:
+                                run.pt_type_num, run.descrip = case_controls[run.the_num]
+                            print(f'The patient type I found is {run.the_num} ({run.descrip})')
+                        print(f'The study id is {run.study_id}')
+
+                        if run.art_ox_sat == 'redcap':
+                            try:
+                                run.art_ox_sat = float(cands.iloc[0][f'mr{scan_index+1}_pulse_ox_result'])/100
+                            except ValueError:
+                                raise Exception(f'There is no pulse ox (arterial ox sat) value in mr{scan_index+1}_pulse_ox_result in REDCap')
+                            print(f'The study pulse ox (arterial ox sat) I found is {run.art_ox_sat}')
+
                         time.sleep(3)
-                        
+
                 else:
                     print('Answer must be "y" or "n"')
     except requests.exceptions.RequestException:
         print(f"Could not make contact with the REDCap database. You won't be able to push data to REDCap automatically")
         print("This is usually due to lack of internet connection or REDCap being down")
-        name_in_redcap = False
+        run.name_in_redcap = False
         time.sleep(3)
 
-if '1' in steps:
+    return run.name_in_redcap
+
+
+def deidentify(run):
     ##### step 1 : deidentification
-    
+    in_folder = run.in_folder
+    deidentify_name = run.deidentify_name
+    replacement = run.pt_id
+
     try:
         assert type(deidentify_name) == str
     except AssertionError:
         raise AssertionError('patient name must be a string')
-        
-    files_of_interest = os.listdir(os.path.join(in_folder, 'acquired'))
+
+    files_of_interest = os.listdir(os.path.join(in_folder, 'Acquired'))
     has_deid_name = any([deidentify_name in f for f in files_of_interest])
     if not has_deid_name:
         has_ans = False
         while not has_ans:
-            ans = input(f'\nName "{deidentify_name}" not found in acquired folder. Would you like to proceed anyway? [y/n/change]\n')
+            ans = run.decide.ask('deidentify_missing', f'\nName "{deidentify_name}" not found in acquired folder. Would you like to proceed anyway? [y/n/change]\n')
             if ans in ('y','n', 'change'):
                 has_ans = True
                 if ans == 'n':
                     raise Exception('Aborting processing')
                 elif ans == 'change':
-                    deidentify_name = input(f'Enter a new deidentification string to replace {deidentify_name}:\n')
+                    deidentify_name = run.deidentify_name = run.decide.ask('deidentify_new_name', f'Enter a new deidentification string to replace {deidentify_name}:\n')
             else:
                 print('Answer must be "y", "n" or "change')
-        
+
     print(f'\nStep 1: deidentification. {deidentify_name} will be replaced with {replacement}')
-        
+
     # build the call to the deidentify script
-    deid_scripts_loc = r'/Users/manusdonahue/Desktop/Projects/SCD/Processing/deidentifySLW/'
-    
+    deid_scripts_loc = SCD_DEIDENTIFY
+
     strip_filename_input = f'deidentifyFileNames.sh {in_folder} {deidentify_name} {replacement}'
     strip_header_input = f'deidentifyPARfiles.sh {in_folder}'
-    
+
     deid_commands = [os.path.join(deid_scripts_loc, c) for c in (strip_filename_input, strip_header_input)]
-    
+
     for com in deid_commands:
-        subprocess.run([com], check=True, shell=True)
-        
-    print(f'\nDeidentification complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+        run_logged(com, cwd=None)
+
+
+def asl_parameters(run):
+    """
+    Finds the PLD, LD and TR of the pCASL scan and has them confirmed.
+    Sets run.asl_pld, run.asl_ld and run.asl_tr
+    """
+
+    decide = run.decide
+    acquired_folder = os.path.join(run.in_folder, 'Acquired')
 
-if '2' in steps:    
-    ##### step 2 : main processing
-    
-    print(f'Step 2: begin main processing sequence\n')
-    
-    acquired_folder = os.path.join(in_folder, 'Acquired')
-    
-    
     globber_pld = os.path.join(acquired_folder,'*_PLD*')
     globber_ld = os.path.join(acquired_folder,'*_LD*')
-    
-    names_with_pld = glob.glob(globber_pld)
-    names_with_ld = glob.glob(globber_ld)
-    
+
+    names_with_pld = sorted(glob.glob(globber_pld)) # sorted so the PAR comes before the REC
+    names_with_ld = sorted(glob.glob(globber_ld))
+
 
     if len(names_with_pld) == 0 or len(names_with_ld) == 0:
         print('No PLD/LD signature detected, implying a lack of ASL data. If you intend to run ASL processing this will be an issue.')
 
         has_ans = False
         while not has_ans:
-            if not auto:
-                ans = input(f'\nWould you like to proceed anyway? [y/n]\n')
-            else:
-                ans = 'y'
-                print(f'Auto response: {ans}')
+            ans = decide.ask('asl_missing', f'\nWould you like to proceed anyway? [y/n]\n', auto_answer='y')
             if ans in ('y','n'):
                 has_ans = True
                 if ans == 'n':
@@ -481,25 +640,25 @@ if '2' in steps:
                     print('Continuing. TR, PLD and PL will be set to 0 but can be manually adjusted.')
             else:
                 print('Answer must be "y" or "n"')
-                
+
         pld_name = 'NOT FOUND'
         candidate_line = 'NOT FOUND'
         tr = pld = ld = 0
-        
+
     else:
         pld_name = names_with_pld[0]
         ld_name = names_with_ld[0]
-        
+
         if pld_name != ld_name:
             raise Exception(f'\n{pld_name} != {ld_name}\nPLD and LD parameters not found in same file. Please configure filenames so PLD and LD are specified in the pCASL source file')
-            
+
         if 'PAR' in pld_name or 'REC' in pld_name:
             pcasl_meta = open(pld_name)
             pcasl_lines = pcasl_meta.read().split('\n')
             candidate_lines = [i for i in pcasl_lines if 'Repetition time' in i]
             candidate_line = candidate_lines[0]
             candidate_broken = candidate_line.split(' ')
-        
+
             tr = None
             for c in candidate_broken:
                 try:
@@ -512,35 +671,30 @@ if '2' in steps:
             candidate_line = 'There is no candidate line for tr for non-PARREC files'
             print("Just so you know, I can't extract the repetition time (tr) from non-PARREC files")
             print("tr is generally 4 seconds, so I've set it for you. You can still change it though.")
-        
+
         pld_split = pld_name.split('_')
         ld_split = ld_name.split('_')
-        
-        
+
+
         plds = [i for i in pld_split if 'PLD' in i]
         lds = [i for i in ld_split if ('LD' in i and 'PLD' not in i)]
-        
+
         pld = plds[0][3:]
         ld = lds[0][2:]
-        
+
     has_ans = False
     while not has_ans:
-        print(f'\nFound asl_pld: {pld}\nFound asl_ld: {ld}\nFound asl_tr: {tr}\nIs this okay? (y/n/show)\n')
-        if not auto:
-            ans = input()
-        else:
-            ans = 'y'
-            print(f'Auto response: {ans}')
+        ans = decide.ask('asl_params', f'\nFound asl_pld: {pld}\nFound asl_ld: {ld}\nFound asl_tr: {tr}\nIs this okay? (y/n/show)\n', auto_answer='y')
         if ans == 'y':
             has_ans = True
             asl_pld = pld
             asl_ld = ld
             asl_tr = tr
         elif ans == 'n':
-            asl_pld_hold = input('What should asl_pld be?\n')
-            asl_ld_hold = input('What should asl_ld be?\n')
-            asl_tr_hold = input('What should asl_tr be (in seconds)?\n')
-            
+            asl_pld_hold = decide.ask('asl_pld', 'What should asl_pld be?\n')
+            asl_ld_hold = decide.ask('asl_ld', 'What should asl_ld be?\n')
+            asl_tr_hold = decide.ask('asl_tr', 'What should asl_tr be (in seconds)?\n')
+
             try:
                 asl_pld = int(asl_pld_hold)
                 asl_ld = int(asl_ld_hold)
@@ -553,98 +707,141 @@ if '2' in steps:
             print(f'TR line: {candidate_line}')
         else:
             print('Answer must be y, n or show')
-            
-    
+
+
     if None in [asl_tr, asl_pld, asl_ld]:
         raise Exception('TR, PLD and LD all must be defined (cannot be None)')
-        
-        
-    if do_run['trust']:
-        # if we're running trust, make sure the trust source image has TRUST_VEIN in the filename.
-        # otherwise the MATLAB script will break
-        
-        globber_trustsource = os.path.join(acquired_folder,'*SOURCE*TRUST*')
-        names_with_trustsource = glob.glob(globber_trustsource)
-        
-        try:
-            trustsource = names_with_trustsource[0]
-        except IndexError:
-            raise Exception('\nIt appears you do not have a source file for TRUST (pattern: *SOURCE*TRUST*)\nEither add this file to the folder, or exclude TRUST processing')
-        
-        tv = 'TRUST_VEIN'
-        if tv in trustsource:
-            print(f'\nTRUST source\n----- {trustsource} -----\nis formatted correctly')
-        else:
-            print(f'\nWARNING: TRUST source\n----- {trustsource} -----\nis NOT formatted correctly')
-            has_ans = False
-            while not has_ans:
-                if not auto:
-                    ans = input(f'\nI can try to fix the filenames for you, or you can exit processing and do it yourself. [fix/exit/info]\n')
-                else:
-                    ans = 'fix'
-                    print(f'Auto response: {ans}')
-                if ans in ('fix','exit','info'):
-                    if ans == 'exit':
-                        has_ans = True
-                        raise Exception('Aborting processing')
-                    elif ans == 'fix':
-                        print('Okay. Renaming the files for you.')
-                        
-                        base = os.path.basename(trustsource)
-                        base = base.split('.')[0]
-                        globber_base = os.path.join(acquired_folder,f'{base}.*')
-                        names_with_base = glob.glob(globber_base)
-                        
-                        for path in names_with_base:
-                            
-                            path_break = path.split('TRUST')
-                            new_path = 'TRUST_VEIN'.join(path_break)
-                            
-                            print(f'\n{path}\nto\n{new_path}\n')
-                            os.rename(path, new_path)
-                        
-                        for line in wizard.splitlines():
-                            print(line)
-                            time.sleep(0.05)
-                        print('magically fixed, free of charge\n')
-                        time.sleep(0.5)
-                        has_ans = True
-                    else:
-                        print(f'The TRUST source file must contain TRUST_VEIN somewhere in the filename')
-                        print(f'If you select "fix" the TRUST source file(s) will be modified to conform to this by adding _VEIN after wherever TRUST appears')
-                        
+
+    run.asl_pld, run.asl_ld, run.asl_tr = asl_pld, asl_ld, asl_tr
+
+
+def check_trust_source(run):
+    """
+    Makes sure the TRUST source image has TRUST_VEIN in the filename
+    (otherwise the MATLAB script will break), offering to rename it if not
+    """
+
+    acquired_folder = os.path.join(run.in_folder, 'Acquired')
+
+    globber_trustsource = os.path.join(acquired_folder,'*SOURCE*TRUST*')
+    names_with_trustsource = glob.glob(globber_trustsource)
+
+    try:
+        trustsource = names_with_trustsource[0]
+    except IndexError:
+        raise Exception('\nIt appears you do not have a source file for TRUST (pattern: *SOURCE*TRUST*)\nEither add this file to the folder, or exclude TRUST processing')
+
+    tv = 'TRUST_VEIN'
+    if tv in trustsource:
+        print(f'\nTRUST source\n----- {trustsource} -----\nis formatted correctly')
+    else:
+        print(f'\nWARNING: TRUST source\n----- {trustsource} -----\nis NOT formatted correctly')
+        has_ans = False
+        while not has_ans:
+            ans = run.decide.ask('trust_rename', f'\nI can try to fix the filenames for you, or you can exit processing and do it yourself. [fix/exit/info]\n',
+                                 auto_answer='fix')
+            if ans in ('fix','exit','info'):
+                if ans == 'exit':
+                    has_ans = True
+                    raise Exception('Aborting processing')
+                elif ans == 'fix':
+                    print('Okay. Renaming the files for you.')
+
+                    base = os.path.basename(trustsource)
+                    base = base.split('.')[0]
+                    globber_base = os.path.join(acquired_folder,f'{base}.*')
+                    names_with_base = glob.glob(globber_base)
+
+                    for path in names_with_base:
+
+                        path_break = path.split('TRUST')
+                        new_path = 'TRUST_VEIN'.join(path_break)
+
+                        print(f'\n{path}\nto\n{new_path}\n')
+                        os.rename(path, new_path)
+
+                    for line in wizard.splitlines():
+                        print(line)
+                        time.sleep(0.05)
+                    print('magically fixed, free of charge\n')
+                    time.sleep(0.5)
+                    has_ans = True
                 else:
-                    print('Answer must be "fix", "exit" or "info"')
-    
-    
-    processing_scripts_loc = r'/Users/manusdonahue/Desktop/Projects/SCD/Processing/Pipeline/'
-    os.chdir(processing_scripts_loc)
-    
-    if '4' in steps and do_run['trust']:
-        assert art_ox_sat != 'redcap'
-        
+                    print(f'The TRUST source file must contain TRUST_VEIN somewhere in the filename')
+                    print(f'If you select "fix" the TRUST source file(s) will be modified to conform to this by adding _VEIN after wherever TRUST appears')
+
+            else:
+                print('Answer must be "fix", "exit" or "info"')
+
+
+def main_processing(run):
+    ##### step 2 : main processing
+    in_folder = run.in_folder
+    pt_id = run.pt_id
+    do_run = run.do_run
+
+    print(f'Step 2: begin main processing sequence\n')
+
+    asl_parameters(run)
+
     if do_run['trust']:
-        assert hematocrit != 'redcap'
-    elif hematocrit == 'redcap':
-        hematocrit = 0 #fine to pass junk in for hct if not running TRUST
-        
-    assert pt_type_num != 'redcap'
-    
-    processing_input = f'''/Applications/MATLAB_R2016b.app/bin/matlab -nodesktop -nosplash -r "Master_v2('{pt_id}',{hematocrit},{pt_type_num},{flip},{asl_tr},{asl_pld},{asl_ld},{do_run['trust']},{do_run['vol']},{do_run['asl']},{auto})"'''
-    
-    print(f'Call to MATLAB: {processing_input}')
-    
-    subprocess.run(processing_input, check=True, shell=True)
-    # subprocess.run('quit force', check=True, shell=True)
-    
-    os.chdir(original_wd)
-    
-    print(f'\nMain processing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
-    
-if '3' in steps and name_in_redcap:    
-    ##### step 3 : main processing
+        check_trust_source(run)
+
+
+    if '4' in run.steps and do_run['trust']:
+        assert run.art_ox_sat != 'redcap'
+
+    if do_run['trust']:
+        assert run.hematocrit != 'redcap'
+    elif run.hematocrit == 'redcap':
+        run.hematocrit = 0 #fine to pass junk in for hct if not running TRUST
+
+    assert run.pt_type_num != 'redcap'
+
+    def master_args(the_id, flags):
+        # the ASL parameters may still be strings parsed from filenames
+        return [the_id, float(run.hematocrit), run.pt_type_num, run.flip, float(run.asl_tr), float(run.asl_pld), float(run.asl_ld),
+                flags['trust'], flags['vol'], flags['asl'], run.auto]
+
+    split_jobs = [j for j in SUBPROCESSES if do_run[j]]
+    if run.split and len(split_jobs) > 1:
+        # run each subprocessing step as its own MATLAB job in its own job folder, then merge the results
+        log_folder = os.path.join(in_folder, 'logs')
+        os.makedirs(log_folder, exist_ok=True)
+
+        job_folders = {}
+        tasks = {}
+        for j in split_jobs:
+            the_job_id = job_id(pt_id, j)
+            job_folders[the_job_id] = make_job_folder(in_folder, the_job_id)
+            flags = {key:int(key == j) for key in do_run}
+
+            job_log = os.path.join(log_folder, f'step2_{j}.log')
+            print(f'Running {j} processing as {the_job_id} (logged to {job_log})')
+            tasks[j] = lambda job_args=master_args(the_job_id, flags), job_log=job_log: run.backend.call('Master_v2', job_args, cwd=SCD_SCRIPTS, log_file=job_log)
+
+        finished = False
+        try:
+            elapsed = run_parallel(tasks)
+            finished = True
+        finally:
+            collect_job_outputs(in_folder, pt_id, job_folders, merge=finished)
+
+        for j, secs in elapsed.items():
+            print(f'{j} processing took {round(secs/60, 2)} minutes')
+    else:
+        run.backend.call('Master_v2', master_args(pt_id, do_run), cwd=SCD_SCRIPTS)
+
+
+def push_to_redcap(run):
+    ##### step 3 : pushing results to REDCap
+    import pandas as pd
+
     print(f'\nStep 3: pushing results to REDCap\n')
-    
+
+    scan_index = run.scan_index
+    study_id = run.study_id
+
     fields_of_interest_raw = [
                             'mrINDEX_lparietal_gm_cbf',
                             'mrINDEX_rparietal_gm_cbf',
@@ -672,15 +869,15 @@ if '3' in steps and name_in_redcap:
                             'mrINDEX_f_model_venous_oxygen_sat1',
                             'mrINDEX_f_model_venous_oxygen_sat2'
                          ]
-    
+
     fields_of_interest = [i.replace('INDEX', str(scan_index+1)) for i in fields_of_interest_raw]
-    processed_csv = os.path.join(in_folder, f'{pt_id}_PROCESSINGresults.csv')
-    
-    data_row = studyid_index_data.loc[study_id]
+    processed_csv = os.path.join(run.in_folder, f'{run.pt_id}_PROCESSINGresults.csv')
+
+    data_row = run.redcap_data.loc[study_id]
     old_data = {i:data_row[i] for i in fields_of_interest}
     new_data = hp.parse_scd_csv(processed_csv, scan_index)
-    
-    print(f'\nThe following changes will be made to study ID {study_id} ({scan_mr_col}):')
+
+    print(f'\nThe following changes will be made to study ID {study_id} ({run.scan_mr_col}):')
     for key in old_data:
         time.sleep(0.1)
         oldy = old_data[key]
@@ -688,52 +885,72 @@ if '3' in steps and name_in_redcap:
             oldy = 'NOTHING'
         newy = new_data[key]
         print(f'\t{key} : {oldy} ---> {newy}')
-        
+
     has_ans = False
     while not has_ans:
-        ans = input(f'\nPush to database? Note that a nan will not overwrite the database entry. This behavior may or may not be desired. [y/n/wipe (DO NOT USE WIPE)]\n')
+        ans = run.decide.ask('redcap_push', f'\nPush to database? Note that a nan will not overwrite the database entry. This behavior may or may not be desired. [y/n/wipe (DO NOT USE WIPE)]\n')
         if ans in ('y','n','wipe'):
             has_ans = True
             if ans == 'n':
                 print('Data will not be pushed')
             elif ans == 'y':
                 print('Pushing to database - this takes about a minute')
-                
-                project = redcap.Project(api_url, token) # we need to pull a fresh copy of the database in case someone else had been modifying it during processing
-                project_data_raw = project.export_records()
+
+                project = redcap_project(REDCAP_API_URL, REDCAP_TOKEN_LOC)
+                with telemetry.span('redcap', 'export_records'):
+                    project_data_raw = project.export_records() # we need to pull a fresh copy of the database in case someone else had been modifying it during processing
                 project_data = pd.DataFrame(project_data_raw)
                 studyid_index_data = project_data.set_index('study_id')
-                
+
                 for key, val in new_data.items():
                     studyid_index_data.loc[study_id][key] = val
-                np_out = project.import_records(studyid_index_data)
+                with telemetry.span('redcap', 'import_records'):
+                    np_out = project.import_records(studyid_index_data)
                 print(f'REDCap data import message: {np_out}')
-                    
-                print(f'\nData import complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+                print(f'\nData import complete. Elapsed time: {str_time_elapsed(run.start_stamp)} minutes')
             elif ans =='wipe':
                 print('BRO I SAID DO NOT')
                 sys.exit()
                 print('Wiping REDCap entries for this scan - this takes about a minute')
-                project = redcap.Project(api_url, token) # we need to pull a fresh copy of the database in case someone else had been modifying it during processing
-                project_data_raw = project.export_records()
+                project = redcap_project(REDCAP_API_URL, REDCAP_TOKEN_LOC)
+                with telemetry.span('redcap', 'export_records'):
+                    project_data_raw = project.export_records() # we need to pull a fresh copy of the database in case someone else had been modifying it during processing
                 project_data = pd.DataFrame(project_data_raw)
                 studyid_index_data = project_data.set_index('study_id')
-                
+
                 for key, val in new_data.items():
                     studyid_index_data.loc[study_id][key] = ''
-                np_out = project.import_records(studyid_index_data)
+                with telemetry.span('redcap', 'import_records'):
+                    np_out = project.import_records(studyid_index_data)
                 print(f'REDCap data import message: {np_out}')
         else:
             print('Answer must be "y", "n" or "wipe" (which will clear the displayed fields for this scan)')
-    
-elif '3' in steps and not name_in_redcap:
-    print(f"\nSkipping Step 3: can't push to REDCap as either the mr_id is not in the database or the database could not be contacted")
-    
-    
-if '4' in steps:
-    
+
+
+def make_report(run):
+    ##### step 4 : PDF report
+    in_folder = run.in_folder
+    pt_id = run.pt_id
+    do_run = run.do_run
+    the_num = run.the_num
+    descrip = run.descrip
+    art_ox_sat = run.art_ox_sat
+    hematocrit = run.hematocrit
+    study_id = run.study_id
+    scan_date = run.scan_date
+    gender = run.gender
+    birth_date = run.birth_date
+    scan_index = run.scan_index
+    from_redcap = run.redcap_row is not None
+
     print('\nStep 4: Generating PDF report\n')
     
+    import numpy as np
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from fpdf import FPDF
+    
     if hematocrit == 'redcap':
         hematocrit = None
     
@@ -741,12 +958,8 @@ if '4' in steps:
     now = datetime.datetime.now()
     nowstr = now.strftime("%Y-%m-%d %H:%M")
     
-    reporting_folder = os.path.join(in_folder, 'reporting')
-    
-    if os.path.exists(reporting_folder):
-        shutil.rmtree(reporting_folder)
-    
-    os.mkdir(reporting_folder)
+    # the report is made in a staging folder that replaces the old one when it's complete
+    reporting_folder = hp.staging_folder(run.reporting_folder)
     
     print('Pulling data from CSV')
     
@@ -802,9 +1015,9 @@ if '4' in steps:
     pdf.set_xy(0, 0)
     pdf.set_font('arial', 'B', 16)
     
-    donahue_logo = '/Users/manusdonahue/Documents/Sky/repositories/scan-reporting/bin/Donahue_Lab_v1.png'
-    #donahue_logo = '/Users/manusdonahue/Documents/Sky/repositories/scan-reporting/bin/Donahue_Lab_v1_vec.svg'
-    vumc_logo = '/Users/manusdonahue/Documents/Sky/repositories/scan-reporting/bin/vumc_logo_clear.png'
+    donahue_logo = os.path.join(BIN_FOLDER, 'Donahue_Lab_v1.png')
+    #donahue_logo = os.path.join(BIN_FOLDER, 'Donahue_Lab_v1_vec.svg')
+    vumc_logo = os.path.join(BIN_FOLDER, 'vumc_logo_clear.png')
     
     
     pdf.cell(210, 5, f"", 0, 2, 'C')
@@ -839,11 +1052,11 @@ if '4' in steps:
     
     pdf.cell(-10, 0, '', 0, 0, 'C')
     
-    if contact_redcap:
-        study_id = cands.iloc[0][f'mr{scan_index+1}_scan_id']
-        scan_date = cands.iloc[0][f'mr{scan_index+1}_dt']
-        gender = cands.iloc[0][f'gender']
-        birth_date = cands.iloc[0][f'dob']
+    if from_redcap:
+        study_id = run.redcap_row[f'mr{scan_index+1}_scan_id']
+        scan_date = run.redcap_row[f'mr{scan_index+1}_dt']
+        gender = run.redcap_row[f'gender']
+        birth_date = run.redcap_row[f'dob']
         
     if gender == '1':
         gender_str = 'male'
@@ -852,7 +1065,7 @@ if '4' in steps:
     else:
         gender_str = gender
         
-    if contact_redcap:
+    if from_redcap:
         format_str_scan = '%Y-%m-%d %H:%M'
         format_str_birth = '%Y-%m-%d'
     else:
@@ -1172,15 +1385,85 @@ if '4' in steps:
     
     pdf_out = os.path.join(reporting_folder, f'{use_pt_id}_report.pdf')
     pdf.output(pdf_out, 'F')
-    
-    
-    
+    hp.swap_folder(reporting_folder, run.reporting_folder)
 
-    
-    
-print(f'\nProcessing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes\n')
 
+def process(run):
+    """
+    Runs the requested steps of the SCD pipeline on one patient
 
 
+    Parameters
+    ----------
+    run : ScdRun
+        the run. Steps that are up to date are skipped (see step_graph.py).
+
+    Returns
+    -------
+    ScdRun, filled in.
+
+    """
+
+    if run.graph is None:
+        plan(run)
+    if run.dry_run:
+        return run
+
+    # one run at a time per patient. a run that had to wait replans, as the other run may have brought steps up to date
+    with hp.patient_lock(run.in_folder) as waited:
+        if waited:
+            run.graph.refresh()
+            print(f'\nStep plan:\n{run.graph.describe()}')
+        graph = run.graph
+        try:
+            prepare(run) # inside the try, so a run that fails here still ends its telemetry
+            start_stamp = run.start_stamp
+            if run.contact_redcap:
+                # check the redcap database to make sure the folder name is (pt_id) is in the redcap database
+                check_redcap(run)
+
+            if graph.should_run('1'):
+                deidentify(run)
+                graph.mark_done('1')
+                print(f'\nDeidentification complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+            if graph.should_run('2'):
+                main_processing(run)
+                graph.mark_done('2')
+                print(f'\nMain processing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes')
+
+            if run.name_in_redcap and graph.should_run('3'):
+                push_to_redcap(run)
+                graph.mark_done('3')
+            elif '3' in run.steps and not run.name_in_redcap:
+                print(f"\nSkipping Step 3: can't push to REDCap as either the mr_id is not in the database or the database could not be contacted")
+
+            if graph.should_run('4'):
+                # the profile goes to the final reporting folder, so it is kept when the report fails
+                profiler = stage_profiler('step4_pdf', run.reporting_folder, run.profile)
+                profiler.start()
+                try:
+                    make_report(run)
+                finally:
+                    profiler.stop()
+                graph.mark_done('4')
+        except BaseException as e:
+            telemetry.finish(ok=False, error=f'{type(e).__name__}: {e}')
+            raise
+
+        telemetry.finish()
+        print(f'\nProcessing complete. Elapsed time: {str_time_elapsed(start_stamp)} minutes\n')
+    return run
+
+
+def main(argv=None):
+    """
+    The command line interface. argv defaults to sys.argv[1:]
+    """
+
+    run = parse_args(sys.argv[1:] if argv is None else argv)
+    return process(run)
 
 
+if __name__ == '__main__':
+    main()
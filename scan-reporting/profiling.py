@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the reporting stages (run the pipelines with --profile).
+
+A stage profiler runs cProfile and tracemalloc between start() and stop(),
+then writes into [out_folder]/profile
+    [stage].pstats : the cProfile statistics (open with pstats or snakeviz)
+    [stage]_profile.txt : the functions with the most cumulative time
+    [stage]_alloc.txt : the peak traced memory and the lines that allocated the most
+
+When profiling is off, stage_profiler() returns a profiler whose start() and
+stop() do nothing, so the pipelines pay nothing for the hooks.
+
+Note that cProfile only sees the thread that calls start().
+
+"""
+
+import os
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+TOP_N = 30
+
+
+class StageProfiler:
+    """
+    Profiles the time and memory allocations of one stage
+
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage, used to name the output files.
+    out_folder : str
+        the profile subfolder is created here when the profiler stops.
+    top_n : int, optional
+        the number of functions and allocation sites listed in the summaries. The default is TOP_N.
+
+    """
+
+    def __init__(self, stage, out_folder, top_n=TOP_N):
+        self.stage = stage
+        self.out_folder = out_folder
+        self.top_n = top_n
+        self._profile = None
+        self._started_tracing = False
+
+    def start(self):
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start(10)
+        tracemalloc.reset_peak()
+        self._start_time = time.perf_counter()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        """
+        Stops profiling and writes the outputs
+
+
+        Returns
+        -------
+        str of the folder the outputs were written to.
+
+        """
+
+        if self._profile is None:
+            return None
+        self._profile.disable()
+        elapsed = time.perf_counter() - self._start_time
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+        profile_folder = os.path.join(self.out_folder, 'profile')
+        os.makedirs(profile_folder, exist_ok=True)
+        base = os.path.join(profile_folder, self.stage)
+
+        self._profile.dump_stats(f'{base}.pstats')
+        text = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(self.top_n)
+        with open(f'{base}_profile.txt', 'w') as f:
+            f.write(f'{self.stage}: {round(elapsed, 2)} s\n')
+            f.write(text.getvalue())
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+                                           tracemalloc.Filter(False, __file__)])
+        with open(f'{base}_alloc.txt', 'w') as f:
+            f.write(f'{self.stage}: peak traced memory {round(peak/1024**2, 1)} MB, still allocated at the end {round(current/1024**2, 1)} MB\n\n')
+            f.write(f'Top {self.top_n} allocation sites still allocated at the end of the stage:\n')
+            for stat in snapshot.statistics('lineno')[:self.top_n]:
+                f.write(f'{stat}\n')
+
+        self._profile = None
+        print(f'Profile of {self.stage} written to {profile_folder}')
+        return profile_folder
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class NullProfiler:
+    """
+    Stands in for StageProfiler when profiling is off
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def stage_profiler(stage, out_folder, enabled):
+    """
+    Gets a StageProfiler for a stage if profiling is enabled, otherwise a NullProfiler
+    """
+
+    if enabled:
+        return StageProfiler(stage, out_folder)
+    return NullProfiler()
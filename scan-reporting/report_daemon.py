@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+A long-lived report worker. The daemon starts a pool of worker processes that
+import the pipelines and their libraries (numpy, pandas, matplotlib,
+python-pptx, nibabel, fpdf) and read the report templates and dot images once,
+then takes jobs (a pipeline and its options, as in batch.py) over a Unix domain
+socket. Reports made by the daemon don't pay the interpreter and library
+startup that a fresh process_bold.py or process_scd.py pays.
+
+Jobs always run unattended (-q), so every question needs an answer in the
+patient's parameter file. The output of each job is appended to
+logs/report_daemon.log in the patient folder.
+
+The same script is the client:
+
+    report_daemon.py -m serve -w 2 &
+    report_daemon.py -m submit -- bold -i /path/to/PTSTEN_101_01 -s 56
+    report_daemon.py -m status
+    report_daemon.py -m drain
+
+Draining (-m drain, SIGTERM or ctrl-c) stops the daemon taking new jobs, lets
+the queued and running ones finish, then exits.
+
+-m bench measures the latency of one job run cold (a fresh process_*.py per
+report) and through a daemon it starts itself. -z is added to the job so every
+repeat redoes the steps.
+
+input:
+    -m / --mode : serve, submit, status, drain, ping or bench. default: submit
+    -k / --socket : the socket path. default: SCAN_REPORTING_SOCKET, or scan-reporting-[uid].sock
+        in the temporary folder
+    -w / --workers : serve/bench: the number of jobs run at the same time (worker processes). default: 1
+    -n / --nowait : submit: return as soon as the job is queued instead of when it finishes.
+        does not take an argument
+    -r / --repeats : bench: the number of reports timed each way. default: 5
+    -o / --out : bench: also write the results to this JSON file
+    -g / --help : brings up this helpful information. does not take an argument
+
+    For submit and bench, the job goes after --: the pipeline (bold or scd) and its options.
+"""
+
+import os
+import sys
+import getopt
+import json
+import time
+import glob
+import signal
+import socket
+import tempfile
+import threading
+import traceback
+import contextlib
+import subprocess
+import socketserver
+import statistics
+import multiprocessing
+import concurrent.futures
+
+SOCKET_PATH = os.environ.get('SCAN_REPORTING_SOCKET', os.path.join(tempfile.gettempdir(), f'scan-reporting-{os.getuid()}.sock'))
+HERE = os.path.dirname(os.path.abspath(__file__))
+WARM_MODULES = ['numpy', 'pandas', 'matplotlib.pyplot', 'scipy.ndimage', 'nibabel', 'pptx', 'PIL.Image', 'fpdf',
+                'process_bold', 'process_scd']
+
+
+##### worker side
+
+def warm_up():
+    """
+    Runs once in every worker process: imports the pipelines and the heavy
+    libraries, and reads the files used by every report into read_cached()
+    """
+
+    import importlib
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # ctrl-c drains the daemon, which lets the running jobs finish
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    for name in WARM_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f'report_daemon: could not preload {name} ({e})', file=sys.stderr)
+
+    import helpers as hp
+    from external import BIN_FOLDER
+    for pattern in ('*.pptx', '*_dot.png'):
+        for path in glob.glob(os.path.join(BIN_FOLDER, pattern)):
+            hp.read_cached(path)
+
+
+@contextlib.contextmanager
+def output_to(log):
+    """
+    Sends everything written to stdout and stderr, including by subprocesses,
+    to the open file log. A worker runs one job at a time, so this is safe there
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+
+def run_in_worker(pipeline, argv, log_base='report_daemon.log'):
+    """
+    Runs one job in a worker process, with its output going to the patient's
+    logs/[log_base] (logs/report_daemon.log by default). Never raises: failures
+    are returned
+    """
+
+    import importlib
+    import batch
+
+    start = time.perf_counter()
+    module = importlib.import_module(batch.PIPELINES[pipeline])
+    log_name = None
+    try:
+        run = module.parse_args(argv)
+        run.unattended = True
+        if not os.path.isdir(run.in_folder): # before the log folder is made, which would make a patient folder out of a typo
+            raise FileNotFoundError(f'input folder {run.in_folder} does not exist')
+        log_folder = os.path.join(run.in_folder, 'logs')
+        os.makedirs(log_folder, exist_ok=True)
+        log_name = os.path.join(log_folder, log_base)
+        with open(log_name, 'a', buffering=1) as log, output_to(log):
+            print(f'\n##### {time.strftime("%Y-%m-%d %H:%M:%S")} pid {os.getpid()}: {pipeline} {" ".join(argv)}\n')
+            try:
+                module.process(run)
+            except BaseException:
+                traceback.print_exc()
+                raise
+            finally:
+                batch.release_figures()
+        status, error = 'ok', None
+    except SystemExit as e:
+        status, error = 'failed', f'SystemExit: {e}'
+    except Exception as e:
+        status, error = 'failed', f'{type(e).__name__}: {e}'
+    return {'status':status, 'error':error, 'log':log_name, 'pid':os.getpid(),
+            'run_seconds':round(time.perf_counter() - start, 3)}
+
+
+##### server side
+
+class ReportDaemon:
+    """
+    The state of a running daemon: the worker pool and the jobs it has been
+    given
+
+
+    Parameters
+    ----------
+    socket_path : str, optional
+        where to listen. The default is SOCKET_PATH.
+    workers : int, optional
+        the number of worker processes, i.e., jobs run at the same time. The default is 1.
+
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, workers=1):
+        self.socket_path = socket_path
+        self.workers = workers
+        self.jobs = {} # job id: {'pipeline', 'args', 'state', 'submitted', 'result'}
+        self.futures = {}
+        self.done = {} # job id: threading.Event set when the job has finished
+        self.draining = False
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.pool = None
+        self.server = None
+
+    def start_pool(self):
+        # spawn, not fork: the server has threads, and the workers should start clean
+        context = multiprocessing.get_context('spawn')
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=warm_up)
+        # start and warm every worker now rather than on the first jobs
+        list(self.pool.map(time.sleep, [0.1] * self.workers))
+
+    def submit(self, pipeline, args):
+        import batch
+        if pipeline not in batch.PIPELINES:
+            raise ValueError(f'the pipeline must be one of {list(batch.PIPELINES)}, not {pipeline}')
+        with self.lock:
+            if self.draining:
+                raise RuntimeError('the daemon is draining and not taking new jobs')
+            job_id = self.next_id
+            self.next_id += 1
+            job = {'id':job_id, 'pipeline':pipeline, 'args':list(args), 'state':'queued', 'submitted':time.time(), 'result':None}
+            self.jobs[job_id] = job
+            self.done[job_id] = threading.Event()
+            try:
+                future = self.pool.submit(run_in_worker, pipeline, list(args))
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died (e.g., killed for memory). start a fresh pool
+                self.start_pool()
+                future = self.pool.submit(run_in_worker, pipeline, list(args))
+            self.futures[job_id] = future
+        future.add_done_callback(lambda f, job=job: self._finished(job, f))
+        return job
+
+    def _finished(self, job, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'status':'failed', 'error':f'{type(e).__name__}: {e}'}
+        result['latency_seconds'] = round(time.time() - job['submitted'], 3)
+        with self.lock:
+            job['result'] = result
+            job['state'] = result['status']
+            self.futures.pop(job['id'], None)
+        self.done.pop(job['id']).set()
+
+    def status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                state = job['state']
+                if state == 'queued' and self.futures.get(job['id']) is not None and self.futures[job['id']].running():
+                    state = 'running'
+                counts[state] = counts.get(state, 0) + 1
+            return {'pid':os.getpid(), 'workers':self.workers, 'draining':self.draining, 'jobs':counts}
+
+    def drain(self):
+        """
+        Stops taking jobs, waits for the queued and running ones, then stops the server
+        """
+
+        with self.lock:
+            if self.draining:
+                return
+            self.draining = True
+            pending = list(self.futures.values())
+        print(f'report_daemon: draining ({len(pending)} job(s) left)', flush=True)
+
+        def finish():
+            concurrent.futures.wait(pending)
+            self.pool.shutdown(wait=True)
+            self.server.shutdown()
+        threading.Thread(target=finish, daemon=True).start()
+
+    def handle(self, message):
+        command = message.get('command')
+        if command == 'ping':
+            return {'ok':True, 'pid':os.getpid()}
+        elif command == 'status':
+            return dict(ok=True, **self.status())
+        elif command == 'drain':
+            pending = len(self.futures)
+            self.drain()
+            return {'ok':True, 'pending':pending}
+        elif command == 'submit':
+            try:
+                job = self.submit(message['pipeline'], message.get('args', []))
+            except (ValueError, RuntimeError, KeyError) as e:
+                return {'ok':False, 'error':str(e)}
+            if not message.get('wait', True):
+                return {'ok':True, 'job':job['id']}
+            done = self.done.get(job['id'])
+            if done is not None:
+                done.wait()
+            return dict(ok=job['result']['status'] == 'ok', job=job['id'], **job['result'])
+        elif command == 'job':
+            job = self.jobs.get(message.get('job'))
+            if job is None:
+                return {'ok':False, 'error':f'no job {message.get("job")}'}
+            return {'ok':True, 'job':job['id'], 'state':job['state'], 'result':job['result']}
+        return {'ok':False, 'error':f'unknown command {command}'}
+
+    def serve(self):
+        """
+        Listens on the socket until drained
+        """
+
+        if os.path.exists(self.socket_path):
+            try:
+                request(self.socket_path, {'command':'ping'}, timeout=1)
+                raise RuntimeError(f'A daemon is already listening on {self.socket_path}')
+            except OSError:
+                os.remove(self.socket_path) # left behind by a daemon that didn't exit cleanly
+
+        print(f'report_daemon: starting {self.workers} worker(s)', flush=True)
+        start = time.perf_counter()
+        self.start_pool()
+        print(f'report_daemon: workers warm in {round(time.perf_counter() - start, 2)} s', flush=True)
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                try:
+                    reply = daemon.handle(json.loads(line))
+                except json.JSONDecodeError:
+                    reply = {'ok':False, 'error':'requests must be one line of JSON'}
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(self.socket_path, Handler)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: self.drain())
+        print(f'report_daemon: listening on {self.socket_path}', flush=True)
+        try:
+            self.server.serve_forever(poll_interval=0.2)
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        print('report_daemon: stopped', flush=True)
+
+
+##### client side
+
+def request(socket_path, message, timeout=None):
+    """
+    Sends one request to a daemon and returns its reply
+
+
+    Parameters
+    ----------
+    socket_path : str
+        the daemon's socket.
+    message : dict
+        the request, e.g., {'command':'submit', 'pipeline':'bold', 'args':[...]}.
+    timeout : float, optional
+        seconds to wait for the reply. The default is None (forever).
+
+    Returns
+    -------
+    dict of the reply.
+
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        with sock.makefile('r') as f:
+            return json.loads(f.readline())
+
+
+def submit(socket_path, pipeline, args, wait=True):
+    """
+    Submits a job to a daemon. If wait, returns when the job is done
+    """
+
+    return request(socket_path, {'command':'submit', 'pipeline':pipeline, 'args':list(args), 'wait':wait})
+
+
+def wait_for_daemon(socket_path, timeout=120):
+    """
+    Waits until a daemon answers on socket_path
+    """
+
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            return request(socket_path, {'command':'ping'}, timeout=1)
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f'No daemon answered on {socket_path} within {timeout} s')
+
+
+def bench_latency(pipeline, args, repeats=5, workers=1):
+    """
+    Times the same report made cold (a fresh process_*.py each time) and
+    through a daemon started for the purpose
+
+
+    Parameters
+    ----------
+    pipeline : str
+        'bold' or 'scd'.
+    args : list of str
+        the options of the pipeline. -z and -q are added.
+    repeats : int, optional
+        the number of reports timed each way. The default is 5.
+    workers : int, optional
+        the number of daemon workers. The default is 1.
+
+    Returns
+    -------
+    dict of the latencies (seconds) and their summary.
+
+    """
+
+    import batch
+
+    args = list(args)
+    for flag in ('-z', '-q'):
+        if flag not in args:
+            args.append(flag)
+
+    env = dict(os.environ)
+    env.setdefault('MPLBACKEND', 'Agg')
+    script = os.path.join(HERE, f'{batch.PIPELINES[pipeline]}.py')
+
+    cold = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, script] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              stdin=subprocess.DEVNULL, env=env, cwd=HERE)
+        cold.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError(f'The cold run failed ({proc.returncode}): {script} {" ".join(args)}')
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    daemon_log = open(os.path.join(os.path.dirname(socket_path), 'daemon.log'), 'w')
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '-m', 'serve', '-k', socket_path, '-w', str(workers)],
+                            stdout=daemon_log, stderr=subprocess.STDOUT, env=env, cwd=HERE)
+    try:
+        wait_for_daemon(socket_path)
+        startup = time.perf_counter() - start
+        warm = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            reply = submit(socket_path, pipeline, args)
+            warm.append(time.perf_counter() - start)
+            if not reply['ok']:
+                raise RuntimeError(f'The daemon run failed: {reply.get("error")} (see {reply.get("log")})')
+    finally:
+        try:
+            request(socket_path, {'command':'drain'}, timeout=5)
+        except OSError:
+            proc.terminate()
+        proc.wait()
+        daemon_log.close()
+
+    results = {'pipeline':pipeline, 'args':args, 'repeats':repeats, 'workers':workers,
+               'daemon_startup_seconds':round(startup, 3),
+               'cold_seconds':[round(t, 3) for t in cold], 'daemon_seconds':[round(t, 3) for t in warm],
+               'cold_median':round(statistics.median(cold), 3), 'daemon_median':round(statistics.median(warm), 3)}
+    results['speedup'] = round(results['cold_median'] / results['daemon_median'], 2)
+    print(f'\nLatency per report over {repeats} repeats (median):')
+    print(f'\tcold : {results["cold_median"]} s')
+    print(f'\tdaemon : {results["daemon_median"]} s ({results["speedup"]}x faster). The daemon itself took {results["daemon_startup_seconds"]} s to start')
+    return results
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "m:k:w:nr:o:g", ['mode=', 'socket=', 'workers=', 'nowait', 'repeats=', 'out=', 'help'])
+
+    mode = 'submit'
+    socket_path = SOCKET_PATH
+    workers = 1
+    wait = True
+    repeats = 5
+    out_name = None
+
+    for opt, arg in options:
+        if opt in ('-m', '--mode'):
+            mode = arg
+        elif opt in ('-k', '--socket'):
+            socket_path = arg
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-n', '--nowait'):
+            wait = False
+        elif opt in ('-r', '--repeats'):
+            repeats = int(arg)
+        elif opt in ('-o', '--out'):
+            out_name = arg
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if mode == 'serve':
+        ReportDaemon(socket_path, workers).serve()
+    elif mode in ('status', 'drain', 'ping'):
+        print(json.dumps(request(socket_path, {'command':mode}), indent=4))
+    elif mode in ('submit', 'bench'):
+        if not remainder:
+            raise ValueError('The job (the pipeline and its options) must follow --')
+        if mode == 'submit':
+            reply = submit(socket_path, remainder[0], remainder[1:], wait)
+            print(json.dumps(reply, indent=4))
+            if not reply['ok']:
+                sys.exit(1)
+        else:
+            results = bench_latency(remainder[0], remainder[1:], repeats, workers)
+            if out_name is not None:
+                with open(out_name, 'w') as f:
+                    json.dump(results, f, indent=4)
+    else:
+        raise ValueError(f'Unknown mode {mode}. Must be serve, submit, status, drain, ping or bench')
@@ -4,24 +4,25 @@
 Functions for reading in a scan and generating a multislice plot for
 sticking in reports
 
+matplotlib, numpy and scipy are imported inside the functions that use them,
+so importing this module (e.g., for par2nii) doesn't pay for them.
+
 """
 
 import subprocess
 import os
 import itertools
 
-import matplotlib.pyplot as plt
-import matplotlib
-import numpy as np
-import nibabel as nib
-from scipy import ndimage
-
 from helpers import get_terminal
+from nii_io import load_nii
+from external import DCM2NII
+import telemetry
 
 
+@telemetry.timed('subprocess', 'dcm2nii')
 def par2nii(dcm, out_folder):
     
-    path_to_dcm2nii = '/Users/manusdonahue/Documents/Sky/mricron/dcm2nii'
+    path_to_dcm2nii = DCM2NII
     conversion_command = f'{path_to_dcm2nii} -o {out_folder} -a n -i n -d n -p n -e n -f y -v n {dcm}'
     
     original_stem = get_terminal(dcm)[:-4]
@@ -33,6 +34,7 @@ def par2nii(dcm, out_folder):
 
 def filter_zeroed_axial_slices(nii_data, thresh=0.99):
     # removes slices if the number of pixels that are lesser than or equal to 0 exceeds a % threshold, and replaces NaN with -1
+    import numpy as np
     the_data = nii_data.copy()
     wherenan = np.isnan(the_data)
     the_data[wherenan] = -1
@@ -60,10 +62,18 @@ def filter_zeroed_axial_slices(nii_data, thresh=0.99):
         return the_data
 
 
-def compare_nii_images(niis, cmaps=[matplotlib.cm.gray,matplotlib.cm.inferno],
+@telemetry.timed('render')
+def compare_nii_images(niis, cmaps=None,
                        cmaxes=[None,None], save=True,
                        out_name=None, frames=6, ax_font_size=32):
+    # cmaps defaults to [matplotlib.cm.gray, matplotlib.cm.inferno]
+    import numpy as np
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from scipy import ndimage
     
+    if cmaps is None:
+        cmaps = [matplotlib.cm.gray, matplotlib.cm.inferno]
     
     plt.style.use('dark_background')
         
@@ -75,8 +85,8 @@ def compare_nii_images(niis, cmaps=[matplotlib.cm.gray,matplotlib.cm.inferno],
     fig, axs = plt.subplots(nrows, 3, figsize=(3*3,nrows*1.95))
     fig.subplots_adjust(hspace=0.0, wspace=-0.4)
     
-    data1 = nib.load(niis[0]).get_fdata()
-    data2 = nib.load(niis[1]).get_fdata()
+    data1 = load_nii(niis[0]).get_fdata()
+    data2 = load_nii(niis[1]).get_fdata()
     datas = [data1,data2]
     
     num_slices = data1.shape[2] - 1 # num of axial slices
@@ -172,6 +182,7 @@ def compare_nii_images(niis, cmaps=[matplotlib.cm.gray,matplotlib.cm.inferno],
     
 
 
+@telemetry.timed('render')
 def nii_image(nii, dimensions, out_name, cmap, cmax=None, save=True, specified_frames=None, ax_font_size=32):
     """
     Produces a png representing multiple AXIAL slices of a NiFTI
@@ -196,10 +207,14 @@ def nii_image(nii, dimensions, out_name, cmap, cmax=None, save=True, specified_f
     The thresholding value (upper percentile for grayscale, absolute value for all other cmaps).
 
     """
+    import numpy as np
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from scipy import ndimage
     
     plt.style.use('dark_background')
     
-    img = nib.load(nii)
+    img = load_nii(nii)
     data = img.get_fdata()
     #data = filter_zeroed_axial_slices(data)
     data = filter_zeroed_axial_slices(data, thresh=False)
@@ -304,7 +319,7 @@ def nii_image(nii, dimensions, out_name, cmap, cmax=None, save=True, specified_f
     
     
     matplotlib.rcParams.update({'font.size': ax_font_size})
-    plt.tight_layout(0.8)
+    plt.tight_layout(pad=0.8)
     
     if cmap != matplotlib.cm.gray:
             
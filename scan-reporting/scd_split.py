@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for running the TRUST, volumetrics and ASL parts of the SCD
+MATLAB processing (Master_v2) as separate, concurrent jobs.
+
+Master_v2 writes its outputs into the patient folder it is given, so
+concurrent jobs on the same patient would overwrite each other. Each job is
+instead given its own sibling job folder (e.g., PTSTEN_001_01_trustjob next
+to PTSTEN_001_01) containing only a link to the patient's Acquired folder.
+Once all the jobs are done their outputs are moved back into the patient
+folder (with the job ID in filenames replaced by the patient ID), and their
+*_PROCESSINGresults.csv files are merged into one.
+
+"""
+
+import os
+import re
+import shutil
+
+import helpers as hp
+
+SUBPROCESSES = ('trust', 'vol', 'asl')
+MISSING_VALUES = ('-999', 'nan', 'NaN', '')
+
+
+def job_id(pt_id, subprocess_name):
+    """
+    The ID a job is run under, e.g., PTSTEN_001_01_trustjob
+    """
+
+    return f'{pt_id}_{subprocess_name}job'
+
+
+def make_job_folder(in_folder, the_job_id):
+    """
+    Makes a job folder next to the patient folder that links to the patient's Acquired data
+
+
+    Parameters
+    ----------
+    in_folder : str
+        the patient folder.
+    the_job_id : str
+        the job ID (see job_id()).
+
+    Returns
+    -------
+    str of the path to the job folder.
+
+    """
+
+    pt_folder = os.path.abspath(in_folder)
+    job_folder = os.path.join(os.path.dirname(pt_folder), the_job_id)
+    if os.path.lexists(job_folder):
+        remove_job_folder(job_folder) # left over from an interrupted run
+    os.mkdir(job_folder)
+    os.symlink(os.path.join(pt_folder, 'Acquired'), os.path.join(job_folder, 'Acquired'))
+    return job_folder
+
+
+def remove_job_folder(job_folder):
+    """
+    Deletes a job folder without following its link to the Acquired data
+    """
+
+    link = os.path.join(job_folder, 'Acquired')
+    if os.path.islink(link):
+        os.unlink(link)
+    shutil.rmtree(job_folder)
+
+
+def _is_missing(cell):
+    numeric = re.sub('[^0-9.-]', '', cell) # the same filtering parse_scd_csv does
+    return numeric in MISSING_VALUES or 'nan' in cell.lower()
+
+
+def merge_results_csvs(csvs, out_csv):
+    """
+    Merges *_PROCESSINGresults.csv files from jobs that each filled in only part of the results.
+    Cell by cell, the first value that isn't missing (-999/NaN) is kept
+
+
+    Parameters
+    ----------
+    csvs : list of str
+        the csvs to merge, in order of preference.
+    out_csv : str
+        the merged csv to write.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    tables = [open(c).read().split('\n') for c in csvs]
+    n_lines = max([len(t) for t in tables])
+
+    merged = []
+    for i in range(n_lines):
+        rows = [t[i].split(',') for t in tables if i < len(t)]
+        n_cells = max([len(r) for r in rows])
+        line = []
+        for j in range(n_cells):
+            cells = [r[j] for r in rows if j < len(r)]
+            present = [c for c in cells if not _is_missing(c)]
+            line.append(present[0] if present else cells[0])
+        merged.append(','.join(line))
+
+    with hp.atomic_output(out_csv) as tmp_name:
+        with open(tmp_name, 'w') as f:
+            f.write('\n'.join(merged))
+
+
+def collect_job_outputs(in_folder, pt_id, job_folders, merge=True):
+    """
+    Moves the outputs of the jobs into the patient folder and merges their results csvs
+    into the patient's, unless merge is False (e.g., when a job failed, so the merged
+    table would be partial)
+
+
+    Parameters
+    ----------
+    in_folder : str
+        the patient folder.
+    pt_id : str
+        the patient ID.
+    job_folders : dict
+        {job ID: job folder}, in order of preference for merging.
+    merge : bool, optional
+        whether to replace the patient's results csv with the merged one. The default is True.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    results_csvs = []
+    for the_job_id, job_folder in job_folders.items():
+        for folder, subfolders, files in os.walk(job_folder):
+            subfolders[:] = [s for s in subfolders if not os.path.islink(os.path.join(folder, s))]
+            for f in files:
+                src = os.path.join(folder, f)
+                rel = os.path.relpath(src, job_folder).replace(the_job_id, pt_id)
+                if rel == f'{pt_id}_PROCESSINGresults.csv':
+                    results_csvs.append(src)
+                    continue
+                dst = os.path.join(in_folder, rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(src, dst)
+
+    if not merge:
+        print(f'\n!!!!!\nWARNING: not all of the jobs finished, so {pt_id}_PROCESSINGresults.csv was left as it was\n!!!!!\n')
+    elif results_csvs:
+        merge_results_csvs(results_csvs, os.path.join(in_folder, f'{pt_id}_PROCESSINGresults.csv'))
+    else:
+        print('\n!!!!!\nWARNING: none of the jobs wrote a PROCESSINGresults csv\n!!!!!\n')
+
+    for job_folder in job_folders.values():
+        remove_job_folder(job_folder)
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Orders the jobs of a batch (see batch.py) for running several at a time.
+
+Each job's run time and peak memory are estimated from the step spans that
+earlier runs recorded in their telemetry logs (see telemetry.py). The estimate
+is per pipeline and step, scaled by the size of the patient's Acquired folder
+when earlier runs of the step took longer on bigger inputs, and only counts the
+steps the job will actually run (steps that are up to date are skipped, see
+step_graph.py). Steps with no history use rough defaults (DEFAULT_SECONDS,
+DEFAULT_MEMORY_MB).
+
+Jobs are then started in this order as workers become free:
+    fast lane : report-only jobs (BOLD steps 5-6, SCD steps 3-4) first, shortest
+        first, so quick clinical turnarounds don't wait behind MATLAB runs
+    the rest : longest first (LPT), so the long jobs don't all end up at the end of
+        the batch with most workers idle
+A job is only started if its estimated memory fits in what the running jobs
+leave of the memory budget. If nothing fits and nothing is running, the next
+job runs on its own.
+
+Running this script prints the estimates for a job file and the simulated
+batch time with first-in-first-out and with this ordering. Use batch.py -w to
+run a batch this way.
+
+input:
+    -j / --jobs : the job file (see batch.py)
+    -w / --workers : the number of jobs run at the same time. default: 4
+    -m / --memory : the memory budget in MB. default: 80% of this machine's memory
+    -y / --history : a telemetry log to learn from, in addition to the logs of the patients
+        in the job file and their cohort logs. can be passed more than once
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import io
+import getopt
+import time
+import glob
+import statistics
+import contextlib
+import importlib
+
+import telemetry
+
+REPORT_STEPS = {'bold':'56', 'scd':'34'} # steps that only make reports. jobs running only these take the fast lane
+
+# used for steps that have never been recorded
+DEFAULT_SECONDS = {'bold':{'1':30, '2':1200, '3':120, '4':300, '5':60, '6':30},
+                   'scd':{'1':30, '2':1200, '3':10, '4':60}}
+DEFAULT_MEMORY_MB = {'bold':{'2':4000, '3':2000, '4':2000},
+                     'scd':{'2':4000}} # steps not listed: 1000
+
+
+def folder_mb(folder):
+    # the size of a patient's raw scans in MB, from the directory entries only
+    total = 0
+    for path in glob.glob(os.path.join(folder, 'Acquired', '**', '*'), recursive=True):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total / 1024**2
+
+
+def memory_budget():
+    # 80% of this machine's physical memory, in MB
+    try:
+        return 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**2
+    except (ValueError, OSError, AttributeError):
+        return 8000
+
+
+def fit_line(points):
+    """
+    Least squares fit of y = a + b*x. b is kept at 0 or more (bigger inputs
+    don't make a step faster), and is 0 if the x values are all the same
+
+
+    Parameters
+    ----------
+    points : list of (x, y) tuples
+
+    Returns
+    -------
+    tuple of (a, b).
+
+    """
+
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum([(x - mean_x)**2 for x in xs])
+    if var_x == 0:
+        return statistics.median(ys), 0
+    b = max(0, sum([(x - mean_x)*(y - mean_y) for x, y in points]) / var_x)
+    return mean_y - b*mean_x, b
+
+
+def span_window(rec):
+    # the start and end of a span in seconds since the epoch, and how far off they may be
+    if rec.get('start_s') is not None:
+        return rec['start_s'], rec['start_s'] + (rec.get('wall_s') or 0), 0.01
+    start = time.mktime(time.strptime(rec['started'], "%Y-%m-%d %H:%M:%S")) # logged before start_s, only to the second
+    return start, start + (rec.get('wall_s') or 0), 1
+
+
+def step_programs(spans):
+    """
+    Finds the external programs (subprocess spans, which include MATLAB run by
+    the shell backend) each step ran. A program belongs to the step its parent
+    spans lead to. Programs started from another thread have no parent, and
+    belong to every step of the run that was running when they ran (e.g., both
+    of BOLD steps 3 and 4, which run at the same time)
+
+
+    Parameters
+    ----------
+    spans : list of dict
+        spans of any number of runs, each recorded once.
+
+    Returns
+    -------
+    dict of {(run, step): list of program spans}.
+
+    """
+
+    parents = {(r.get('run'), f"{r.get('kind')}:{r.get('name')}"):r.get('parent') for r in spans}
+    steps = [r for r in spans if r.get('kind') == 'step' and r.get('started') and r.get('wall_s') is not None]
+
+    programs = {}
+    for rec in spans:
+        if rec.get('proc_rss_peak_mb') is None or not rec.get('started'):
+            continue
+        run = rec.get('run')
+        label = rec.get('parent')
+        seen = set()
+        while label and not label.startswith('step:') and label not in seen:
+            seen.add(label)
+            label = parents.get((run, label))
+        if label and label.startswith('step:'):
+            owners = [label[5:]]
+        else:
+            start, end, slack = span_window(rec)
+            owners = [s['name'] for s in steps if s.get('run') == run and
+                      span_window(s)[0] - slack <= start and end <= span_window(s)[1] + slack]
+        for name in owners:
+            programs.setdefault((run, name), []).append(rec)
+    return programs
+
+
+def concurrent_peak(programs):
+    # the most memory the programs used at once: the peaks of programs that overlapped in time are added
+    events = []
+    for rec in programs:
+        start, end, slack = span_window(rec)
+        end = max(start, end - slack) # one program starting as another ends isn't an overlap
+        events += [(start, 1, rec['proc_rss_peak_mb']), (end, 0, -rec['proc_rss_peak_mb'])] # ends sort before starts
+    total = peak = 0
+    for when, order, mb in sorted(events):
+        total += mb
+        peak = max(peak, total)
+    return peak
+
+
+class CostModel:
+    """
+    Estimates of the run time and memory of each step, learned from recorded step spans.
+    A step's memory is how much it raised the peak memory of the pipeline process
+    (rss_growth_mb) plus the peak of the external programs it ran, added up where
+    they ran at the same time (see step_programs()). The pipeline process's own
+    baseline isn't counted, as the batch workers hold it whether or not a job runs
+
+
+    Parameters
+    ----------
+    records : list of dict
+        spans, e.g., from telemetry.read_logs(). Only successful step spans are used.
+    sizes : dict, optional
+        patient ID: size of its Acquired folder in MB. The default is None (no scaling by size).
+
+    """
+
+    def __init__(self, records, sizes=None):
+        sizes = sizes or {}
+        self.samples = {} # (pipeline, step): list of (input MB or None, seconds, memory MB)
+        spans = {}
+        for rec in records:
+            key = (rec.get('run'), rec.get('kind'), rec.get('name'), rec.get('parent'), rec.get('started'), rec.get('wall_s'))
+            spans.setdefault(key, rec) # the same span is in the patient and the cohort log
+        spans = list(spans.values())
+        programs = step_programs(spans)
+
+        for rec in spans:
+            if rec.get('kind') != 'step' or not rec.get('ok') or rec.get('wall_s') is None:
+                continue
+            if rec.get('rss_growth_mb') is None: # logged before rss_growth_mb was recorded
+                memory = (rec.get('rss_peak_mb') or 0) + (rec.get('child_rss_peak_mb') or 0)
+            else:
+                memory = rec['rss_growth_mb'] + concurrent_peak(programs.get((rec.get('run'), rec['name']), []))
+            self.samples.setdefault((rec['pipeline'], rec['name']), []).append((sizes.get(rec.get('patient')), rec['wall_s'], memory))
+
+    @classmethod
+    def from_folders(cls, folders, extra_logs=()):
+        """
+        Builds a model from the telemetry logs of patient folders, the cohort
+        logs next to them and any extra logs
+        """
+
+        logs = set(extra_logs)
+        if telemetry.COHORT_LOG:
+            logs.add(telemetry.COHORT_LOG)
+        parents = set()
+        for folder in folders:
+            logs.add(os.path.join(folder, telemetry.TELEMETRY_FILE))
+            parents.add(os.path.dirname(os.path.abspath(folder)))
+        for parent in parents:
+            logs.add(os.path.join(parent, telemetry.TELEMETRY_FILE))
+        records = telemetry.read_logs(sorted([log for log in logs if os.path.exists(log)]))
+
+        # the inputs of recorded patients are sized where they can be found next to the batch's patients
+        sizes = {}
+        for patient in set([r.get('patient') for r in records if r.get('kind') == 'step']):
+            for parent in parents:
+                if patient and os.path.isdir(os.path.join(parent, patient, 'Acquired')):
+                    sizes[patient] = folder_mb(os.path.join(parent, patient))
+                    break
+        return cls(records, sizes)
+
+    def step_seconds(self, pipeline, step, mb=None):
+        samples = self.samples.get((pipeline, step))
+        if not samples:
+            return DEFAULT_SECONDS.get(pipeline, {}).get(step, 60)
+        sized = [(x, s) for x, s, m in samples if x is not None]
+        if mb is not None and len(sized) >= 3:
+            a, b = fit_line(sized)
+            return max(0, a + b*mb)
+        return statistics.median([s for x, s, m in samples])
+
+    def step_memory(self, pipeline, step):
+        samples = self.samples.get((pipeline, step))
+        if not samples:
+            return DEFAULT_MEMORY_MB.get(pipeline, {}).get(step, 1000)
+        return max([m for x, s, m in samples])
+
+    def estimate(self, pipeline, steps, mb=None):
+        """
+        Estimates a job
+
+
+        Parameters
+        ----------
+        pipeline : str
+            'bold' or 'scd'.
+        steps : str
+            the steps the job will run, e.g., '123456'.
+        mb : float, optional
+            the size of the patient's Acquired folder. The default is None.
+
+        Returns
+        -------
+        tuple of (seconds, peak memory in MB).
+
+        """
+
+        seconds = sum([self.step_seconds(pipeline, step, mb) for step in steps])
+        memory = max([self.step_memory(pipeline, step) for step in steps], default=0)
+        return seconds, memory
+
+
+def steps_to_run(pipeline, argv):
+    """
+    The steps a job will run: the requested steps that aren't up to date.
+    Returns the patient folder too (None if the options can't be read)
+    """
+
+    module = importlib.import_module({'bold':'process_bold', 'scd':'process_scd'}[pipeline])
+    try:
+        run = module.parse_args(argv)
+    except (Exception, SystemExit):
+        return None, ''.join(sorted(DEFAULT_SECONDS[pipeline]))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()): # plan() prints the step plan
+            graph = module.plan(run)
+    except Exception:
+        return run.in_folder, run.steps
+    return run.in_folder, ''.join([name for name, (will_run, reason) in graph.plan.items() if will_run])
+
+
+def estimate_jobs(jobs, model=None, extra_logs=()):
+    """
+    Estimates the jobs of a batch
+
+
+    Parameters
+    ----------
+    jobs : list of (pipeline, argv) tuples
+        see batch.read_jobs().
+    model : CostModel, optional
+        the model. The default is None (built from the patients' telemetry logs and extra_logs).
+
+    Returns
+    -------
+    list of dict, one per job: n, pipeline, argv, patient, steps, mb, seconds, memory_mb, fast.
+
+    """
+
+    planned = []
+    for n, (pipeline, argv) in enumerate(jobs):
+        folder, steps = steps_to_run(pipeline, argv)
+        planned.append({'n':n, 'pipeline':pipeline, 'argv':list(argv), 'folder':folder, 'steps':steps,
+                        'patient':os.path.basename(os.path.normpath(folder)) if folder else f'job {n+1}'})
+    if model is None:
+        model = CostModel.from_folders([j['folder'] for j in planned if j['folder']], extra_logs)
+
+    for job in planned:
+        job['mb'] = folder_mb(job['folder']) if job['folder'] and os.path.isdir(job['folder']) else None
+        job['seconds'], job['memory_mb'] = model.estimate(job['pipeline'], job['steps'], job['mb'])
+        job['fast'] = all([step in REPORT_STEPS[job['pipeline']] for step in job['steps']])
+    return planned
+
+
+class Scheduler:
+    """
+    Decides which jobs start when workers free up. See help_info
+
+
+    Parameters
+    ----------
+    jobs : list of dict
+        from estimate_jobs().
+    workers : int
+        the number of jobs run at the same time.
+    memory_mb : float, optional
+        the memory budget. The default is None (memory_budget()).
+    policy : str, optional
+        'lpt' (fast lane, then longest first) or 'fifo' (job file order). The default is 'lpt'.
+
+    """
+
+    def __init__(self, jobs, workers, memory_mb=None, policy='lpt'):
+        self.workers = workers
+        self.memory_mb = memory_budget() if memory_mb is None else memory_mb
+        self.policy = policy
+        if policy == 'lpt':
+            fast = sorted([j for j in jobs if j['fast']], key=lambda j: j['seconds'])
+            rest = sorted([j for j in jobs if not j['fast']], key=lambda j: -j['seconds'])
+            self.pending = fast + rest
+        else:
+            self.pending = list(jobs)
+        self.running = []
+
+    def admit(self):
+        """
+        Returns the jobs to start now, and counts them as running
+        """
+
+        started = []
+        while self.pending and len(self.running) < self.workers:
+            used = sum([j['memory_mb'] for j in self.running])
+            fits = [j for j in self.pending if used + j['memory_mb'] <= self.memory_mb]
+            if self.policy == 'fifo':
+                fits = fits[:1] if fits and fits[0] is self.pending[0] else []
+            if fits:
+                job = fits[0]
+            elif not self.running:
+                job = self.pending[0]
+                print(f"{job['patient']} is estimated to need {round(job['memory_mb'])} MB, more than the "
+                      f"{round(self.memory_mb)} MB budget. Running it on its own")
+            else:
+                break
+            self.pending.remove(job)
+            self.running.append(job)
+            started.append(job)
+        return started
+
+    def finished(self, job):
+        self.running.remove(job)
+
+
+def simulate(jobs, workers, memory_mb=None, policy='lpt'):
+    """
+    Simulates running jobs with their estimated times
+
+
+    Returns
+    -------
+    dict of the total time and the mean time until the fast lane jobs finish.
+
+    """
+
+    scheduler = Scheduler(jobs, workers, memory_mb, policy)
+    now = 0
+    ends = {} # job n: end time
+    while scheduler.pending or scheduler.running:
+        for job in scheduler.admit():
+            ends[job['n']] = now + job['seconds']
+        job = min(scheduler.running, key=lambda j: ends[j['n']])
+        now = ends[job['n']]
+        scheduler.finished(job)
+    fast = [ends[j['n']] for j in jobs if j['fast']]
+    return {'total_seconds':round(now, 1), 'fast_lane_mean_seconds':round(statistics.mean(fast), 1) if fast else None}
+
+
+def run_scheduled(jobs, workers, memory_mb=None, keep_going=False, extra_logs=()):
+    """
+    Runs a batch on worker processes in the order of the Scheduler. Each
+    worker imports the pipelines once (see report_daemon.warm_up) and the
+    output of each job goes to logs/batch.log in its patient folder
+
+
+    Parameters
+    ----------
+    jobs : list of (pipeline, argv) tuples
+        see batch.read_jobs().
+    workers : int
+        the number of jobs run at the same time.
+    memory_mb : float, optional
+        the memory budget. The default is None (memory_budget()).
+    keep_going : bool, optional
+        carry on after a job fails. Otherwise no new jobs are started, and the running ones finish. The default is False.
+
+    Returns
+    -------
+    dict summarizing the batch, as batch.run_batch().
+
+    """
+
+    import multiprocessing
+    import concurrent.futures as cf
+    import report_daemon
+
+    planned = estimate_jobs(jobs, extra_logs=extra_logs)
+    scheduler = Scheduler(planned, workers, memory_mb)
+    print(f'{len(planned)} jobs on {workers} workers with a {round(scheduler.memory_mb)} MB memory budget. '
+          f'Estimated total: {simulate(planned, workers, scheduler.memory_mb)["total_seconds"]} s')
+
+    def start_pool():
+        return cf.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                      initializer=report_daemon.warm_up)
+
+    results = []
+    start = time.perf_counter()
+    futures = {}
+    stopping = False
+    pool = start_pool()
+    try:
+        while futures or (scheduler.pending and not stopping):
+            if not stopping:
+                for job in scheduler.admit():
+                    lane = 'fast lane' if job['fast'] else f"est. {round(job['seconds'])} s, {round(job['memory_mb'])} MB"
+                    print(f"{time.strftime('%H:%M:%S')} start {job['patient']} ({job['pipeline']} steps {job['steps'] or 'none'}, {lane})")
+                    try:
+                        future = pool.submit(report_daemon.run_in_worker, job['pipeline'], job['argv'], 'batch.log')
+                    except cf.process.BrokenProcessPool:
+                        pool = start_pool()
+                        future = pool.submit(report_daemon.run_in_worker, job['pipeline'], job['argv'], 'batch.log')
+                    futures[future] = (job, time.perf_counter())
+            done, _ = cf.wait(futures, return_when=cf.FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                job, job_start = futures.pop(future)
+                scheduler.finished(job)
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    # run_in_worker returns failures, so this is the worker itself dying (e.g., killed for memory),
+                    # which fails every job running in the pool
+                    outcome = {'status':'failed', 'error':f'{type(e).__name__}: {e}', 'log':None}
+                    broken = broken or isinstance(e, cf.process.BrokenProcessPool)
+                elapsed = time.perf_counter() - job_start
+                results.append({'pipeline':job['pipeline'], 'patient':job['patient'], 'status':outcome['status'],
+                                'error':outcome['error'], 'seconds':round(elapsed, 2), 'steps':job['steps'],
+                                'estimated_seconds':round(job['seconds'], 1), 'log':outcome['log']})
+                print(f"{time.strftime('%H:%M:%S')} {outcome['status']} {job['patient']} in {round(elapsed, 1)} s "
+                      f"(estimated {round(job['seconds'], 1)} s)" + (f" - {outcome['error']}" if outcome['error'] else ''))
+                if outcome['status'] != 'ok' and not keep_going and not stopping:
+                    stopping = True
+                    print(f"\n{job['patient']} failed. Not starting any more jobs (use -k / --keepgoing to carry on)")
+            if broken and not stopping:
+                print('A worker process died. Starting new workers')
+                pool.shutdown(wait=False)
+                pool = start_pool()
+    finally:
+        pool.shutdown(wait=True)
+
+    wall = time.perf_counter() - start
+    n_ok = sum([r['status'] == 'ok' for r in results])
+    summary = {'jobs':len(jobs), 'processed':len(results), 'succeeded':n_ok, 'workers':workers,
+               'wall_seconds':round(wall, 2), 'results':results}
+    print(f'\n{n_ok} of {len(jobs)} patients processed in {round(wall, 1)} s')
+    return summary
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "j:w:m:y:g", ['jobs=', 'workers=', 'memory=', 'history=', 'help'])
+
+    job_file = None
+    workers = 4
+    memory_mb = None
+    extra_logs = []
+
+    for opt, arg in options:
+        if opt in ('-j', '--jobs'):
+            job_file = arg
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-m', '--memory'):
+            memory_mb = float(arg)
+        elif opt in ('-y', '--history'):
+            extra_logs.append(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if job_file is None:
+        raise ValueError('A job file (-j) is required')
+
+    import batch
+
+    planned = estimate_jobs(batch.read_jobs(job_file), extra_logs=extra_logs)
+    print('Job estimates:')
+    for job in planned:
+        print(f"\t{job['patient']} ({job['pipeline']} steps {job['steps'] or 'none'}, {round(job['mb'] or 0, 1)} MB of scans): "
+              f"{round(job['seconds'], 1)} s, {round(job['memory_mb'])} MB" + (' [fast lane]' if job['fast'] else ''))
+
+    fifo = simulate(planned, workers, memory_mb, 'fifo')
+    lpt = simulate(planned, workers, memory_mb, 'lpt')
+    print(f'\nSimulated on {workers} workers:')
+    print(f"\tin job file order: {fifo['total_seconds']} s in total, fast lane jobs done after {fifo['fast_lane_mean_seconds']} s on average")
+    print(f"\tscheduled: {lpt['total_seconds']} s in total, fast lane jobs done after {lpt['fast_lane_mean_seconds']} s on average")
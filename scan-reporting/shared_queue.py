@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Spreads a batch of patients over several machines that mount the same shared
+drive, without a central server. The machines (nodes) coordinate through files
+in a shared queue folder:
+
+    jobs/[job].json : one per patient: the pipeline and its options
+    leases/[job].lease : the node working on a job. Created atomically (a hard link
+        that fails if the lease exists), and touched by its node every lease/4 seconds
+    done/[job].json : the outcome of a finished job
+
+Every node runs the same loop: take the next job that has no done file and no
+lease, or whose lease hasn't been touched for the lease time (its node crashed
+or lost the drive), and run it. A stolen job is resumed: steps whose outputs are
+up to date are skipped (see step_graph.py). Adding a node is just starting
+batch.py -d on another machine. The nodes' clocks should be in sync (NTP), as
+lease ages are compared across machines.
+
+This script is the test harness: it runs several local node processes against
+one temporary queue folder with stand-in jobs that just sleep, kills one of
+them partway through a job, and checks that every job finishes and that only
+the killed node's job was run twice. Use batch.py -d to process real patients.
+
+input:
+    -o / --outfolder : the folder for the harness. Must not exist yet
+    -n / --nodes : the number of node processes. default: 3
+    -j / --jobs : the number of jobs. default: 12
+    -s / --seconds : how long each stand-in job takes. default: 1
+    -l / --lease : the lease time in seconds. default: 4
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import getopt
+import json
+import time
+import socket
+import hashlib
+import threading
+import subprocess
+
+LEASE = 120 # seconds without a touch before a lease is taken to be abandoned
+POLL = 5 # seconds between looks at the queue when every job left is leased
+
+
+def node_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def link_create(path, content):
+    """
+    Atomically creates path with content, failing with FileExistsError if it
+    exists. The content is written to a temporary file that is then hard
+    linked into place, which is atomic on NFS as well as local disks
+    """
+
+    tmp = f'{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.link(tmp, path)
+    finally:
+        os.remove(tmp)
+
+
+def write_replace(path, content):
+    # writes a file atomically, replacing it if it exists
+    tmp = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class SharedQueue:
+    """
+    A queue folder on a shared drive
+
+
+    Parameters
+    ----------
+    folder : str
+        the queue folder. Made if it doesn't exist.
+    lease : float, optional
+        seconds without a touch before a lease is abandoned. The default is LEASE.
+    node : str, optional
+        this node's name. The default is None (host:pid).
+
+    """
+
+    def __init__(self, folder, lease=LEASE, node=None):
+        self.folder = folder
+        self.lease = lease
+        self.node = node or node_name()
+        for sub in ('jobs', 'leases', 'done'):
+            os.makedirs(os.path.join(folder, sub), exist_ok=True)
+
+    def path(self, kind, job_id):
+        ext = {'jobs':'json', 'leases':'lease', 'done':'json'}[kind]
+        return os.path.join(self.folder, kind, f'{job_id}.{ext}')
+
+    def publish(self, jobs):
+        """
+        Adds jobs to the queue. The job ids come from the jobs' position and
+        content, so several nodes publishing the same job file add each job once
+
+
+        Parameters
+        ----------
+        jobs : list of (pipeline, argv) tuples
+            see batch.read_jobs().
+
+        Returns
+        -------
+        list of the job ids.
+
+        """
+
+        ids = []
+        for n, (pipeline, argv) in enumerate(jobs):
+            spec = json.dumps({'pipeline':pipeline, 'args':list(argv)})
+            job_id = f'{n:05d}-{hashlib.sha1(spec.encode()).hexdigest()[:10]}'
+            try:
+                link_create(self.path('jobs', job_id), spec)
+            except FileExistsError:
+                pass
+            ids.append(job_id)
+        return ids
+
+    def job_ids(self):
+        return sorted([f[:-5] for f in os.listdir(os.path.join(self.folder, 'jobs')) if f.endswith('.json')])
+
+    def job(self, job_id):
+        with open(self.path('jobs', job_id)) as f:
+            return json.load(f)
+
+    def is_done(self, job_id):
+        return os.path.exists(self.path('done', job_id))
+
+    def lease_age(self, job_id):
+        # seconds since the lease was last touched, or None if there is no lease
+        try:
+            return time.time() - os.stat(self.path('leases', job_id)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def lease_owner(self, job_id):
+        try:
+            with open(self.path('leases', job_id)) as f:
+                return json.load(f)['node']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def try_claim(self, job_id):
+        """
+        Tries to take a job: creates its lease if it has none, or steals its
+        lease if it has expired
+
+
+        Returns
+        -------
+        str: 'claimed', 'stolen' or None if the job couldn't be taken.
+
+        """
+
+        if self.is_done(job_id):
+            return None
+        lease = self.path('leases', job_id)
+        content = json.dumps({'node':self.node, 'claimed':time.strftime('%Y-%m-%d %H:%M:%S')})
+        try:
+            link_create(lease, content)
+            how = 'claimed'
+        except FileExistsError:
+            age = self.lease_age(job_id)
+            if age is None or age < self.lease:
+                return None
+            # move the expired lease aside. only one node's rename can succeed
+            stale = f'{lease}.{socket.gethostname()}.{os.getpid()}.stale'
+            try:
+                os.rename(lease, stale)
+            except FileNotFoundError:
+                return None
+            if time.time() - os.stat(stale).st_mtime < self.lease:
+                # it was touched just before the rename: its node is alive after all. give it back
+                try:
+                    os.link(stale, lease)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return None
+            os.remove(stale)
+            try:
+                link_create(lease, content)
+            except FileExistsError:
+                return None
+            how = 'stolen'
+        if self.is_done(job_id): # finished between the check and the claim
+            self.release(job_id)
+            return None
+        return how
+
+    def touch(self, job_id):
+        """
+        Refreshes this node's lease on a job. Returns False if the lease has
+        been lost (stolen by another node after it expired)
+        """
+
+        if self.lease_owner(job_id) != self.node:
+            return False
+        now = time.time()
+        try:
+            os.utime(self.path('leases', job_id), (now, now))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, job_id):
+        if self.lease_owner(job_id) == self.node:
+            try:
+                os.remove(self.path('leases', job_id))
+            except FileNotFoundError:
+                pass
+
+    def finish(self, job_id, result):
+        result = dict(result, node=self.node, finished=time.strftime('%Y-%m-%d %H:%M:%S'))
+        write_replace(self.path('done', job_id), json.dumps(result, indent=4))
+        self.release(job_id)
+
+    def results(self):
+        results = {}
+        for job_id in self.job_ids():
+            try:
+                with open(self.path('done', job_id)) as f:
+                    results[job_id] = json.load(f)
+            except FileNotFoundError:
+                results[job_id] = None
+        return results
+
+
+def work(queue, run, poll=POLL):
+    """
+    Takes and runs jobs until every job in the queue is done. While the jobs
+    left are all leased by other nodes, waits in case one of their leases
+    expires
+
+
+    Parameters
+    ----------
+    queue : SharedQueue
+        the queue.
+    run : function
+        called with (pipeline, argv) to run a job. Returns a dict for the done file (e.g., status, seconds).
+    poll : float, optional
+        seconds between looks at the queue when every job left is leased. The default is POLL.
+
+    Returns
+    -------
+    list of the ids of the jobs this node ran.
+
+    """
+
+    ran = []
+    while True:
+        left = [j for j in queue.job_ids() if not queue.is_done(j)]
+        if not left:
+            return ran
+        for job_id in left:
+            how = queue.try_claim(job_id)
+            if how is None:
+                continue
+            job = queue.job(job_id)
+            print(f'{queue.node}: {how} {job_id} ({job["pipeline"]} {" ".join(job["args"])})', flush=True)
+
+            stop = threading.Event()
+            lost = []
+            def beat():
+                while not stop.wait(queue.lease / 4):
+                    if not queue.touch(job_id):
+                        lost.append(True)
+                        print(f'{queue.node}: lost the lease on {job_id}', flush=True)
+                        return
+            thread = threading.Thread(target=beat, daemon=True)
+            thread.start()
+            try:
+                result = run(job['pipeline'], job['args'])
+            finally:
+                stop.set()
+                thread.join()
+            result['how'] = how
+            if lost:
+                result['lease_lost'] = True
+            queue.finish(job_id, result)
+            ran.append(job_id)
+            break # look at the queue afresh: earlier jobs may have been freed
+        else:
+            time.sleep(poll)
+
+
+def test_job(pipeline, argv):
+    # the stand-in job of the harness: sleeps, and records that it ran
+    seconds = float(os.environ.get('SHARED_QUEUE_TEST_SECONDS', 1))
+    with open(os.environ['SHARED_QUEUE_TEST_LOG'], 'a') as f:
+        f.write(f'{argv[1]} {node_name()} start\n')
+    time.sleep(seconds)
+    with open(os.environ['SHARED_QUEUE_TEST_LOG'], 'a') as f:
+        f.write(f'{argv[1]} {node_name()} end\n')
+    return {'status':'ok', 'seconds':seconds}
+
+
+def simulate(out_folder, nodes=3, jobs=12, seconds=1, lease=4):
+    """
+    The test harness. See help_info
+
+
+    Returns
+    -------
+    dict of the results. 'passed' is True if every check passed.
+
+    """
+
+    queue_folder = os.path.join(out_folder, 'queue')
+    os.makedirs(out_folder)
+    log = os.path.join(out_folder, 'runs.log')
+    queue = SharedQueue(queue_folder, lease=lease)
+    queue.publish([('test', ['-i', f'job{i:03d}']) for i in range(jobs)])
+    open(log, 'w').close()
+
+    env = dict(os.environ, SHARED_QUEUE_TEST_SECONDS=str(seconds), SHARED_QUEUE_TEST_LOG=log)
+    command = [sys.executable, '-c', 'import sys, shared_queue as sq; sq.work(sq.SharedQueue(sys.argv[1], float(sys.argv[2])), sq.test_job, poll=0.2)',
+               queue_folder, str(lease)]
+    start = time.time()
+    procs = [subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=open(os.path.join(out_folder, f'node{i}.log'), 'w'), stderr=subprocess.STDOUT)
+             for i in range(nodes)]
+
+    # kill the first node partway through a job
+    time.sleep(seconds * 1.5)
+    procs[0].kill()
+    killed = f'{socket.gethostname()}:{procs[0].pid}'
+    for proc in procs[1:]:
+        proc.wait()
+    wall = time.time() - start
+
+    runs = {}
+    for line in open(log).read().splitlines():
+        job, node, what = line.split(' ')
+        runs.setdefault(job, []).append((node, what))
+
+    results = queue.results()
+    unfinished = [j for j, r in results.items() if r is None]
+    twice = sorted([j for j, r in runs.items() if len([w for n, w in r if w == 'start']) > 1])
+    killed_jobs = sorted([j for j, r in runs.items() if (killed, 'start') in r and (killed, 'end') not in r])
+    stolen = sorted([j for j, r in results.items() if r and r.get('how') == 'stolen'])
+    by_node = {}
+    for r in results.values():
+        if r:
+            by_node[r['node']] = by_node.get(r['node'], 0) + 1
+
+    passed = not unfinished and twice == killed_jobs and len(stolen) == len(killed_jobs)
+    summary = {'nodes':nodes, 'jobs':jobs, 'seconds':seconds, 'lease':lease, 'wall_seconds':round(wall, 2),
+               'killed_node':killed, 'killed_jobs':killed_jobs, 'run_twice':twice, 'stolen':stolen,
+               'unfinished':unfinished, 'jobs_per_node':by_node, 'passed':passed}
+    with open(os.path.join(out_folder, 'simulation.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    print(f'{jobs} jobs of {seconds} s on {nodes} nodes (one killed) in {round(wall, 1)} s')
+    print(f'Jobs per node: {by_node}')
+    print(f'Job the killed node was running: {killed_jobs}. Stolen: {stolen}. Run more than once: {twice}. Unfinished: {unfinished}')
+    print(f'\nSimulation {"passed" if passed else "FAILED"}')
+    return summary
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "o:n:j:s:l:g", ['outfolder=', 'nodes=', 'jobs=', 'seconds=', 'lease=', 'help'])
+
+    out_folder = None
+    nodes = 3
+    jobs = 12
+    seconds = 1
+    lease = 4
+
+    for opt, arg in options:
+        if opt in ('-o', '--outfolder'):
+            out_folder = arg
+        elif opt in ('-n', '--nodes'):
+            nodes = int(arg)
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt in ('-s', '--seconds'):
+            seconds = float(arg)
+        elif opt in ('-l', '--lease'):
+            lease = float(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if out_folder is None:
+        raise ValueError('An output folder (-o) is required')
+
+    summary = simulate(out_folder, nodes, jobs, seconds, lease)
+    sys.exit(0 if summary['passed'] else 1)
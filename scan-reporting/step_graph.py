@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Describes the processing steps of each pipeline as a dependency graph, and
+decides which requested steps actually need to run.
+
+Each step lists the files it reads and the files it writes as glob patterns
+relative to the patient folder. When a step finishes, the size and
+modification time (and optionally a SHA-1) of its inputs and outputs are
+recorded in step_state.json in the patient folder, along with a digest of
+the run options and processing answers (see decisions.py) the step's outputs
+depend on, e.g., the date of birth shown in the BOLD report. A requested step
+is then skipped on a later run if:
+    it has outputs, and all of them still exist unchanged
+    its inputs are unchanged since it last ran
+    its options and answers are the same as when it last ran
+    none of the steps it depends on are going to run
+
+Steps with no outputs (e.g., pushing to REDCap) always run when requested.
+
+Each step that runs is also recorded as a telemetry span, from should_run()
+returning True to mark_done().
+
+"""
+
+import os
+import glob
+import json
+import time
+import hashlib
+import threading
+
+import telemetry
+
+STATE_FILE = 'step_state.json'
+
+
+class Step:
+    """
+    A single pipeline step
+
+
+    Parameters
+    ----------
+    name : str
+        the step number as used with -s (e.g., '2').
+    description : str
+        a short human-readable description.
+    inputs : list of str, optional
+        glob patterns (relative to the patient folder) of the files the step reads.
+    outputs : list of str, optional
+        glob patterns (relative to the patient folder) of the files the step writes.
+    depends : list of str, optional
+        names of the steps whose outputs this step needs.
+    params : list of str, optional
+        names of the run options (e.g., 'dobage') the step's outputs depend on.
+    answers : list of str, optional
+        keys of the processing questions (see decisions.py) the step's outputs depend on.
+
+    """
+
+    def __init__(self, name, description, inputs=(), outputs=(), depends=(), params=(), answers=()):
+        self.name = name
+        self.description = description
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.depends = list(depends)
+        self.params = list(params)
+        self.answers = list(answers)
+
+
+_bold_maps = ['processed/**/*CBF_MNI*.nii.gz',
+              'processed/**/*ZSTAT1_MNI_normalized*.nii.gz',
+              'processed/**/*ZMAX2STANDARD_normalized*.nii.gz',
+              'processed/**/*TMAX2STANDARD*.nii.gz']
+
+
+def bold_steps(pt_id):
+    """
+    The steps of process_bold.py
+    """
+
+    return [Step('1', 'deidentification', inputs=['Acquired/*'], outputs=['Acquired/*']),
+            Step('2', 'MATLAB main processing', inputs=['Acquired/*'], outputs=_bold_maps, depends=['1'], answers=['asl_type']),
+            Step('3', 'CVR movie', inputs=_bold_maps, outputs=[f'{pt_id}_zstatMovie.nii.gz'], depends=['2']),
+            Step('4', 'metrics calculation', inputs=_bold_maps, outputs=['CBF_metrics.csv', 'TMAX_metrics.csv'], depends=['2']),
+            Step('5', 'reporting images', inputs=_bold_maps + ['Acquired/**/*FLAIR*', 'thresh_vals.csv'],
+                 outputs=['reporting_images/*_report_image.png'], depends=['2'],
+                 answers=['thresh_search', 'thresh_scan', 'thresh_index']),
+            Step('6', 'powerpoint report', inputs=['reporting_images/*.png', '*_metrics.csv', 'etco2.csv', 'thresh_vals.csv'],
+                 outputs=[f'{pt_id}_report.pptx'], depends=['4', '5'], params=['dobage'], answers=['scan_date'])
+            ]
+
+
+def scd_steps(pt_id):
+    """
+    The steps of process_scd.py
+    """
+
+    results = f'{pt_id}_PROCESSINGresults.csv'
+    subject = ['hematocrit', 'art_ox_sat', 'pt_type', 'exclude'] # given, or 'redcap' to look them up
+    return [Step('1', 'deidentification', inputs=['Acquired/*'], outputs=['Acquired/*']),
+            Step('2', 'MATLAB main processing (TRUST, volumetrics, ASL)', inputs=['Acquired/*'], outputs=[results], depends=['1'],
+                 params=subject + ['flip', 'auto'], answers=['asl_missing', 'asl_params', 'asl_pld', 'asl_ld', 'asl_tr']),
+            Step('3', 'push results to REDCap', inputs=[results], outputs=[], depends=['2']),
+            Step('4', 'PDF report', inputs=[results, 'decay_params.csv', 'Processed/CBF2mm/*', 'Processed/*_3D_MNI_nonBET.nii.gz'],
+                 outputs=['reporting/*_report.pdf'], depends=['2'],
+                 params=subject + ['birth_date', 'gender', 'scan_date', 'study_id'])
+            ]
+
+
+def value_digest(value):
+    # options and answers are stored as digests so names and dates of birth don't end up in step_state.json
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def file_digest(path, chunk_size=4*1024**2):
+    """
+    SHA-1 of a file's contents
+    """
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class StepGraph:
+    """
+    Decides which requested steps need to run, and records steps as they finish
+
+
+    Parameters
+    ----------
+    folder : str
+        the patient folder.
+    steps : list of Step
+        all the steps of the pipeline, e.g., bold_steps(pt_id).
+    requested : str
+        the requested steps as passed with -s (e.g., '123456').
+    force : bool, optional
+        if True, every requested step runs regardless of its state. The default is False.
+    use_hash : bool, optional
+        if True, file contents are hashed in addition to comparing size and
+        modification time. Slower, but catches files that were rewritten with
+        an old timestamp. The default is False.
+    params : dict, optional
+        the run's options, {name: value}, as given (before anything is looked
+        up in REDCap). The default is None (no options).
+    decide : DecisionProvider, optional
+        where the run gets its processing answers. The default is None (no answers).
+
+    """
+
+    def __init__(self, folder, steps, requested, force=False, use_hash=False, params=None, decide=None):
+        self.folder = folder
+        self.steps = {s.name:s for s in steps}
+        self.requested = [s.name for s in steps if s.name in requested]
+        self.force = force
+        self.use_hash = use_hash
+        self.params = dict(params or {})
+        self.decide = decide
+        self.state_file = os.path.join(folder, STATE_FILE)
+        self._spans = {}
+        self.listeners = [] # functions called with the name of each step marked done
+        self._lock = threading.Lock() # steps run concurrently can finish at the same time
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rereads the step state and remakes the plan, e.g., after waiting for
+        another run on the same patient to finish
+        """
+
+        try:
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.state = {}
+        self.plan = self._make_plan()
+
+    def fingerprint(self, patterns):
+        """
+        Gets the size, modification time and optionally hash of every file matching a set of patterns
+
+
+        Parameters
+        ----------
+        patterns : list of str
+            glob patterns relative to the patient folder.
+
+        Returns
+        -------
+        dict of {relative path: [size, mtime_ns] or [size, mtime_ns, sha1]}.
+
+        """
+
+        prints = {}
+        for pattern in patterns:
+            for path in glob.glob(os.path.join(self.folder, pattern), recursive=True):
+                if not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                fp = [st.st_size, st.st_mtime_ns]
+                if self.use_hash:
+                    fp.append(file_digest(path))
+                prints[os.path.relpath(path, self.folder)] = fp
+        return prints
+
+    def _same(self, recorded, current):
+        # a recorded hash is only compared if we're hashing this time too
+        if recorded.keys() != current.keys():
+            return False
+        for key, now in current.items():
+            then = recorded[key]
+            if len(now) == 3 and len(then) == 3:
+                if now[2] != then[2]:
+                    return False
+            elif now[:2] != then[:2]:
+                return False
+        return True
+
+    def _staleness(self, step):
+        # returns None if the step's outputs are current, otherwise the reason they are not
+        if not step.outputs:
+            return 'always runs (no outputs)'
+        record = self.state.get(step.name)
+        if record is None:
+            return 'never run'
+        outputs = self.fingerprint(step.outputs)
+        if not outputs:
+            return 'outputs missing'
+        if not self._same(record['outputs'], outputs):
+            return 'outputs changed'
+        if not self._same(record['inputs'], self.fingerprint(step.inputs)):
+            return 'inputs changed'
+        changed = [p for p in step.params if record.get('params', {}).get(p) != value_digest(self.params.get(p))]
+        changed += [key for key, then in record.get('answers', {}).items() if then != self._answer_digest(key, then)]
+        if changed:
+            return f'parameters changed ({", ".join(changed)})'
+        return None
+
+    def _answer_digest(self, key, then):
+        # what the run would answer without asking, recorded the way mark_done() does.
+        # an answer typed in at a prompt can only be compared with another prompt
+        answer = self.decide.peek(key) if self.decide is not None else None
+        if answer is not None:
+            return value_digest(answer)
+        if self.decide is not None and self.decide.auto and then.startswith('auto:'):
+            return then # --auto answers are fixed in the pipeline, so one recorded with --auto still holds
+        return 'prompt'
+
+    def _make_plan(self):
+        plan = {}
+        for name in self.requested: # steps are numbered in dependency order
+            step = self.steps[name]
+            upstream = [d for d in step.depends if plan.get(d, (False,))[0]]
+            if self.force:
+                plan[name] = (True, 'forced')
+            elif upstream:
+                plan[name] = (True, f'step {",".join(upstream)} will run first')
+            else:
+                reason = self._staleness(step)
+                plan[name] = (reason is not None, reason or 'up to date')
+        return plan
+
+    def should_run(self, name):
+        """
+        Whether a step should run in this invocation. Steps that were not requested never run
+        """
+
+        if name not in self.plan:
+            return False
+        run, reason = self.plan[name]
+        if not run:
+            print(f'\nSkipping step {name} ({self.steps[name].description}): up to date. Use --force to rerun it')
+        elif name not in self._spans:
+            self._spans[name] = telemetry.begin('step', name, description=self.steps[name].description, reason=reason)
+        return run
+
+    def mark_done(self, name):
+        """
+        Records that a step finished successfully, so later runs can skip it
+        """
+
+        with self._lock:
+            step = self.steps[name]
+            answers = {}
+            if self.decide is not None:
+                for key in step.answers:
+                    if self.decide.answered_by(key) == 'prompt':
+                        answers[key] = 'prompt'
+                    elif self.decide.answered_by(key) == 'auto':
+                        answers[key] = f'auto:{value_digest(self.decide.answer_of(key))}'
+                    elif self.decide.answered_by(key) is not None:
+                        answers[key] = value_digest(self.decide.answer_of(key))
+            self.state[name] = {'finished':time.strftime("%Y-%m-%d %H:%M:%S"),
+                                'inputs':self.fingerprint(step.inputs),
+                                'outputs':self.fingerprint(step.outputs),
+                                'params':{p:value_digest(self.params.get(p)) for p in step.params},
+                                'answers':answers}
+            tmp_file = os.path.join(self.folder, f'.{STATE_FILE}.{os.getpid()}.tmp')
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state, f, indent=1)
+            os.replace(tmp_file, self.state_file) # readers never see a half-written state
+
+            if name in self._spans:
+                telemetry.end(self._spans.pop(name))
+            for listener in self.listeners:
+                listener(name)
+
+    def describe(self):
+        """
+        Gets a human-readable listing of what would run and why
+        """
+
+        lines = []
+        for name, (run, reason) in self.plan.items():
+            verb = 'RUN ' if run else 'SKIP'
+            lines.append(f'\t{verb} step {name} ({self.steps[name].description}): {reason}')
+        return '\n'.join(lines)
@@ -0,0 +1,6 @@
+#!/bin/sh
+# Stand-in for the first part of the CVR movie generation. Point the BOLD
+# pipeline at the stub scripts folder with
+#     export SCAN_REPORTING_BOLD_SCRIPTS=/path/to/scan-reporting/stubs/bold_scripts
+echo "[stub mkZstatMov_part1_v2.sh] $1"
+sleep "${STUB_SCRIPT_SECONDS:-1}"
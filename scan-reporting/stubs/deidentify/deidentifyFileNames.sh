@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the deidentifyFileNames.sh script. Point the pipelines at the
+stub deidentify folder with
+    export SCAN_REPORTING_BOLD_DEIDENTIFY=/path/to/scan-reporting/stubs/deidentify
+    export SCAN_REPORTING_SCD_DEIDENTIFY=/path/to/scan-reporting/stubs/deidentify
+
+Usage: deidentifyFileNames.sh pt_folder name replacement
+Replaces name with replacement in the names of the files in pt_folder/Acquired.
+"""
+
+import os
+import sys
+
+pt_folder, name, replacement = sys.argv[1:4]
+acq_folder = os.path.join(pt_folder, 'Acquired')
+for f in sorted(os.listdir(acq_folder)):
+    if name in f:
+        os.rename(os.path.join(acq_folder, f), os.path.join(acq_folder, f.replace(name, replacement)))
+        print(f'[stub deidentifyFileNames] {f}', flush=True)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the deidentifyPARfiles.sh script (see deidentifyFileNames.sh).
+
+Usage: deidentifyPARfiles.sh pt_folder
+Blanks the patient name in the headers of the PAR files in pt_folder/Acquired.
+"""
+
+import os
+import re
+import sys
+
+pt_folder = sys.argv[1]
+acq_folder = os.path.join(pt_folder, 'Acquired')
+for f in sorted(os.listdir(acq_folder)):
+    if not f.endswith('.PAR'):
+        continue
+    path = os.path.join(acq_folder, f)
+    with open(path, errors='replace') as fob:
+        text = fob.read()
+    text = re.sub(r'(\.\s+Patient name\s+:).*', r'\1 ', text)
+    with open(path, 'w') as fob:
+        fob.write(text)
+    print(f'[stub deidentifyPARfiles] {f}', flush=True)
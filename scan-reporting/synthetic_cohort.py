@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Generates a cohort of synthetic patient folders and optionally runs them
+end-to-end through process_bold.py or process_scd.py with the stubs in the
+stubs folder standing in for MATLAB, the MATLAB scripts, dcm2nii, the DICOM
+converter and the deidentify scripts. This gives a reproducible way to
+measure patients/hour and to try out changes to the pipelines without
+patient data or MATLAB.
+
+Each synthetic PTSTEN folder has
+    Acquired : raw scans as PAR/REC (with realistic headers) or NiFTI, still
+        named with a fake patient name so step 1 has something to deidentify.
+        SCD pCASL scans are named with _PLD/_LD and the TRUST source with TRUST_VEIN
+    the outputs the MATLAB processing would have written, so the reporting
+        steps have something to work on
+        BOLD : processed/ MNI maps (CBF, CVR, CVRmax, CVRdelay), CBF_metrics.csv,
+            TMAX_metrics.csv
+        SCD : [PTSTEN_ID]_PROCESSINGresults.csv, decay_params.csv, Processed/ MNI maps
+    etco2.csv (BOLD)
+    params.json : answers to every processing question, so runs are unattended
+The cohort folder also gets a copy of the repository's bin folder (the report
+templates, logos and dot images), a manifest (cohort.json) and, after a run, the logs of every
+patient and throughput.json.
+
+With -w / --warm, each of the -j workers is one batch.py process that runs its
+share of the patients one after another, instead of one process per patient,
+so the two can be compared.
+
+input:
+    -o / --outfolder : the folder to make the cohort in. Must not exist yet
+    -n / --number : the number of patients. default: 4
+    -p / --pipeline : bold or scd. default: bold
+    -f / --format : the format of the raw scans, par or nii. default: par
+    -d / --dynamics : the number of dynamics in the BOLD series. default: 60
+    -s / --seed : random seed. default: 0
+    -x / --run : run the cohort after generating it. does not take an argument
+    -j / --jobs : the number of patients processed at the same time when running. default: 1
+    -t / --steps : the steps to run. default: all of them (123456 for BOLD, 124 for SCD)
+    -w / --warm : run the patients through batch.py (see above). does not take an argument
+    -r / --rerun : after the run, check that running the cohort again with the same options would skip
+        every step (the SCD patients answer some questions with --auto). exits with 1 if not.
+        does not take an argument
+    -g / --help : brings up this helpful information. does not take an argument
+
+    Environment variables STUB_MATLAB_SECONDS and STUB_SCRIPT_SECONDS set how
+    long the stub MATLAB and movie script calls take (default 2 and 1 seconds).
+"""
+
+import os
+import sys
+import getopt
+import time
+import json
+import shutil
+import datetime
+import subprocess
+import shlex
+import concurrent.futures
+
+import numpy as np
+import nibabel as nib
+
+from benchmarks import VOLUME_SHAPES, synthetic_nii, synthetic_map
+from external import stub_environment, REPO_BIN_FOLDER
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NAMES = ['SMITHJOHN', 'GARCIAMARIA', 'JOHNSONAVA', 'LEEDANIEL', 'BROWNEMMA', 'NGUYENLIAM',
+         'PATELPRIYA', 'DAVISNOAH', 'LOPEZSOFIA', 'WILSONOWEN', 'MOORECHLOE', 'TAYLORMASON']
+
+# series number, protocol and shape (x, y, slices) of the scans in the Acquired folders
+BOLD_SCANS = [(2, 'WIP_3D_T1', (128, 128, 60)),
+              (3, 'WIP_T2W_FLAIR_AX', (128, 128, 24)),
+              (4, 'WIP_pCASL', (64, 64, 17)),
+              (5, 'WIP_BOLD_CVR', (64, 64, 20))]
+SCD_SCANS = [(2, 'WIP_3D_T1', (128, 128, 60)),
+             (3, 'WIP_T2W_FLAIR_AX', (128, 128, 24)),
+             (4, 'WIP_pCASL_PLD1800_LD1800_SENSE', (64, 64, 17)),
+             (6, 'WIP_SOURCE_TRUST_VEIN', (64, 64, 1))]
+
+PAR_GENERAL = """# === DATA DESCRIPTION FILE ======================================================
+#
+# CAUTION - Investigational device.
+# Limited by Federal Law to investigational use.
+#
+# Dataset name: {name}
+#
+# CLINICAL TRYOUT             Research image export tool     V4.2
+#
+# === GENERAL INFORMATION ========================================================
+#
+.    Patient name                       :   {patient}
+.    Examination name                   :   Synthetic
+.    Protocol name                      :   {protocol}
+.    Examination date/time              :   {date} / 09:30:00
+.    Series Type                        :   Image   MRSERIES
+.    Acquisition nr                     :   {series}
+.    Reconstruction nr                  :   1
+.    Scan Duration [sec]                :   {duration:.2f}
+.    Max. number of cardiac phases      :   1
+.    Max. number of echoes              :   1
+.    Max. number of slices/locations    :   {slices}
+.    Max. number of dynamics            :   {dynamics}
+.    Max. number of mixes               :   1
+.    Patient position                   :   Head First Supine
+.    Preparation direction              :   Anterior-Posterior
+.    Technique                          :   FEEPI
+.    Scan resolution  (x, y)            :   {x}  {y}
+.    Scan mode                          :   MS
+.    Repetition time [ms]               :   {tr:.3f}
+.    FOV (ap,fh,rl) [mm]                :   {fov_y:.3f}  {fov_z:.3f}  {fov_x:.3f}
+.    Water Fat shift [pixels]           :   8.000
+.    Angulation midslice(ap,fh,rl)[degr]:   0.000  0.000  0.000
+.    Off Centre midslice(ap,fh,rl) [mm] :   0.000  0.000  0.000
+.    Flow compensation <0=no 1=yes> ?   :   0
+.    Presaturation     <0=no 1=yes> ?   :   0
+.    Phase encoding velocity [cm/sec]   :   0.000000  0.000000  0.000000
+.    MTC               <0=no 1=yes> ?   :   0
+.    SPIR              <0=no 1=yes> ?   :   0
+.    EPI factor        <0,1=no EPI>     :   1
+.    Dynamic scan      <0=no 1=yes> ?   :   {is_dynamic}
+.    Diffusion         <0=no 1=yes> ?   :   0
+.    Diffusion echo time [ms]           :   0.0000
+.    Max. number of diffusion values    :   1
+.    Max. number of gradient orients    :   1
+.    Number of label types   <0=no ASL> :   0
+#
+# === IMAGE INFORMATION ==========================================================
+#  sl ec  dyn ph ty    idx pix scan% rec size                (re)scale              window        angulation              offcentre        thick   gap   info      spacing     echo     dtime   ttime    diff  avg  flip    freq   RR-int  turbo delay b grad cont anis         diffusion       L.ty
+
+"""
+
+
+def write_par_rec(out_stem, data, patient, protocol, series, scan_date, tr=2000, voxel=(3, 3, 4)):
+    """
+    Writes a volume as a Philips PAR/REC pair (PAR version 4.2) that nibabel
+    and the pipelines can read
+
+
+    Parameters
+    ----------
+    out_stem : str
+        path of the files to write, without the extension.
+    data : numpy array of int16
+        the image, 3D (x, y, slices) or 4D (x, y, slices, dynamics).
+    patient : str
+        the patient name written in the header.
+    protocol : str
+        the protocol name written in the header.
+    series : int
+        the acquisition number.
+    scan_date : str
+        the exam date as YYYY.mm.dd.
+    tr : float, optional
+        the repetition time in ms. The default is 2000.
+    voxel : tuple of float, optional
+        the voxel size (x, y, slice thickness) in mm. The default is (3, 3, 4).
+
+    Returns
+    -------
+    str of the path to the PAR.
+
+    """
+
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    x, y, slices, dynamics = data.shape
+
+    header = PAR_GENERAL.format(name=os.path.basename(out_stem), patient=patient, protocol=protocol,
+                                date=scan_date, series=series, duration=tr*dynamics/1000, slices=slices,
+                                dynamics=dynamics, x=x, y=y, tr=tr, fov_x=x*voxel[0], fov_y=y*voxel[1],
+                                fov_z=slices*voxel[2], is_dynamic=int(dynamics > 1))
+    lines = []
+    index = 0
+    for dyn in range(dynamics):
+        for sl in range(slices):
+            offcentre = (sl - slices/2) * voxel[2]
+            lines.append(f'{sl+1:3d}   1 {dyn+1:4d}  1 0 2 {index:5d}  16   100 {x:4d} {y:4d}     0.00000 1.00000 1.00000e+000  1000  2000'
+                         f'   0.00   0.00   0.00    0.00 {offcentre:7.2f}    0.00  {voxel[2]:.3f}  0.000 0 1 0 2  {voxel[0]:.3f}  {voxel[1]:.3f}  10.00'
+                         f' {dyn*tr/1000:8.2f}     0.00    0.00   1   90.00     0    0    0     1   0.0  1   1    4    0   0.000    0.000    0.000  1')
+            index += 1
+
+    par_name = f'{out_stem}.PAR'
+    with open(par_name, 'w') as f:
+        f.write(header)
+        f.write('\n'.join(lines))
+        f.write('\n\n# === END OF DATA DESCRIPTION FILE ===============================================\n')
+
+    # the REC is every image one after the other, in the order of the index column
+    images = data.transpose(0, 1, 3, 2).reshape(x, y, slices*dynamics)
+    with open(f'{out_stem}.REC', 'wb') as f:
+        f.write(images.astype('<i2').tobytes(order='F'))
+    return par_name
+
+
+def synthetic_scan(shape, dynamics=1, seed=0):
+    """
+    Makes the data of a raw scan: a "head" of smooth values with noise, plus a
+    slow oscillation over the dynamics for a series (like a CVR response)
+    """
+
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    radius = sum([((g - n/2) / (n/2))**2 for g, n in zip(grid, shape)])
+    head = radius < 0.8
+    base = 800 * (1 - radius) * head
+    if dynamics == 1:
+        return (base + rng.normal(0, 20, shape) * head).astype(np.int16)
+
+    response = 1 + 0.03 * np.sin(np.linspace(0, 4*np.pi, dynamics))
+    data = base[..., np.newaxis] * response + rng.normal(0, 20, shape + (dynamics,)) * head[..., np.newaxis]
+    return data.astype(np.int16)
+
+
+def write_acquired(acq_folder, patient, scans, fmt, scan_date, dynamics, seed=0):
+    """
+    Writes the raw scans of a patient to its Acquired folder
+    """
+
+    os.makedirs(acq_folder)
+    for i, (series, protocol, shape) in enumerate(scans):
+        n_dyn = dynamics if 'BOLD' in protocol else 1
+        if 'TRUST' in protocol:
+            n_dyn = 24
+        data = synthetic_scan(shape, n_dyn, seed=seed+i)
+        tr = 4000 if 'pCASL' in protocol else 2000
+        stem = os.path.join(acq_folder, f'{patient}_{series}_1_{protocol}')
+        if fmt == 'par':
+            write_par_rec(stem, data, patient, protocol, series, scan_date, tr=tr)
+        else:
+            nib.save(nib.Nifti1Image(data, np.diag([3, 3, 4, 1])), f'{stem}.nii.gz')
+
+
+def write_bold_outputs(pt_folder, pt_id, rng, seed=0):
+    """
+    Writes what the BOLD MATLAB processing would have: the MNI maps in processed,
+    the metrics CSVs, plus the etco2.csv that is added by hand
+    """
+
+    processed = os.path.join(pt_folder, 'processed')
+    os.makedirs(processed)
+    shape = VOLUME_SHAPES['mni4mm']
+    for i, signature in enumerate(('CBF_MNI', 'ZSTAT1_MNI_normalized', 'ZMAX2STANDARD_normalized', 'TMAX2STANDARD')):
+        synthetic_map(os.path.join(processed, f'{pt_id}_{signature}.nii.gz'), shape, seed=seed+i)
+
+    # one header line of six values (lACA, rACA, lMCA, rMCA, lPCA, rPCA). they're read as column
+    # names, so they're made unique
+    for name, low, high in (('CBF_metrics.csv', 30, 70), ('TMAX_metrics.csv', 5, 40)):
+        values = rng.uniform(low, high, 6).round(4) + np.arange(6) * 1e-4
+        with open(os.path.join(pt_folder, name), 'w') as f:
+            f.write(','.join(values.astype(str)) + '\n')
+
+    dyns = np.arange(1, 361, 6)
+    co2 = 40 + 8 * (np.sin(dyns / 30) > 0) + rng.normal(0, 1, len(dyns))
+    with open(os.path.join(pt_folder, 'etco2.csv'), 'w') as f:
+        f.write('dynamic,etco2\n')
+        f.writelines([f'{d},{round(c, 2)}\n' for d, c in zip(dyns, co2)])
+
+
+def write_scd_outputs(pt_folder, pt_id, rng, seed=0):
+    """
+    Writes what the SCD MATLAB processing would have: the PROCESSINGresults csv,
+    decay_params.csv and the MNI maps used in the report
+    """
+
+    # labels have no digits, periods or dashes because parse_scd_csv strips everything else out of the lines
+    def pair(label, a, b):
+        return f'{label} one, {a}, {label} two, {b}'
+
+    lines = [f'processing results for {pt_id}',
+             'ASL, PLD 1800, LD 1800, TR 4',
+             pair('Tb (s)', round(rng.uniform(0.05, 0.07), 4), round(rng.uniform(0.05, 0.07), 4)),
+             pair('Yv bovine', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             pair('Yv HbF', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             pair('Yv HbAA', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             pair('Yv HbSS', round(rng.uniform(0.55, 0.7), 4), round(rng.uniform(0.55, 0.7), 4)),
+             f'white volume: {round(rng.uniform(400, 500), 2)}',
+             f'grey volume: {round(rng.uniform(550, 700), 2)}',
+             f'csf volume: {round(rng.uniform(150, 300), 2)}']
+    while len(lines) < 22:
+        if len(lines) in (15, 18):
+            values = rng.uniform(30, 80, 12).round(2)
+            label = 'territory CBF' if len(lines) == 15 else 'territory CBF sd'
+            lines.append(f'{label}: ' + ', '.join(values.astype(str)))
+        else:
+            lines.append('unused')
+    with open(os.path.join(pt_folder, f'{pt_id}_PROCESSINGresults.csv'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    # rows: effective echo times, mean sagittal sinus signal, its max and min, then [signal at eTE 0, T2, T2 min, T2 max]
+    ete = np.array([0, 40, 80, 160])
+    t2 = rng.uniform(0.05, 0.07)
+    signal = 1000 * np.exp(-(ete / 1000) / t2)
+    rows = [ete, signal, signal * 1.05, signal * 0.95, [1000, t2, t2 * 0.9, t2 * 1.1]]
+    with open(os.path.join(pt_folder, 'decay_params.csv'), 'w') as f:
+        f.writelines([','.join([str(round(v, 5)) for v in row]) + '\n' for row in rows])
+
+    processed = os.path.join(pt_folder, 'Processed')
+    os.makedirs(os.path.join(processed, 'CBF2mm'))
+    shape = VOLUME_SHAPES['mni2mm']
+    synthetic_map(os.path.join(processed, 'CBF2mm', f'{pt_id}_CBF_MNI_2mm.nii.gz'), shape, seed=seed)
+    synthetic_nii(os.path.join(processed, f'{pt_id}_3D_MNI_nonBET.nii.gz'), shape, seed=seed+1)
+
+
+def make_bin_folder(bin_folder):
+    """
+    Makes the cohort's bin folder, a copy of the repository's (the report
+    templates, logos and dot images), so runs use the real report assets
+    """
+
+    shutil.copytree(REPO_BIN_FOLDER, bin_folder)
+
+
+def make_cohort(out_folder, number=4, pipeline='bold', fmt='par', dynamics=60, seed=0):
+    """
+    Generates a synthetic cohort
+
+
+    Parameters
+    ----------
+    out_folder : str
+        the folder to make the cohort in. Must not exist yet.
+    number : int, optional
+        the number of patients. The default is 4.
+    pipeline : str, optional
+        'bold' or 'scd'. The default is 'bold'.
+    fmt : str, optional
+        'par' or 'nii', the format of the raw scans. The default is 'par'.
+    dynamics : int, optional
+        the number of dynamics in the BOLD series. The default is 60.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    dict of the cohort manifest (also written to out_folder/cohort.json).
+
+    """
+
+    if pipeline not in ('bold', 'scd'):
+        raise ValueError(f'pipeline must be bold or scd, not {pipeline}')
+    if fmt not in ('par', 'nii'):
+        raise ValueError(f'format must be par or nii, not {fmt}')
+
+    os.makedirs(out_folder)
+    make_bin_folder(os.path.join(out_folder, 'bin'))
+    rng = np.random.default_rng(seed)
+
+    patients = []
+    for i in range(number):
+        pt_id = f'PTSTEN_{900+i:03d}_01'
+        name = NAMES[i % len(NAMES)]
+        if i >= len(NAMES):
+            name = f'{name}{chr(65 + i // len(NAMES))}'
+        pt_folder = os.path.join(out_folder, pt_id)
+        scan_date = (datetime.date(2019, 1, 7) + datetime.timedelta(days=int(rng.integers(0, 700)))).strftime('%Y.%m.%d')
+        dob = (datetime.date(1950, 1, 1) + datetime.timedelta(days=int(rng.integers(0, 18000)))).strftime('%Y.%m.%d')
+
+        print(f'Generating {pt_id} ({pipeline}, {fmt})')
+        scans = BOLD_SCANS if pipeline == 'bold' else SCD_SCANS
+        write_acquired(os.path.join(pt_folder, 'Acquired'), name, scans, fmt, scan_date, dynamics, seed=seed+100*i)
+
+        answers = {'nifti_beta':'acknowledge', 'deidentify_missing':'y'}
+        if pipeline == 'bold':
+            write_bold_outputs(pt_folder, pt_id, rng, seed=seed+100*i)
+            answers.update({'asl_type':'pCASL', 'thresh_search':'n', 'scan_date':scan_date})
+        else:
+            write_scd_outputs(pt_folder, pt_id, rng, seed=seed+100*i)
+            # asl_missing and asl_params are left to --auto (-y 1), so auto answers are exercised too
+            answers.update({'trust_rename':'fix', 'redcap_push':'n'})
+        with open(os.path.join(pt_folder, 'params.json'), 'w') as f:
+            json.dump(answers, f, indent=4)
+
+        patients.append({'pt_id':pt_id, 'name':name, 'folder':pt_folder, 'dob':dob, 'scan_date':scan_date})
+
+    manifest = {'pipeline':pipeline, 'format':fmt, 'dynamics':dynamics, 'seed':seed, 'patients':patients}
+    with open(os.path.join(out_folder, 'cohort.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def patient_command(patient, pipeline, steps=None):
+    """
+    Builds the command that processes one synthetic patient
+    """
+
+    if pipeline == 'bold':
+        return [sys.executable, os.path.join(HERE, 'process_bold.py'), '-i', patient['folder'], '-n', patient['name'],
+                '-s', steps or '123456', '-d', patient['dob'], '-q']
+    return [sys.executable, os.path.join(HERE, 'process_scd.py'), '-i', patient['folder'], '-n', patient['name'],
+            '-s', steps or '124', '-h', '0.3', '-p', 'sca', '-a', '0.98', '-r', '0', '-y', '1',
+            '-b', patient['dob'], '-u', 'female', '-t', patient['scan_date'], '-x', f'Synthetic_{patient["pt_id"]}', '-q']
+
+
+def run_cohort(out_folder, jobs=1, steps=None, warm=False):
+    """
+    Runs every patient of a synthetic cohort through its pipeline with the stubs
+
+
+    Parameters
+    ----------
+    out_folder : str
+        the cohort folder made by make_cohort().
+    jobs : int, optional
+        the number of patients processed at the same time. The default is 1.
+    steps : str, optional
+        the steps to run. The default is None (all of them).
+    warm : bool, optional
+        run the patients in jobs batch.py processes rather than one process
+        each. The default is False.
+
+    Returns
+    -------
+    dict of the throughput summary (also written to out_folder/throughput.json).
+
+    """
+
+    with open(os.path.join(out_folder, 'cohort.json')) as f:
+        manifest = json.load(f)
+    pipeline = manifest['pipeline']
+
+    env = dict(os.environ)
+    env.update(stub_environment(os.path.abspath(os.path.join(out_folder, 'bin'))))
+    env['SCAN_REPORTING_TELEMETRY_LOG'] = os.path.abspath(os.path.join(out_folder, 'telemetry.jsonl'))
+    env['MPLBACKEND'] = 'Agg'
+
+    log_folder = os.path.join(out_folder, 'logs')
+    os.makedirs(log_folder, exist_ok=True)
+
+    def run_one(patient):
+        log_name = os.path.join(log_folder, f'{patient["pt_id"]}.log')
+        start = time.perf_counter()
+        with open(log_name, 'w') as log:
+            proc = subprocess.run(patient_command(patient, pipeline, steps), stdout=log, stderr=subprocess.STDOUT,
+                                  stdin=subprocess.DEVNULL, env=env, cwd=HERE)
+        elapsed = time.perf_counter() - start
+        status = 'ok' if proc.returncode == 0 else f'failed ({proc.returncode})'
+        print(f'{patient["pt_id"]}: {status} in {round(elapsed, 1)} s. Log: {log_name}')
+        return {'pt_id':patient['pt_id'], 'returncode':proc.returncode, 'seconds':round(elapsed, 2)}
+
+    def run_warm(worker, patients):
+        # one batch.py process for a share of the patients
+        job_file = os.path.join(log_folder, f'batch_{worker}.jobs')
+        report = os.path.join(log_folder, f'batch_{worker}.json')
+        with open(job_file, 'w') as f:
+            for patient in patients:
+                f.write(' '.join([pipeline] + [shlex.quote(a) for a in patient_command(patient, pipeline, steps)[2:]]) + '\n')
+        log_name = os.path.join(log_folder, f'batch_{worker}.log')
+        with open(log_name, 'w') as log:
+            subprocess.run([sys.executable, os.path.join(HERE, 'batch.py'), '-j', job_file, '-k', '-r', report],
+                           stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, env=env, cwd=HERE)
+        with open(report) as f:
+            batch_results = json.load(f)['results']
+        results = []
+        for r in batch_results:
+            returncode = 0 if r['status'] == 'ok' else 1
+            print(f"{r['patient']}: {r['status']} in {r['seconds']} s. Log: {log_name}")
+            results.append({'pt_id':r['patient'], 'returncode':returncode, 'seconds':r['seconds']})
+        return results
+
+    mode = f'{jobs} batch.py process(es)' if warm else f'process_{pipeline}.py, {jobs} at a time'
+    print(f'Running {len(manifest["patients"])} patients through {mode}')
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        if warm:
+            shares = [manifest['patients'][i::jobs] for i in range(jobs)]
+            results = [r for share in pool.map(run_warm, range(jobs), shares) for r in share]
+        else:
+            results = list(pool.map(run_one, manifest['patients']))
+    wall = time.perf_counter() - start
+
+    n_ok = sum([r['returncode'] == 0 for r in results])
+    summary = {'pipeline':pipeline, 'jobs':jobs, 'steps':steps, 'warm':warm, 'patients':len(results), 'succeeded':n_ok,
+               'wall_seconds':round(wall, 2), 'patients_per_hour':round(n_ok / wall * 3600, 2) if wall else None,
+               'stub_matlab_seconds':float(env.get('STUB_MATLAB_SECONDS', 2)),
+               'stub_script_seconds':float(env.get('STUB_SCRIPT_SECONDS', 1)),
+               'results':results}
+    with open(os.path.join(out_folder, 'throughput.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    print(f'\n{n_ok} of {len(results)} patients processed in {round(wall, 1)} s: {summary["patients_per_hour"]} patients/hour')
+    return summary
+
+
+def check_rerun(out_folder, steps=None):
+    """
+    Plans every patient of a cohort that has been run again with the same
+    options. Nothing should need to run: a step that would is a step the
+    step state (see step_graph.py) failed to record or to match
+
+
+    Returns
+    -------
+    list of (patient ID, step, reason) of the steps that would run again.
+
+    """
+
+    import io
+    import contextlib
+    import importlib
+
+    with open(os.path.join(out_folder, 'cohort.json')) as f:
+        manifest = json.load(f)
+    module = importlib.import_module({'bold':'process_bold', 'scd':'process_scd'}[manifest['pipeline']])
+
+    reruns = []
+    for patient in manifest['patients']:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run = module.parse_args(patient_command(patient, manifest['pipeline'], steps)[2:])
+            graph = module.plan(run)
+        for name, (will_run, reason) in graph.plan.items():
+            if will_run:
+                reruns.append((patient['pt_id'], name, reason))
+    return reruns
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "o:n:p:f:d:s:xj:t:wrg", ['outfolder=', 'number=', 'pipeline=', 'format=', 'dynamics=',
+                                                                             'seed=', 'run', 'jobs=', 'steps=', 'warm', 'rerun', 'help'])
+
+    out_folder = None
+    number = 4
+    pipeline = 'bold'
+    fmt = 'par'
+    dynamics = 60
+    seed = 0
+    run = False
+    jobs = 1
+    steps = None
+    warm = False
+    rerun = False
+
+    for opt, arg in options:
+        if opt in ('-o', '--outfolder'):
+            out_folder = arg
+        elif opt in ('-n', '--number'):
+            number = int(arg)
+        elif opt in ('-p', '--pipeline'):
+            pipeline = arg
+        elif opt in ('-f', '--format'):
+            fmt = arg
+        elif opt in ('-d', '--dynamics'):
+            dynamics = int(arg)
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+        elif opt in ('-x', '--run'):
+            run = True
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt in ('-t', '--steps'):
+            steps = arg
+        elif opt in ('-w', '--warm'):
+            warm = True
+        elif opt in ('-r', '--rerun'):
+            rerun = True
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if out_folder is None:
+        raise ValueError('An output folder (-o) is required')
+
+    make_cohort(out_folder, number, pipeline, fmt, dynamics, seed)
+    if run:
+        summary = run_cohort(out_folder, jobs, steps, warm)
+        if summary['succeeded'] < summary['patients']:
+            sys.exit(1)
+        if rerun:
+            reruns = check_rerun(out_folder, steps)
+            for pt_id, name, reason in reruns:
+                print(f'{pt_id}: step {name} would run again ({reason})')
+            print(f'Rerun check: {len(reruns)} step(s) would run again')
+            if reruns:
+                sys.exit(1)
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Records how long each part of processing takes, and summarizes those records
+across runs.
+
+While a pipeline runs, every step, external program call, MATLAB call, REDCap
+request and image render is recorded as a "span" with its wall time, the CPU
+time of this process and the CPU time of the child processes it waited for.
+Spans are written as JSON lines to telemetry.jsonl in the patient folder (next
+to meta.txt) and to a cohort-level log, by default telemetry.jsonl in the
+folder containing the patient folders (override with SCAN_REPORTING_TELEMETRY_LOG).
+
+Spans also record resource use, for this process and for its child processes
+(dcm2nii, the perl converter, MATLAB, the deidentify scripts, ...):
+    rss_peak_mb / child_rss_peak_mb : the peak resident memory of this process,
+        and of the largest child waited for, so far in the run (these are
+        high-water marks, so a stage's value includes earlier stages)
+    rss_growth_mb : how much this process's peak resident memory rose during
+        the span, i.e., what the span itself added on top of earlier stages
+    proc_rss_peak_mb : the exact peak of the one external program a
+        subprocess span ran (and anything it waited for)
+    read_mb / write_mb : bytes this process read from and wrote to storage
+        during the span (from /proc/self/io where it exists)
+    child_read_mb / child_write_mb : the same for waited-for children, from
+        their block I/O counts
+When a run finishes, the peak figures of each stage are written to
+run_resources.json in the patient folder and summarized in meta.txt, for
+sizing how many patients can be processed at once.
+
+Running this script summarizes telemetry logs, giving the count, p50, p95 and
+total wall time, and the mean CPU and child CPU time, of each stage.
+
+input:
+    -i / --infile : a telemetry log. can be passed more than once
+    -k / --kind : only summarize spans of this kind (run, step, subprocess, matlab, redcap or render)
+    -p / --pipeline : only summarize spans from this pipeline (bold or scd)
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import atexit
+import resource
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+TELEMETRY_FILE = 'telemetry.jsonl'
+RESOURCES_FILE = 'run_resources.json'
+COHORT_LOG = os.environ.get('SCAN_REPORTING_TELEMETRY_LOG')
+
+_sinks = []
+_context = {}
+_open = {} # span id: span, for spans started with begin() that haven't ended
+_lock = threading.Lock()
+_local = threading.local()
+_counter = [0]
+_records = [] # spans recorded in this run
+
+# ru_maxrss is in kilobytes on Linux but bytes on macOS
+_MAXRSS_TO_MB = 1 / 1024**2 if sys.platform == 'darwin' else 1 / 1024
+_BLOCK_BYTES = 512
+
+
+def configure(pt_folder, pipeline, cohort_log=None):
+    """
+    Starts recording spans for a run on a patient. Also starts a span for the whole run,
+    after ending the span of any earlier run in this process that was never finished
+
+
+    Parameters
+    ----------
+    pt_folder : str
+        the patient folder. Spans are written to telemetry.jsonl here.
+    pipeline : str
+        'bold' or 'scd'.
+    cohort_log : str, optional
+        the cohort-level log. The default is COHORT_LOG, or telemetry.jsonl in the parent of pt_folder.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    finish(ok=False, error='did not finish') # a run this process left open is recorded against its own patient
+    pt_folder = os.path.abspath(pt_folder)
+    if cohort_log is None:
+        cohort_log = COHORT_LOG or os.path.join(os.path.dirname(pt_folder), TELEMETRY_FILE)
+
+    _sinks[:] = [os.path.join(pt_folder, TELEMETRY_FILE), cohort_log]
+    _records.clear()
+    _context.clear()
+    _context.update({'folder':pt_folder,
+                     'run':f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}',
+                     'pipeline':pipeline,
+                     'patient':os.path.basename(pt_folder)})
+    _context['run_span'] = begin('run', pipeline)
+
+
+def _proc_io():
+    # bytes actually read from and written to storage by this process, or None where /proc doesn't exist
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def resource_snapshot():
+    """
+    Gets the current resource counters of this process and its waited-for children
+
+
+    Returns
+    -------
+    dict of CPU seconds (cpu, child_cpu), peak RSS in MB (rss_peak, child_rss_peak),
+        and bytes read and written (io: (read, write) or None, child_io: (read, write)).
+
+    """
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = _proc_io()
+    if io is None:
+        io = (own.ru_inblock * _BLOCK_BYTES, own.ru_oublock * _BLOCK_BYTES)
+    return {'cpu':time.process_time(),
+            'child_cpu':kids.ru_utime + kids.ru_stime,
+            'rss_peak':own.ru_maxrss * _MAXRSS_TO_MB,
+            'child_rss_peak':kids.ru_maxrss * _MAXRSS_TO_MB,
+            'io':io,
+            'child_io':(kids.ru_inblock * _BLOCK_BYTES, kids.ru_oublock * _BLOCK_BYTES)}
+
+
+def rusage_fields(usage):
+    """
+    Converts the rusage of a single child process (e.g., from os.wait4) to span fields
+    """
+
+    return {'proc_rss_peak_mb':round(usage.ru_maxrss * _MAXRSS_TO_MB, 1),
+            'proc_cpu_s':round(usage.ru_utime + usage.ru_stime, 4),
+            'proc_read_mb':round(usage.ru_inblock * _BLOCK_BYTES / 1024**2, 2),
+            'proc_write_mb':round(usage.ru_oublock * _BLOCK_BYTES / 1024**2, 2)}
+
+
+def _write(record):
+    if not _sinks:
+        return
+    line = json.dumps(record) + '\n'
+    with _lock:
+        for sink in _sinks:
+            try:
+                with open(sink, 'a') as f:
+                    f.write(line)
+            except OSError as e:
+                print(f'Could not write telemetry to {sink}: {e}')
+
+
+def begin(kind, name, **fields):
+    """
+    Starts a span that is ended later with end(). Prefer span() where the work fits in a with block
+
+
+    Parameters
+    ----------
+    kind : str
+        the kind of work (run, step, subprocess, matlab, redcap or render).
+    name : str
+        what is being done, e.g., the step number or the program name.
+    **fields
+        anything else to record with the span.
+
+    Returns
+    -------
+    int of the span id.
+
+    """
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    with _lock:
+        _counter[0] += 1
+        span_id = _counter[0]
+        _open[span_id] = {'kind':kind, 'name':str(name), 'fields':fields,
+                          'parent':stack[-1] if stack else None,
+                          'started':time.time(), 'wall0':time.perf_counter(),
+                          'usage0':resource_snapshot()}
+    stack.append(span_id)
+    return span_id
+
+
+def end(span_id, ok=True, error=None, **fields):
+    """
+    Ends a span started with begin() and records it
+
+
+    Parameters
+    ----------
+    span_id : int
+        the id returned by begin().
+    ok : bool, optional
+        whether the work succeeded. The default is True.
+    error : str, optional
+        what went wrong, if it didn't. The default is None.
+    **fields
+        anything else to record with the span.
+
+    Returns
+    -------
+    dict of the recorded span, or None if the span had already ended.
+
+    """
+
+    with _lock:
+        span = _open.pop(span_id, None)
+    if span is None:
+        return None
+    stack = getattr(_local, 'stack', [])
+    if span_id in stack:
+        stack.remove(span_id)
+
+    parent = _open.get(span['parent'])
+    before = span['usage0']
+    after = resource_snapshot()
+    record = {'run':_context.get('run'), 'pipeline':_context.get('pipeline'), 'patient':_context.get('patient'),
+              'kind':span['kind'], 'name':span['name'],
+              'parent':f"{parent['kind']}:{parent['name']}" if parent else None,
+              'started':time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(span['started'])),
+              'start_s':round(span['started'], 3),
+              'wall_s':round(time.perf_counter() - span['wall0'], 4),
+              'cpu_s':round(after['cpu'] - before['cpu'], 4),
+              'child_cpu_s':round(after['child_cpu'] - before['child_cpu'], 4),
+              'rss_peak_mb':round(after['rss_peak'], 1),
+              'child_rss_peak_mb':round(after['child_rss_peak'], 1),
+              'rss_growth_mb':round(after['rss_peak'] - before['rss_peak'], 1),
+              'read_mb':round((after['io'][0] - before['io'][0]) / 1024**2, 2),
+              'write_mb':round((after['io'][1] - before['io'][1]) / 1024**2, 2),
+              'child_read_mb':round((after['child_io'][0] - before['child_io'][0]) / 1024**2, 2),
+              'child_write_mb':round((after['child_io'][1] - before['child_io'][1]) / 1024**2, 2),
+              'ok':ok}
+    if error is not None:
+        record['error'] = error
+    record.update(span['fields'])
+    record.update(fields)
+    _write(record)
+    with _lock:
+        _records.append(record)
+    return record
+
+
+def annotate(**fields):
+    """
+    Adds fields to the innermost open span of the calling thread
+    """
+
+    stack = getattr(_local, 'stack', [])
+    with _lock:
+        if stack and stack[-1] in _open:
+            _open[stack[-1]]['fields'].update(fields)
+
+
+@contextmanager
+def span(kind, name, **fields):
+    """
+    Records the work done in a with block as a span. See begin() for the parameters
+    """
+
+    span_id = begin(kind, name, **fields)
+    try:
+        yield
+    except BaseException as e:
+        end(span_id, ok=False, error=f'{type(e).__name__}: {e}')
+        raise
+    end(span_id)
+
+
+def timed(kind, name=None):
+    """
+    Decorator that records every call to a function as a span. The name defaults to the function's name
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def finish(ok=True, error=None):
+    """
+    Ends the run span. Call when processing completes, or with ok=False when
+    it fails in a process that carries on (e.g., to the next patient of a
+    batch), so the failed run's open spans aren't left to end at exit
+    """
+
+    run_span = _context.pop('run_span', None)
+    if run_span is None:
+        return
+    if not ok:
+        for span_id in sorted(_open, reverse=True):
+            if span_id != run_span:
+                end(span_id, ok=False, error=error)
+    end(run_span, ok=ok, error=error)
+    write_run_resources()
+
+
+def stage_resources(records):
+    """
+    Collects the peak resource use of each stage of a run
+
+
+    Parameters
+    ----------
+    records : list of dict
+        the spans of one run.
+
+    Returns
+    -------
+    dict of {kind:name: {figure: value}}, where the figures are the maximum
+        over all the spans of the stage (wall and CPU times are summed).
+
+    """
+
+    stages = {}
+    for rec in records:
+        stage = stages.setdefault(f"{rec['kind']}:{rec['name']}", {'n':0})
+        stage['n'] += 1
+        for key in ('wall_s', 'cpu_s', 'child_cpu_s'):
+            stage[key] = round(stage.get(key, 0) + rec.get(key, 0), 4)
+        for key in ('rss_peak_mb', 'child_rss_peak_mb', 'proc_rss_peak_mb', 'read_mb', 'write_mb', 'child_read_mb', 'child_write_mb'):
+            if rec.get(key) is not None:
+                stage[key] = max(stage.get(key, 0), rec[key])
+    return stages
+
+
+def write_run_resources():
+    """
+    Writes the per-stage resource use of the run to run_resources.json and appends a summary to meta.txt
+    """
+
+    folder = _context.get('folder')
+    if folder is None:
+        return
+    stages = stage_resources(_records)
+    run = stages.get(f"run:{_context['pipeline']}", {})
+    summary = {'run':_context['run'], 'pipeline':_context['pipeline'], 'patient':_context['patient'],
+               'rss_peak_mb':run.get('rss_peak_mb'), 'child_rss_peak_mb':run.get('child_rss_peak_mb'),
+               'stages':stages}
+    tmp_file = os.path.join(folder, f'.{RESOURCES_FILE}.{os.getpid()}.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(tmp_file, os.path.join(folder, RESOURCES_FILE))
+
+    with open(os.path.join(folder, 'meta.txt'), 'a') as f:
+        f.write(f"\n\nResource use (peak RSS of this process: {summary['rss_peak_mb']} MB, largest child: {summary['child_rss_peak_mb']} MB)\n")
+        for name, stage in stages.items():
+            if name.startswith('step:'):
+                f.write(f"\tstep {name[5:]}: {round(stage['wall_s']/60, 2)} min, cpu {round(stage['cpu_s'], 1)} s, "
+                        f"child cpu {round(stage['child_cpu_s'], 1)} s, peak RSS {stage.get('rss_peak_mb')} MB, "
+                        f"child peak RSS {stage.get('child_rss_peak_mb')} MB, "
+                        f"read {stage.get('read_mb')} MB, wrote {stage.get('write_mb')} MB, "
+                        f"children read {stage.get('child_read_mb')} MB, wrote {stage.get('child_write_mb')} MB\n")
+
+
+@atexit.register
+def _end_unfinished():
+    # anything still open at exit (including the run) didn't finish
+    for span_id in sorted(_open, reverse=True):
+        end(span_id, ok=False, error='did not finish')
+
+
+def read_logs(paths):
+    """
+    Reads telemetry logs into a list of span dicts, skipping lines that aren't valid JSON
+    """
+
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    return records
+
+
+def summarize(records, kind=None, pipeline=None):
+    """
+    Summarizes spans per stage
+
+
+    Parameters
+    ----------
+    records : list of dict
+        spans, e.g., from read_logs().
+    kind : str, optional
+        only summarize spans of this kind. The default is None.
+    pipeline : str, optional
+        only summarize spans from this pipeline. The default is None.
+
+    Returns
+    -------
+    pandas DataFrame indexed by (pipeline, kind, name), sorted by total wall time.
+
+    """
+
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    if df.empty:
+        return df
+    if kind is not None:
+        df = df[df['kind'] == kind]
+    if pipeline is not None:
+        df = df[df['pipeline'] == pipeline]
+
+    grouped = df.groupby(['pipeline', 'kind', 'name'])
+    summary = pd.DataFrame({'n':grouped['wall_s'].count(),
+                            'failed':grouped['ok'].apply(lambda ok: int((~ok.astype(bool)).sum())),
+                            'p50_wall_s':grouped['wall_s'].quantile(0.5),
+                            'p95_wall_s':grouped['wall_s'].quantile(0.95),
+                            'total_wall_s':grouped['wall_s'].sum(),
+                            'mean_cpu_s':grouped['cpu_s'].mean(),
+                            'mean_child_cpu_s':grouped['child_cpu_s'].mean()})
+    for key in ('rss_peak_mb', 'child_rss_peak_mb', 'proc_rss_peak_mb'):
+        if key in df:
+            summary[f'max_{key}'] = grouped[key].max()
+    return summary.sort_values('total_wall_s', ascending=False).round(2)
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "i:k:p:g", ["infile=", "kind=", "pipeline=", "help"])
+
+    in_files = []
+    kind = None
+    pipeline = None
+    for opt, arg in options:
+        if opt in ('-i', '--infile'):
+            in_files.append(arg)
+        elif opt in ('-k', '--kind'):
+            kind = arg
+        elif opt in ('-p', '--pipeline'):
+            pipeline = arg
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if not in_files:
+        raise Exception('at least one telemetry log must be given with -i')
+
+    import pandas as pd
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(summarize(read_logs(in_files), kind=kind, pipeline=pipeline))
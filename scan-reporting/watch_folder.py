@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+help_info = """
+Watches the data roots for new patients and queues them for processing
+without anyone having to notice them first. Every poll, the PTSTEN_* folders
+in each root are listed and the sizes and modification times of the files in
+their Acquired folders are compared with the last poll (no OS-specific file
+notifier is needed). A patient is queued once its Acquired folder has stopped
+changing for the settle time, so a drop that is still being copied in isn't
+picked up half-finished. Files whose names start with . or ~, or end in .part,
+.tmp, .partial or .filepart are treated as still being written and ignored.
+
+Each patient is only queued once. The queued patients are recorded in a
+state file, so restarting the watcher doesn't queue them again. Folders that
+already have a meta.txt (processing has already been started on them) are
+not queued unless -b is given.
+
+How a patient is queued (-a):
+    daemon : submitted to the report daemon (report_daemon.py) on the socket given by -k. default
+    jobfile : appended to the batch.py job file given by -k
+    queue : added to the job queue (job_queue.py) database given by -k
+    print : only printed
+
+input:
+    -r / --roots : the data roots to watch, separated by commas
+    -p / --pipeline : bold or scd. default: bold
+    -x / --options : the options of process_bold.py or process_scd.py used for every patient, as one
+        string. -i is added. {folder} and {pt_id} are replaced with the patient's folder and ID. default: -q
+    -a / --action : daemon, jobfile, queue or print. default: daemon
+    -k / --target : the socket (daemon), job file (jobfile) or queue database (queue).
+        default for daemon: report_daemon.SOCKET_PATH, for queue: job_queue.QUEUE_DB
+    -s / --settle : seconds the Acquired folder must go unchanged before the patient is queued. default: 60
+    -i / --interval : seconds between polls. default: 10
+    -m / --match : the pattern the patient folders must match. default: PTSTEN_*
+    -b / --backlog : also queue folders that already have a meta.txt. does not take an argument
+    -t / --state : the state file. default: .watch_folder.json in the first root
+    -c / --polls : stop after this many polls. default: 0 (run until SIGTERM or ctrl-c)
+    -y / --simulate : instead of watching, run the test harness in this (new) folder: synthetic scans are
+        dropped into a data root the way a scanner export would (in chunks, through temporary
+        names, with pauses between files) and the watcher is checked to queue each patient exactly
+        once and only after its drop has finished. -s and -i set the watcher's timings (use
+        a few seconds); -n sets the number of patients (default: 3)
+    -g / --help : brings up this helpful information. does not take an argument
+"""
+
+import os
+import sys
+import getopt
+import glob
+import json
+import time
+import shlex
+import shutil
+import signal
+import threading
+
+IGNORED_PREFIXES = ('.', '~')
+PARTIAL_SUFFIXES = ('.part', '.tmp', '.partial', '.filepart')
+STATE_FILE = '.watch_folder.json'
+
+
+def is_partial(name):
+    return name.startswith(IGNORED_PREFIXES) or name.endswith(PARTIAL_SUFFIXES)
+
+
+def snapshot(acq_folder):
+    """
+    The size and modification time of every finished file in a folder
+
+
+    Parameters
+    ----------
+    acq_folder : str
+        the Acquired folder.
+
+    Returns
+    -------
+    dict of relative path: (size, mtime in ns). Empty if the folder doesn't exist.
+
+    """
+
+    snap = {}
+    for folder, subfolders, files in os.walk(acq_folder):
+        subfolders[:] = [s for s in subfolders if not is_partial(s)]
+        for name in files:
+            if is_partial(name):
+                continue
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError: # renamed or removed since the listing
+                continue
+            snap[os.path.relpath(path, acq_folder)] = (st.st_size, st.st_mtime_ns)
+    return snap
+
+
+def job_args(folder, options):
+    """
+    The pipeline options for one patient: -i folder and options, with
+    {folder} and {pt_id} filled in
+    """
+
+    pt_id = os.path.basename(os.path.normpath(folder))
+    return ['-i', folder] + [a.format(folder=folder, pt_id=pt_id) for a in shlex.split(options)]
+
+
+def make_action(action, pipeline, options, target=None):
+    """
+    Builds the function that queues a patient
+
+
+    Parameters
+    ----------
+    action : str
+        'daemon', 'jobfile', 'queue' or 'print'. See help_info.
+    pipeline : str
+        'bold' or 'scd'.
+    options : str
+        the pipeline options. See job_args().
+    target : str, optional
+        the daemon socket, the job file or the queue database.
+
+    Returns
+    -------
+    function of the patient folder that queues it and returns a description. Raises if it couldn't.
+
+    """
+
+    if action == 'daemon':
+        import report_daemon
+        socket_path = target or report_daemon.SOCKET_PATH
+
+        def queue(folder):
+            reply = report_daemon.submit(socket_path, pipeline, job_args(folder, options), wait=False)
+            if not reply['ok']:
+                raise RuntimeError(reply.get('error'))
+            return f'submitted to the report daemon as job {reply["job"]}'
+    elif action == 'jobfile':
+        if target is None:
+            raise ValueError('The jobfile action needs a job file (-k)')
+
+        def queue(folder):
+            with open(target, 'a') as f:
+                f.write(' '.join([pipeline] + [shlex.quote(a) for a in job_args(folder, options)]) + '\n')
+            return f'added to {target}'
+    elif action == 'queue':
+        import job_queue
+        job_db = job_queue.JobQueue(target or job_queue.QUEUE_DB)
+
+        def queue(folder):
+            return f'added to the job queue as job {job_db.add(pipeline, job_args(folder, options))}'
+    elif action == 'print':
+        def queue(folder):
+            return ' '.join([pipeline] + [shlex.quote(a) for a in job_args(folder, options)])
+    else:
+        raise ValueError(f'Unknown action {action}. Must be daemon, jobfile, queue or print')
+    return queue
+
+
+class Watcher:
+    """
+    Polls data roots for patient folders whose Acquired data has arrived
+
+
+    Parameters
+    ----------
+    roots : list of str
+        the data roots.
+    queue : function
+        called with the folder of each patient that is ready. See make_action().
+    settle : float, optional
+        seconds the Acquired folder must go unchanged. The default is 60.
+    match : str, optional
+        the pattern the patient folders must match. The default is 'PTSTEN_*'.
+    backlog : bool, optional
+        also queue folders that already have a meta.txt. The default is False.
+    state_file : str, optional
+        where the queued patients are recorded. The default is STATE_FILE in the first root.
+
+    """
+
+    def __init__(self, roots, queue, settle=60, match='PTSTEN_*', backlog=False, state_file=None):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.queue = queue
+        self.settle = settle
+        self.match = match
+        self.backlog = backlog
+        self.state_file = state_file or os.path.join(self.roots[0], STATE_FILE)
+        self.pending = {} # folder: {'snapshot', 'changed', 'first_seen'}
+        self.stopping = threading.Event()
+
+        self.state = {'queued':{}}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp, self.state_file)
+
+    def candidates(self):
+        for root in self.roots:
+            for acq_folder in sorted(glob.glob(os.path.join(root, self.match, 'Acquired'))):
+                yield os.path.dirname(acq_folder)
+
+    def poll(self, now=None):
+        """
+        Looks at every patient folder once and queues the ones that are ready
+
+
+        Parameters
+        ----------
+        now : float, optional
+            the time of the poll. The default is None (time.time()).
+
+        Returns
+        -------
+        list of the folders queued.
+
+        """
+
+        now = time.time() if now is None else now
+        queued = []
+        seen = set()
+        for folder in self.candidates():
+            seen.add(folder)
+            if folder in self.state['queued']:
+                continue
+            if not self.backlog and os.path.exists(os.path.join(folder, 'meta.txt')):
+                continue
+
+            snap = snapshot(os.path.join(folder, 'Acquired'))
+            entry = self.pending.get(folder)
+            if entry is None:
+                print(f'{time.strftime("%H:%M:%S")} new patient folder: {folder}', flush=True)
+                entry = self.pending[folder] = {'snapshot':snap, 'changed':now, 'first_seen':now}
+            elif snap != entry['snapshot']:
+                entry['snapshot'] = snap
+                entry['changed'] = now # debounce: every change restarts the settle time
+
+            if not snap or now - entry['changed'] < self.settle:
+                continue
+
+            try:
+                how = self.queue(folder)
+            except Exception as e:
+                print(f'{time.strftime("%H:%M:%S")} could not queue {folder}, will retry: {type(e).__name__}: {e}', flush=True)
+                continue
+            self.state['queued'][folder] = {'queued':time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+                                            'files':len(snap), 'bytes':sum([s for s, m in snap.values()]),
+                                            'waited_seconds':round(now - entry['first_seen'], 1)}
+            self.save_state()
+            del self.pending[folder]
+            queued.append(folder)
+            print(f'{time.strftime("%H:%M:%S")} queued {folder} ({len(snap)} files): {how}', flush=True)
+
+        for folder in list(self.pending):
+            if folder not in seen: # removed or renamed before it settled
+                del self.pending[folder]
+        return queued
+
+    def run(self, interval=10, polls=0):
+        """
+        Polls every interval seconds until stop() is called (or SIGTERM/ctrl-c
+        when run from the command line), or for polls polls if it isn't 0
+        """
+
+        n = 0
+        while not self.stopping.is_set():
+            self.poll()
+            n += 1
+            if polls and n >= polls:
+                break
+            self.stopping.wait(interval)
+
+    def stop(self):
+        self.stopping.set()
+
+
+def drop_file(src, dst, chunk=256*1024, delay=0.02):
+    """
+    Copies a file the way a slow scanner export would: to a temporary .part
+    name in chunks, then renamed into place
+    """
+
+    tmp = f'{dst}.part'
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        while True:
+            data = fin.read(chunk)
+            if not data:
+                break
+            fout.write(data)
+            fout.flush()
+            time.sleep(delay)
+    os.replace(tmp, dst)
+
+
+def simulate(out_folder, patients=3, settle=3, interval=0.5, pipeline='bold'):
+    """
+    The test harness: drops synthetic scans into a data root while a Watcher
+    polls it, then checks that every patient was queued exactly once and only
+    after its drop finished
+
+
+    Parameters
+    ----------
+    out_folder : str
+        a folder for the harness. Must not exist yet.
+    patients : int, optional
+        the number of patients dropped. The default is 3.
+    settle, interval : float, optional
+        the Watcher's settle time and poll interval. The default is 3 and 0.5.
+    pipeline : str, optional
+        'bold' or 'scd', which scans to drop. The default is 'bold'.
+
+    Returns
+    -------
+    dict of the results. 'passed' is True if every check passed.
+
+    """
+
+    import synthetic_cohort as sc
+
+    staging = os.path.join(out_folder, 'staging')
+    root = os.path.join(out_folder, 'root')
+    os.makedirs(root)
+    scans = sc.BOLD_SCANS if pipeline == 'bold' else sc.SCD_SCANS
+    pt_ids = [f'PTSTEN_{800+i:03d}_01' for i in range(patients)]
+    for i, pt_id in enumerate(pt_ids):
+        sc.write_acquired(os.path.join(staging, pt_id), sc.NAMES[i % len(sc.NAMES)], scans, 'par', '2020.01.01', 20, seed=i)
+
+    queued = {}
+    def record(folder):
+        queued.setdefault(os.path.basename(folder), []).append(time.time())
+        return 'recorded'
+
+    watcher = Watcher([root], record, settle=settle)
+    thread = threading.Thread(target=watcher.run, args=(interval,), daemon=True)
+    thread.start()
+
+    finished = {}
+    def drop(pt_id):
+        acq_folder = os.path.join(root, pt_id, 'Acquired')
+        os.makedirs(acq_folder)
+        files = sorted(os.listdir(os.path.join(staging, pt_id)))
+        for j, name in enumerate(files):
+            drop_file(os.path.join(staging, pt_id, name), os.path.join(acq_folder, name))
+            if j == len(files) // 2:
+                time.sleep(settle * 0.6) # a pause shorter than the settle time partway through the series
+        finished[pt_id] = time.time()
+
+    # the first two patients are dropped at the same time, the rest one after another
+    droppers = [threading.Thread(target=drop, args=(pt_id,)) for pt_id in pt_ids[:2]]
+    for t in droppers:
+        t.start()
+    for t in droppers:
+        t.join()
+    for pt_id in pt_ids[2:]:
+        drop(pt_id)
+
+    time.sleep(settle + 3 * interval)
+    # a late change to a patient that has been queued must not queue it again
+    first = os.path.join(root, pt_ids[0], 'Acquired')
+    os.utime(os.path.join(first, sorted(os.listdir(first))[0]))
+    time.sleep(settle + 3 * interval)
+    watcher.stop()
+    thread.join()
+
+    # a restarted watcher must not queue anything again either
+    restarted = Watcher([root], record, settle=0)
+    restarted.poll()
+
+    results = []
+    passed = True
+    for pt_id in pt_ids:
+        times = queued.get(pt_id, [])
+        ok = len(times) == 1 and times[0] >= finished[pt_id] + 0.9 * settle # 0.9: the last change may be seen just before finished is recorded
+        passed = passed and ok
+        latency = round(times[0] - finished[pt_id], 2) if times else None
+        results.append({'pt_id':pt_id, 'times_queued':len(times), 'seconds_after_drop':latency, 'ok':ok})
+        print(f'{pt_id}: queued {len(times)} time(s), {latency} s after its drop finished: {"ok" if ok else "FAILED"}')
+
+    shutil.rmtree(staging)
+    summary = {'patients':patients, 'settle':settle, 'interval':interval, 'passed':passed, 'results':results}
+    with open(os.path.join(out_folder, 'simulation.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+    print(f'\nSimulation {"passed" if passed else "FAILED"}')
+    return summary
+
+
+if __name__ == '__main__':
+
+    options, remainder = getopt.getopt(sys.argv[1:], "r:p:x:a:k:s:i:m:bt:c:y:n:g", ['roots=', 'pipeline=', 'options=', 'action=', 'target=',
+                                                                                  'settle=', 'interval=', 'match=', 'backlog', 'state=',
+                                                                                  'polls=', 'simulate=', 'number=', 'help'])
+
+    roots = None
+    pipeline = 'bold'
+    pipeline_options = '-q'
+    action = 'daemon'
+    target = None
+    settle = None
+    interval = None
+    match = 'PTSTEN_*'
+    backlog = False
+    state_file = None
+    polls = 0
+    sim_folder = None
+    number = 3
+
+    for opt, arg in options:
+        if opt in ('-r', '--roots'):
+            roots = arg.split(',')
+        elif opt in ('-p', '--pipeline'):
+            pipeline = arg
+        elif opt in ('-x', '--options'):
+            pipeline_options = arg
+        elif opt in ('-a', '--action'):
+            action = arg
+        elif opt in ('-k', '--target'):
+            target = arg
+        elif opt in ('-s', '--settle'):
+            settle = float(arg)
+        elif opt in ('-i', '--interval'):
+            interval = float(arg)
+        elif opt in ('-m', '--match'):
+            match = arg
+        elif opt in ('-b', '--backlog'):
+            backlog = True
+        elif opt in ('-t', '--state'):
+            state_file = arg
+        elif opt in ('-c', '--polls'):
+            polls = int(arg)
+        elif opt in ('-y', '--simulate'):
+            sim_folder = arg
+        elif opt in ('-n', '--number'):
+            number = int(arg)
+        elif opt in ('-g', '--help'):
+            print(help_info)
+            sys.exit()
+
+    if sim_folder is not None:
+        summary = simulate(sim_folder, number, settle or 3, interval or 0.5, pipeline)
+        sys.exit(0 if summary['passed'] else 1)
+
+    if not roots:
+        raise ValueError('At least one data root (-r) is required')
+    if pipeline not in ('bold', 'scd'):
+        raise ValueError(f'pipeline must be bold or scd, not {pipeline}')
+
+    watcher = Watcher(roots, make_action(action, pipeline, pipeline_options, target),
+                      settle=60 if settle is None else settle, match=match, backlog=backlog, state_file=state_file)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: watcher.stop())
+    print(f'Watching {", ".join(watcher.roots)} for {match}/Acquired (settle {watcher.settle} s). State: {watcher.state_file}')
+    watcher.run(10 if interval is None else interval, polls)